@@ -33,6 +33,148 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 ML_PREDICT_PATH = BASE_DIR / 'ml_predict' / 'saved_models'
 
+# ML inference
+# Run the disease models as one fused multi-output graph instead of a loop
+ML_FUSED_INFERENCE = config('ML_FUSED_INFERENCE', default=False, cast=bool)
+# Run a frozen base network shared by several disease models (same
+# architecture and weights) once per image, feeding each model's head
+ML_SHARE_BACKBONES = config('ML_SHARE_BACKBONES', default=True, cast=bool)
+# Engine serving the classifiers (ml_predict/backends.py): 'keras', 'tf_function',
+# 'xla', or 'tflite[:variant]' for the files written by manage.py export_tflite.
+# Grad-CAMs always use the Keras models. ML_INFERENCE_BACKENDS overrides it per
+# disease, e.g. "cardiomegaly=xla,tuberculosis=tflite:int8".
+ML_INFERENCE_BACKEND = config('ML_INFERENCE_BACKEND', default='keras')
+ML_INFERENCE_BACKENDS = config(
+    'ML_INFERENCE_BACKENDS', default='',
+    cast=lambda value: dict(
+        item.strip().split('=', 1) for item in value.split(',') if item.strip()))
+# Batch sizes the xla backend compiles at warm-up; batches are padded up to
+# the nearest one. Keep the largest at ML_BATCH_MAX_SIZE.
+ML_XLA_BATCH_BUCKETS = config(
+    'ML_XLA_BATCH_BUCKETS', default='1,2,4,8',
+    cast=lambda value: tuple(int(size) for size in value.split(',') if size.strip()))
+ML_TFLITE_VARIANT = config('ML_TFLITE_VARIANT', default='float16')
+ML_TFLITE_THREADS = config('ML_TFLITE_THREADS', default=0, cast=int)
+# Load the models in each gunicorn worker at boot (gunicorn.conf.py) instead
+# of on the first inference request
+ML_WARMUP_ON_BOOT = config('ML_WARMUP_ON_BOOT', default=False, cast=bool)
+# Models load and warm up on a bounded pool; requests are served by the
+# models that are ready while the rest finish (unless ML_SERVE_PARTIAL is off)
+ML_LOAD_WORKERS = config('ML_LOAD_WORKERS', default=4, cast=int)
+ML_SERVE_PARTIAL = config('ML_SERVE_PARTIAL', default=True, cast=bool)
+ML_LOAD_TIMEOUT_SECONDS = config('ML_LOAD_TIMEOUT_SECONDS', default=300, cast=int)
+# Unload the least recently used models when the resident ones exceed this
+# many MB of weights (0 = no limit), or after this many seconds without use
+# (0 = never); they reload on the next request that needs them. Pinned
+# models stay resident. Counters are on /api/ml/health/.
+ML_MODEL_MEMORY_BUDGET_MB = config('ML_MODEL_MEMORY_BUDGET_MB', default=0, cast=int)
+ML_MODEL_IDLE_SECONDS = config('ML_MODEL_IDLE_SECONDS', default=0, cast=int)
+ML_PINNED_MODELS = config(
+    'ML_PINNED_MODELS', default='',
+    cast=lambda value: [name.strip() for name in value.split(',') if name.strip()])
+# Unix socket of the shared inference daemon (manage.py run_inference_server);
+# empty runs inference in every web worker
+ML_INFERENCE_SOCKET = config('ML_INFERENCE_SOCKET', default='')
+ML_INFERENCE_TIMEOUT_SECONDS = config('ML_INFERENCE_TIMEOUT_SECONDS', default=120, cast=float)
+ML_INFERENCE_CONNECT_TIMEOUT = config('ML_INFERENCE_CONNECT_TIMEOUT', default=1.0, cast=float)
+# Load the models in-process when the daemon can't be reached
+ML_INFERENCE_FALLBACK = config('ML_INFERENCE_FALLBACK', default=True, cast=bool)
+# Have web workers preprocess X-rays and pass the tensors to the daemon
+# through a ring of shared-memory slots (read by run_inference_server)
+ML_SHM_TRANSPORT = config('ML_SHM_TRANSPORT', default=False, cast=bool)
+ML_SHM_SLOTS = config('ML_SHM_SLOTS', default=8, cast=int)
+ML_SHM_SLOT_BYTES = config('ML_SHM_SLOT_BYTES', default=4 * 1024 * 1024, cast=int)
+# How long a worker waits for a free slot before answering 503
+ML_SHM_ACQUIRE_TIMEOUT = config('ML_SHM_ACQUIRE_TIMEOUT', default=5.0, cast=float)
+# Coalesce concurrent predict requests into batches (needs threaded workers)
+ML_BATCHING_ENABLED = config('ML_BATCHING_ENABLED', default=False, cast=bool)
+ML_BATCH_MAX_SIZE = config('ML_BATCH_MAX_SIZE', default=8, cast=int)
+ML_BATCH_MAX_WAIT_MS = config('ML_BATCH_MAX_WAIT_MS', default=10, cast=int)
+ML_BATCH_MAX_QUEUE_DEPTH = config('ML_BATCH_MAX_QUEUE_DEPTH', default=64, cast=int)
+ML_BATCH_TIMEOUT_SECONDS = config('ML_BATCH_TIMEOUT_SECONDS', default=60, cast=int)
+# Inference slots per worker process for synchronous predictions. Lanes are
+# "name=max_running:max_queued", highest priority first; X-rays for an
+# emergency appointment use the urgent lane. Requests that find their lane's
+# queue full or wait longer than the timeout get a 429 with Retry-After.
+# Off by default: turning it on can reject requests that used to queue.
+ML_ADMISSION_ENABLED = config('ML_ADMISSION_ENABLED', default=False, cast=bool)
+ML_ADMISSION_MAX_CONCURRENT = config('ML_ADMISSION_MAX_CONCURRENT', default=4, cast=int)
+ML_ADMISSION_LANES = config(
+    'ML_ADMISSION_LANES', default='urgent=4:16,routine=3:32',
+    cast=lambda value: [
+        (name.strip(), int(limits.split(':')[0]), int(limits.split(':')[1]))
+        for name, limits in (item.split('=', 1) for item in value.split(',') if item.strip())])
+ML_ADMISSION_QUEUE_TIMEOUT_SECONDS = config(
+    'ML_ADMISSION_QUEUE_TIMEOUT_SECONDS', default=30, cast=float)
+# A patient's lane without an appointment_id is looked up once per day and
+# cached this long, so a new emergency booking is picked up soon after
+ML_ADMISSION_LANE_CACHE_SECONDS = config('ML_ADMISSION_LANE_CACHE_SECONDS', default=60, cast=int)
+# Also store Grad-CAMs for other diseases above this confidence
+ML_SECONDARY_GRADCAMS = config('ML_SECONDARY_GRADCAMS', default=True, cast=bool)
+ML_GRADCAM_CONFIDENCE_THRESHOLD = config(
+    'ML_GRADCAM_CONFIDENCE_THRESHOLD', default=0.3, cast=float)
+ML_GRADCAM_WORKERS = config('ML_GRADCAM_WORKERS', default=4, cast=int)
+# Grad-CAM overlays are scaled down to this many pixels on their longest
+# side (0 = the X-ray's own size); colormap is one of rendering.COLORMAPS
+ML_GRADCAM_MAX_RESOLUTION = config('ML_GRADCAM_MAX_RESOLUTION', default=1024, cast=int)
+ML_GRADCAM_COLORMAP = config('ML_GRADCAM_COLORMAP', default='jet')
+# Grad-CAMs are stored as png, webp or jpeg; the Grad-CAM endpoint
+# re-encodes them when the client's Accept header prefers another format.
+# manage.py benchmark_encoding compares the settings.
+ML_GRADCAM_FORMAT = config('ML_GRADCAM_FORMAT', default='png')
+ML_GRADCAM_WEBP_QUALITY = config('ML_GRADCAM_WEBP_QUALITY', default=80, cast=int)
+# 0 (fastest) to 6 (smallest)
+ML_GRADCAM_WEBP_METHOD = config('ML_GRADCAM_WEBP_METHOD', default=4, cast=int)
+ML_GRADCAM_JPEG_QUALITY = config('ML_GRADCAM_JPEG_QUALITY', default=85, cast=int)
+# Answer predict requests once the models have scored the image and build
+# the Grad-CAMs afterwards on a background pool (gradcam_status tracks them;
+# the Grad-CAM endpoint answers 202 meanwhile). Pending ones older than the
+# timeout are assumed orphaned and generated on request instead.
+ML_DEFER_GRADCAM = config('ML_DEFER_GRADCAM', default=False, cast=bool)
+ML_DEFERRED_GRADCAM_WORKERS = config('ML_DEFERRED_GRADCAM_WORKERS', default=1, cast=int)
+ML_DEFERRED_GRADCAM_TIMEOUT_SECONDS = config(
+    'ML_DEFERRED_GRADCAM_TIMEOUT_SECONDS', default=300, cast=int)
+# Latency budget for a synchronous prediction (0 = none). Scoring always
+# runs; Grad-CAMs whose measured duration doesn't fit in the time left
+# (less the reserve for saving the result) are deferred or skipped, and
+# under pressure Grad-CAMs are encoded faster (the fast PNG level, WebP
+# method 0). PNG is lossless, so the levels (0-9) only trade file size
+# for encoding time.
+ML_PREDICTION_BUDGET_MS = config('ML_PREDICTION_BUDGET_MS', default=0, cast=int)
+ML_PREDICTION_BUDGET_RESERVE_MS = config('ML_PREDICTION_BUDGET_RESERVE_MS', default=200, cast=int)
+ML_GRADCAM_PNG_COMPRESS_LEVEL = config('ML_GRADCAM_PNG_COMPRESS_LEVEL', default=6, cast=int)
+ML_GRADCAM_FAST_PNG_COMPRESS_LEVEL = config(
+    'ML_GRADCAM_FAST_PNG_COMPRESS_LEVEL', default=1, cast=int)
+# Reuse stored results for byte-identical uploads scored by the same models
+ML_PREDICTION_MEMOIZATION = config('ML_PREDICTION_MEMOIZATION', default=True, cast=bool)
+# Content-addressed Grad-CAM cache (memory LRU + MEDIA_ROOT/gradcam_cache)
+ML_GRADCAM_CACHE_ENABLED = config('ML_GRADCAM_CACHE_ENABLED', default=True, cast=bool)
+ML_GRADCAM_CACHE_MEMORY_BYTES = config(
+    'ML_GRADCAM_CACHE_MEMORY_BYTES', default=32 * 1024 * 1024, cast=int)
+ML_GRADCAM_CACHE_DISK_BYTES = config(
+    'ML_GRADCAM_CACHE_DISK_BYTES', default=512 * 1024 * 1024, cast=int)
+# Concurrent requests for the same prediction or Grad-CAM wait for the one
+# already computing it (across workers via the InferenceLock table) for up
+# to ML_SINGLE_FLIGHT_TIMEOUT_SECONDS, then get a 503. Locks older than the
+# TTL are treated as left behind by a dead worker.
+ML_SINGLE_FLIGHT_TIMEOUT_SECONDS = config(
+    'ML_SINGLE_FLIGHT_TIMEOUT_SECONDS', default=60, cast=int)
+ML_SINGLE_FLIGHT_LOCK_TTL_SECONDS = config(
+    'ML_SINGLE_FLIGHT_LOCK_TTL_SECONDS', default=300, cast=int)
+ML_SINGLE_FLIGHT_DB = config('ML_SINGLE_FLIGHT_DB', default=True, cast=bool)
+# Queue predictions as PredictionJobs and return 202 instead of scoring
+# them in the request; manage.py run_prediction_workers drains the queue.
+# EAGER runs each job inside the request (tests, single-process dev).
+ML_ASYNC_PREDICTIONS = config('ML_ASYNC_PREDICTIONS', default=False, cast=bool)
+ML_PREDICTION_JOBS_EAGER = config('ML_PREDICTION_JOBS_EAGER', default=False, cast=bool)
+ML_PREDICTION_WORKER_THREADS = config('ML_PREDICTION_WORKER_THREADS', default=2, cast=int)
+# Running jobs older than this are assumed orphaned by a dead worker and
+# requeued; orphaned and busy/timed-out jobs are retried up to
+# MAX_ATTEMPTS times, then fail
+ML_PREDICTION_JOB_TIMEOUT_SECONDS = config(
+    'ML_PREDICTION_JOB_TIMEOUT_SECONDS', default=600, cast=int)
+ML_PREDICTION_JOB_MAX_ATTEMPTS = config('ML_PREDICTION_JOB_MAX_ATTEMPTS', default=3, cast=int)
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+# Read automatically by gunicorn from the working directory (see Procfile)
+
+
+def post_worker_init(worker):
+    """Load the ML models before the worker accepts requests when ML_WARMUP_ON_BOOT is set"""
+    from django.conf import settings
+
+    if getattr(settings, 'ML_WARMUP_ON_BOOT', False):
+        from ml_predict.inference import warm_up
+        worker.log.info("Warming up ML models")
+        warm_up()
@@ -0,0 +1,225 @@
+# ml_predict/admission.py
+"""
+Bounded admission in front of the predictor, with priority lanes.
+
+Predict requests take one of ML_ADMISSION_MAX_CONCURRENT inference slots
+before running the models. Each lane (ML_ADMISSION_LANES, highest
+priority first) has its own cap on running and waiting requests, so
+routine screenings can't take every slot, and a freed slot always goes to
+the waiter in the highest priority lane. A request that finds its lane's
+queue full, or waits longer than ML_ADMISSION_QUEUE_TIMEOUT_SECONDS, is
+rejected with a Retry-After estimated from the lane's measured service
+time instead of piling up until the proxy times out.
+
+Limits apply per worker process, like the batching queue.
+"""
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest service time in the moving average
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """The request's lane is full; retry_after is the suggested wait in seconds"""
+
+    def __init__(self, lane, retry_after, reason):
+        super().__init__(f"{lane} lane {reason}")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Admit requests to a fixed number of inference slots, lane by lane"""
+
+    def __init__(self, max_concurrent, lanes, queue_timeout=30.0):
+        # lanes: [(name, max_running, max_queued)], highest priority first
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.lanes = [name for name, _, _ in lanes]
+        self._limits = {name: (running, queued) for name, running, queued in lanes}
+        self._condition = threading.Condition()
+        self._running = 0
+        self._lanes = {
+            name: {
+                'running': 0,
+                'waiting': deque(),
+                'admitted': 0,
+                'rejected_full': 0,
+                'rejected_timeout': 0,
+                'wait_ms_total': 0.0,
+                'wait_ms_max': 0.0,
+                'service_ms_ewma': None,
+            }
+            for name in self.lanes
+        }
+
+    def _can_start(self, lane):
+        return (self._running < self.max_concurrent
+                and self._lanes[lane]['running'] < self._limits[lane][0])
+
+    def _next_lane(self):
+        """The highest priority lane with a waiter that could start now"""
+        for lane in self.lanes:
+            if self._lanes[lane]['waiting'] and self._can_start(lane):
+                return lane
+        return None
+
+    def retry_after(self, lane):
+        """Seconds until the lane's queue has probably drained a place"""
+        state = self._lanes[lane]
+        service_ms = state['service_ms_ewma'] or 1000.0
+        ahead = len(state['waiting']) + 1
+        slots = max(1, min(self._limits[lane][0], self.max_concurrent))
+        return max(1, math.ceil(service_ms * ahead / slots / 1000))
+
+    def acquire(self, lane):
+        """Wait for a slot in lane; raises AdmissionRejected"""
+        state = self._lanes[lane]
+        started = time.perf_counter()
+        with self._condition:
+            if not state['waiting'] and self._next_lane() is None and self._can_start(lane):
+                ticket = None
+            else:
+                if len(state['waiting']) >= self._limits[lane][1]:
+                    state['rejected_full'] += 1
+                    raise AdmissionRejected(lane, self.retry_after(lane), 'queue is full')
+                ticket = object()
+                state['waiting'].append(ticket)
+                deadline = started + self.queue_timeout
+                while not (self._next_lane() == lane and state['waiting'][0] is ticket):
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        state['waiting'].remove(ticket)
+                        state['rejected_timeout'] += 1
+                        # Someone behind this request may be able to start
+                        self._condition.notify_all()
+                        raise AdmissionRejected(
+                            lane, self.retry_after(lane), 'queue wait timed out')
+                    self._condition.wait(remaining)
+                state['waiting'].popleft()
+
+            self._running += 1
+            state['running'] += 1
+            state['admitted'] += 1
+            wait_ms = (time.perf_counter() - started) * 1000
+            state['wait_ms_total'] += wait_ms
+            state['wait_ms_max'] = max(state['wait_ms_max'], wait_ms)
+            if ticket is not None:
+                # The next waiter may be able to start too
+                self._condition.notify_all()
+        return time.perf_counter()
+
+    def release(self, lane, admitted_at):
+        service_ms = (time.perf_counter() - admitted_at) * 1000
+        with self._condition:
+            state = self._lanes[lane]
+            self._running -= 1
+            state['running'] -= 1
+            previous = state['service_ms_ewma']
+            state['service_ms_ewma'] = service_ms if previous is None else (
+                EWMA_ALPHA * service_ms + (1 - EWMA_ALPHA) * previous)
+            self._condition.notify_all()
+
+    def admit(self, lane):
+        """Context manager holding a slot in lane (the lowest priority one if
+        it isn't configured) for the block"""
+        return _Admission(self, lane if lane in self._lanes else self.lanes[-1])
+
+    def stats(self):
+        with self._condition:
+            lanes = {}
+            for lane in self.lanes:
+                state = self._lanes[lane]
+                lanes[lane] = {
+                    'max_running': self._limits[lane][0],
+                    'max_queued': self._limits[lane][1],
+                    'running': state['running'],
+                    'queued': len(state['waiting']),
+                    'admitted': state['admitted'],
+                    'rejected_full': state['rejected_full'],
+                    'rejected_timeout': state['rejected_timeout'],
+                    'mean_wait_ms': (
+                        state['wait_ms_total'] / state['admitted'] if state['admitted'] else 0.0),
+                    'max_wait_ms': state['wait_ms_max'],
+                    'service_ms_ewma': state['service_ms_ewma'],
+                }
+            return {
+                'max_concurrent': self.max_concurrent,
+                'running': self._running,
+                'queue_timeout_seconds': self.queue_timeout,
+                'lanes': lanes,
+            }
+
+
+class _Admission:
+    def __init__(self, controller, lane):
+        self.controller = controller
+        self.lane = lane
+
+    def __enter__(self):
+        self.admitted_at = self.controller.acquire(self.lane)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller.release(self.lane, self.admitted_at)
+        return False
+
+
+def request_lane(patient, appointment_id=None):
+    """'urgent' for X-rays tied to an emergency appointment, else 'routine'
+
+    The appointment is the one given with the upload or, failing that, an
+    emergency appointment the patient has scheduled today. The latter is
+    cached per patient and day for ML_ADMISSION_LANE_CACHE_SECONDS.
+    """
+    from django.core.cache import cache
+    from django.utils import timezone
+    from dashboard.models import Appointment
+
+    appointments = Appointment.objects.filter(patient=patient, appointment_type='emergency')
+    if appointment_id is not None:
+        urgent = appointments.filter(id=appointment_id).exists()
+        return 'urgent' if urgent else 'routine'
+
+    today = timezone.localdate()
+    cache_key = f'ml_predict:lane:{patient.pk}:{today.isoformat()}'
+    lane = cache.get(cache_key)
+    if lane is None:
+        urgent = appointments.filter(date=today, status='scheduled').exists()
+        lane = 'urgent' if urgent else 'routine'
+        cache.set(cache_key, lane, getattr(settings, 'ML_ADMISSION_LANE_CACHE_SECONDS', 60))
+    return lane
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """The process-wide AdmissionController, or None when admission control is off"""
+    global _controller
+    if not getattr(settings, 'ML_ADMISSION_ENABLED', False):
+        return None
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(
+                    max_concurrent=getattr(settings, 'ML_ADMISSION_MAX_CONCURRENT', 4),
+                    lanes=getattr(
+                        settings, 'ML_ADMISSION_LANES',
+                        [('urgent', 4, 16), ('routine', 3, 32)]),
+                    queue_timeout=getattr(settings, 'ML_ADMISSION_QUEUE_TIMEOUT_SECONDS', 30))
+    return _controller
+
+
+def admission_stats():
+    """Per-lane counters, or None if admission control hasn't been used"""
+    return _controller.stats() if _controller is not None else None
@@ -7,6 +7,8 @@ class MlModelsConfig(AppConfig):
     name = 'ml_predict'
 
     def ready(self):
-        # Pre-load models when Django starts
-        from .utils import predictor
-        print("ML models loaded successfully")
+        # Models are loaded lazily by ml_predict.inference.get_predictor() on
+        # the first inference request (or by warmup_models / the gunicorn
+        # post_worker_init hook), so migrate, shell, collectstatic etc. don't
+        # import TensorFlow
+        pass
@@ -0,0 +1,204 @@
+# ml_predict/backbone_sharing.py
+"""
+Run a feature extractor shared by several disease models only once.
+
+The disease models are transfer-learned heads on a base network. When two
+or more models take the same input through a nested base model with the
+same architecture and the same weights, the base is run once and its
+features fed to each model's head. Models whose base was fine-tuned (so
+its weights differ), or which aren't a base followed by a chain of head
+layers, keep running as separate graphs.
+"""
+import json
+import hashlib
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+# Largest acceptable difference between a split model and the original
+PROBE_TOLERANCE = 1e-5
+
+
+def split_backbone(model):
+    """(backbone, head) for a model that is a nested base model followed by
+    a chain of layers, or None
+
+    The head reuses the model's own layers, so it holds no extra weights.
+    """
+    layers = [
+        layer for layer in model.layers
+        if not isinstance(layer, tf.keras.layers.InputLayer)]
+    if len(layers) < 2 or not isinstance(layers[0], tf.keras.Model):
+        return None
+    backbone = layers[0]
+    if tuple(backbone.input_shape[1:]) != tuple(model.input_shape[1:]):
+        return None
+
+    try:
+        # Replaying the remaining layers only reproduces the model when they
+        # form a simple chain; the probe below catches anything else
+        features = tf.keras.Input(shape=tuple(backbone.output_shape[1:]))
+        outputs = features
+        for layer in layers[1:]:
+            outputs = layer(outputs)
+        head = tf.keras.Model(features, outputs, name=f"{model.name}_head")
+
+        probe = np.random.default_rng(0).random(
+            (2,) + tuple(model.input_shape[1:]), dtype=np.float32)
+        expected = np.asarray(model(probe, training=False))
+        actual = np.asarray(head(backbone(probe, training=False), training=False))
+        if actual.shape != expected.shape or not np.allclose(
+                actual, expected, atol=PROBE_TOLERANCE):
+            return None
+    except Exception as e:
+        logger.debug(f"Could not split {model.name}: {str(e)}")
+        return None
+    return backbone, head
+
+
+def _flatten_layers(model):
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            yield from _flatten_layers(layer)
+        else:
+            yield layer
+
+
+def backbone_fingerprint(backbone):
+    """Hash of a backbone's architecture and weights, ignoring layer names"""
+    digest = hashlib.sha256()
+    digest.update(repr((tuple(backbone.input_shape), tuple(backbone.output_shape))).encode())
+    for layer in _flatten_layers(backbone):
+        config = {key: value for key, value in layer.get_config().items() if key != 'name'}
+        digest.update(type(layer).__name__.encode())
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+        for weight in layer.weights:
+            value = np.asarray(weight.numpy())
+            digest.update(f"{value.shape}{value.dtype}".encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def estimate_flops(model, input_shape):
+    """Floating point operations for one image, counted by the TF profiler
+
+    Returns None when the graph can't be profiled.
+    """
+    try:
+        from tensorflow.python.framework.convert_to_constants import (
+            convert_variables_to_constants_v2)
+
+        @tf.function
+        def forward(batch):
+            return model(batch, training=False)
+
+        concrete = forward.get_concrete_function(
+            tf.TensorSpec((1,) + tuple(input_shape), tf.float32))
+        frozen = convert_variables_to_constants_v2(concrete)
+        options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+        options['output'] = 'none'
+        return tf.compat.v1.profiler.profile(
+            graph=frozen.graph, options=options).total_float_ops
+    except Exception as e:
+        logger.debug(f"Could not count FLOPs for {model.name}: {str(e)}")
+        return None
+
+
+class SharedBackboneGroup:
+    """Models that share one backbone, run as backbone once plus one head each"""
+
+    def __init__(self, input_shape, backbone, heads, fingerprint):
+        self.input_shape = tuple(input_shape)
+        self.backbone = backbone
+        self.heads = heads  # disease -> head model, in configured order
+        self.fingerprint = fingerprint
+        self.diseases = list(heads)
+        self.backbone_flops = estimate_flops(backbone, self.input_shape)
+        self.head_flops = {
+            disease: estimate_flops(head, tuple(backbone.output_shape[1:]))
+            for disease, head in heads.items()}
+
+        heads_in_order = [heads[disease] for disease in self.diseases]
+
+        @tf.function(input_signature=[
+            tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+        def serve(batch):
+            features = backbone(batch, training=False)
+            return [head(features, training=False) for head in heads_in_order]
+
+        self._serve = serve
+        # Trace now so the first request doesn't pay for it
+        serve(tf.zeros((1,) + self.input_shape, dtype=tf.float32))
+
+    @property
+    def separate_flops(self):
+        """FLOPs per image when each model runs its own backbone"""
+        if self.backbone_flops is None or None in self.head_flops.values():
+            return None
+        return sum(self.backbone_flops + flops for flops in self.head_flops.values())
+
+    @property
+    def flops_saved(self):
+        """FLOPs per image no longer spent re-running the backbone"""
+        if self.backbone_flops is None:
+            return None
+        return self.backbone_flops * (len(self.diseases) - 1)
+
+    def features(self, model_input):
+        """Backbone output for a symbolic input, for building a larger graph"""
+        return self.backbone(model_input, training=False)
+
+    def predict(self, batch):
+        """disease -> NumPy output for a preprocessed batch"""
+        outputs = self._serve(tf.convert_to_tensor(batch, dtype=tf.float32))
+        return {disease: output.numpy() for disease, output in zip(self.diseases, outputs)}
+
+    def report(self):
+        return {
+            'diseases': self.diseases,
+            'input_shape': list(self.input_shape),
+            'backbone': self.backbone.name,
+            'fingerprint': self.fingerprint,
+            'backbone_flops': self.backbone_flops,
+            'separate_flops_per_image': self.separate_flops,
+            'flops_saved_per_image': self.flops_saved,
+        }
+
+
+def find_shared_backbones(models):
+    """Group models (disease -> Keras model) whose backbones are identical
+
+    Returns a list of SharedBackboneGroup, one per backbone used by two or
+    more models.
+    """
+    candidates = {}
+    for disease, model in models.items():
+        split = split_backbone(model)
+        if split is None:
+            continue
+        backbone, head = split
+        key = (tuple(model.input_shape[1:]), backbone_fingerprint(backbone))
+        candidates.setdefault(key, []).append((disease, backbone, head))
+
+    groups = []
+    for (input_shape, fingerprint), members in candidates.items():
+        if len(members) < 2:
+            continue
+        groups.append(SharedBackboneGroup(
+            input_shape, members[0][1],
+            {disease: head for disease, _, head in members}, fingerprint))
+
+    # Same base network, different weights: usually a fine-tuned backbone
+    by_name = {}
+    for (input_shape, fingerprint), members in candidates.items():
+        for disease, backbone, _ in members:
+            by_name.setdefault((input_shape, backbone.name), set()).add(fingerprint)
+    for (input_shape, name), fingerprints in by_name.items():
+        if len(fingerprints) > 1:
+            logger.info(
+                f"Backbone {name} differs between models with input {input_shape}; "
+                f"they keep separate graphs")
+    return groups
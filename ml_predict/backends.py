@@ -0,0 +1,258 @@
+# ml_predict/backends.py
+"""
+Inference backends: the runtime that turns a preprocessed batch into model
+outputs for one disease.
+
+Every backend wraps the disease's Keras model (which Grad-CAM always uses)
+and implements the same interface, so ChestXrayPredictor and the views
+don't care which engine serves a disease. Backends are picked per disease
+with ML_INFERENCE_BACKENDS, using specs like 'keras', 'tf_function', 'xla'
+or 'tflite:int8'.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+
+import numpy as np
+import tensorflow as tf
+from django.conf import settings
+
+from .hashing import sha256_file
+
+logger = logging.getLogger(__name__)
+
+
+class BackendUnavailable(Exception):
+    """The backend can't serve this model (e.g. no TFLite export)"""
+
+
+class InferenceBackend:
+    """Interface every inference backend implements"""
+
+    name = None
+    # Whether the engine can compute gradients, i.e. run Grad-CAM itself
+    supports_gradcam = False
+    # Whether the Grad-CAM step's outputs are bit-identical to predict_batch,
+    # so one pass can produce both the prediction and the heatmap
+    shares_gradcam_pass = False
+    # Whether the model can join the fused multi-output Keras graph
+    fusable = False
+
+    def __init__(self, keras_model, model_path, option=None):
+        self.keras_model = keras_model
+        self.model_path = model_path
+        self.option = option
+
+    @property
+    def spec(self):
+        return f"{self.name}:{self.option}" if self.option else self.name
+
+    @property
+    def input_shape(self):
+        """(None, height, width, channels), like a Keras model's input_shape"""
+        return (None,) + tuple(self.keras_model.input_shape[1:])
+
+    def load(self):
+        """Prepare the engine; raises BackendUnavailable if it can't serve"""
+
+    def warm_up(self):
+        """Run one dummy batch so the first request doesn't pay for setup"""
+        self.predict_batch(np.zeros((1,) + self.input_shape[1:], dtype=np.float32))
+
+    def predict_batch(self, batch):
+        """Run a float32 (batch, height, width, channels) array; returns a NumPy array"""
+        raise NotImplementedError
+
+    def version(self, keras_version):
+        """Fingerprint of what serves predictions, given the Keras file's"""
+        return keras_version
+
+    def stats(self):
+        """Runtime counters worth exposing on the health endpoint"""
+        return {}
+
+    def memory_report(self):
+        """Approximate memory held by the backend"""
+        weights = self.keras_model.weights
+        return {
+            'backend': self.spec,
+            'parameters': int(sum(np.prod(weight.shape) for weight in weights)),
+            'weight_bytes': int(sum(
+                np.prod(weight.shape) * np.dtype(weight.dtype).itemsize for weight in weights)),
+        }
+
+    # Duck-typed Keras API for code that still calls model.predict
+    def predict(self, batch, verbose=0):
+        return self.predict_batch(batch)
+
+
+class KerasEagerBackend(InferenceBackend):
+    """Calls the Keras model eagerly"""
+
+    name = 'keras'
+    supports_gradcam = True
+    shares_gradcam_pass = True
+    fusable = True
+
+    def predict_batch(self, batch):
+        return np.asarray(self.keras_model(batch, training=False))
+
+
+class KerasFunctionBackend(InferenceBackend):
+    """Runs the Keras model inside a tf.function traced once for any batch size"""
+
+    name = 'tf_function'
+    supports_gradcam = True
+    shares_gradcam_pass = True
+    jit_compile = False
+
+    def load(self):
+        keras_model = self.keras_model
+
+        @tf.function(
+            input_signature=[tf.TensorSpec(self.input_shape, tf.float32)],
+            jit_compile=self.jit_compile)
+        def serve(batch):
+            return keras_model(batch, training=False)
+
+        self._serve = serve
+
+    def predict_batch(self, batch):
+        return self._serve(tf.convert_to_tensor(batch, dtype=tf.float32)).numpy()
+
+
+class KerasXLABackend(KerasFunctionBackend):
+    """tf.function compiled with XLA, on a fixed set of batch sizes
+
+    XLA compiles once per input shape, so batches are zero-padded up to the
+    nearest of ML_XLA_BATCH_BUCKETS (larger ones are split) and every bucket
+    is compiled during warm-up instead of on a request.
+    """
+
+    name = 'xla'
+    # XLA fuses ops, so its outputs differ from the Grad-CAM step's in the
+    # last bits
+    shares_gradcam_pass = False
+    jit_compile = True
+
+    def __init__(self, keras_model, model_path, option=None):
+        super().__init__(keras_model, model_path, option)
+        self.buckets = tuple(sorted(set(
+            getattr(settings, 'ML_XLA_BATCH_BUCKETS', (1, 2, 4, 8)))))
+        self.compile_ms = {}
+        self._hits = {bucket: 0 for bucket in self.buckets}
+        self._padded_rows = 0
+        self._splits = 0
+        self._stats_lock = threading.Lock()
+
+    def warm_up(self):
+        for bucket in self.buckets:
+            started = time.perf_counter()
+            self._serve(tf.zeros((bucket,) + self.input_shape[1:], dtype=tf.float32))
+            self.compile_ms[bucket] = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Compiled {os.path.basename(self.model_path)} with XLA for batch sizes "
+            + ', '.join(f"{bucket} ({ms:.0f} ms)" for bucket, ms in self.compile_ms.items()))
+
+    def _bucket_for(self, size):
+        for bucket in self.buckets:
+            if bucket >= size:
+                return bucket
+        return self.buckets[-1]
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.buckets[-1]
+        if len(batch) > largest:
+            with self._stats_lock:
+                self._splits += 1
+            return np.concatenate([
+                self.predict_batch(batch[start:start + largest])
+                for start in range(0, len(batch), largest)])
+
+        size = len(batch)
+        bucket = self._bucket_for(size)
+        if bucket > size:
+            padded = np.zeros((bucket,) + batch.shape[1:], dtype=np.float32)
+            padded[:size] = batch
+            batch = padded
+        with self._stats_lock:
+            self._hits[bucket] += 1
+            self._padded_rows += bucket - size
+        return self._serve(tf.convert_to_tensor(batch))[:size].numpy()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'buckets': list(self.buckets),
+                'compile_ms': {str(bucket): round(ms, 1) for bucket, ms in self.compile_ms.items()},
+                'bucket_hits': {str(bucket): hits for bucket, hits in self._hits.items()},
+                'padded_rows': self._padded_rows,
+                'split_batches': self._splits,
+            }
+
+
+class TFLiteBackend(InferenceBackend):
+    """Serves the model's exported TFLite file (manage.py export_tflite)"""
+
+    name = 'tflite'
+
+    def __init__(self, keras_model, model_path, option=None):
+        super().__init__(
+            keras_model, model_path,
+            option or getattr(settings, 'ML_TFLITE_VARIANT', 'float16'))
+        self.tflite_model = None
+
+    def load(self):
+        from .tflite import TFLiteModel, tflite_path, VARIANTS
+        if self.option not in VARIANTS:
+            raise BackendUnavailable(f"Unknown TFLite variant {self.option!r}")
+        path = tflite_path(os.path.basename(self.model_path), self.option)
+        if not os.path.exists(path):
+            raise BackendUnavailable(f"No {self.option} TFLite export at {path}")
+        self.tflite_model = TFLiteModel(
+            path, num_threads=getattr(settings, 'ML_TFLITE_THREADS', 0))
+
+    @property
+    def input_shape(self):
+        return self.tflite_model.input_shape
+
+    def predict_batch(self, batch):
+        return self.tflite_model.predict(batch)
+
+    def version(self, keras_version):
+        # Predictions come from the TFLite file, Grad-CAMs from the Keras one
+        return hashlib.sha256(
+            f"{keras_version}:{sha256_file(self.tflite_model.model_path)}".encode()
+        ).hexdigest()[:16]
+
+    def memory_report(self):
+        report = super().memory_report()
+        report['flatbuffer_bytes'] = self.tflite_model.size_bytes
+        return report
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (KerasEagerBackend, KerasFunctionBackend, KerasXLABackend, TFLiteBackend)
+}
+
+
+def backend_spec_for(disease):
+    """The backend spec configured for a disease"""
+    return getattr(settings, 'ML_INFERENCE_BACKENDS', {}).get(
+        disease, getattr(settings, 'ML_INFERENCE_BACKEND', 'keras'))
+
+
+def create_backend(spec, keras_model, model_path):
+    """Build, load and warm up a backend from a spec like 'xla' or 'tflite:int8'"""
+    name, _, option = spec.partition(':')
+    backend_class = BACKENDS.get(name)
+    if backend_class is None:
+        raise BackendUnavailable(f"Unknown inference backend {name!r}")
+    backend = backend_class(keras_model, model_path, option or None)
+    backend.load()
+    backend.warm_up()
+    return backend
@@ -0,0 +1,184 @@
+# ml_predict/batching.py
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusy(Exception):
+    """Raised when the batching queue is full"""
+
+
+class BatchScheduler:
+    """Coalesce concurrent prediction requests into batched forward passes"""
+
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=10,
+                 max_queue_depth=64):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue_depth)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._counters = {
+            'requests': 0,
+            'rejected': 0,
+            'batches': 0,
+            'batch_sizes': {},  # batch size -> number of batches
+            'max_queue_depth': 0,
+            'queue_wait_ms_total': 0.0,
+            'queue_wait_ms_max': 0.0,
+            'inference_ms_total': 0.0,
+        }
+
+    def _ensure_worker(self):
+        """Start the batching thread on first use"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name='ml-batch-scheduler', daemon=True)
+                self._worker.start()
+
+    def submit(self, image_path, inputs=None):
+        """Queue an image for prediction and return a Future for its result"""
+        self._ensure_worker()
+
+        # Decode and resize in the caller's thread so the batch thread only
+        # runs the models
+        if inputs is None:
+            image = self.predictor.load_image(image_path)
+            inputs = self.predictor.preprocess_for_models(image)
+
+        future = Future()
+        try:
+            self._queue.put_nowait((inputs, future, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise SchedulerBusy("Prediction queue is full")
+
+        with self._lock:
+            self._counters['requests'] += 1
+            self._counters['max_queue_depth'] = max(
+                self._counters['max_queue_depth'], self._queue.qsize())
+        return future
+
+    def predict(self, image_path, timeout=None, inputs=None):
+        """Blocking helper with the same result shape as ChestXrayPredictor.predict"""
+        return self.submit(image_path, inputs=inputs).result(timeout=timeout)
+
+    def _collect_batch(self):
+        """Wait for one request, then gather more until the batch is full or max_wait passes"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Batch inference failed: {str(e)}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        started = time.perf_counter()
+        waits = [(started - enqueued_at) * 1000 for _, _, enqueued_at in batch]
+
+        # Stack each input shape into one batch tensor. Shapes only some
+        # requests have (a model finished loading in between) are left out.
+        input_shapes = set.intersection(*(set(inputs) for inputs, _, _ in batch))
+        stacked = {
+            input_shape: np.concatenate(
+                [inputs[input_shape] for inputs, _, _ in batch], axis=0)
+            for input_shape in input_shapes
+        }
+
+        # One forward pass per model (or one fused call) for the whole batch
+        outputs = self.predictor.run_models(stacked)
+
+        for index, (_, future, _) in enumerate(batch):
+            per_request = {
+                disease: None if output is None else output[index:index + 1]
+                for disease, output in outputs.items()
+            }
+            try:
+                future.set_result(
+                    self.predictor.summarise_outputs(per_request))
+            except Exception as e:
+                future.set_exception(e)
+
+        inference_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            counters = self._counters
+            counters['batches'] += 1
+            counters['batch_sizes'][len(batch)] = counters['batch_sizes'].get(
+                len(batch), 0) + 1
+            counters['queue_wait_ms_total'] += sum(waits)
+            counters['queue_wait_ms_max'] = max(
+                counters['queue_wait_ms_max'], max(waits))
+            counters['inference_ms_total'] += inference_ms
+
+        logger.info(
+            f"Ran batch of {len(batch)} in {inference_ms:.1f} ms "
+            f"(max queue wait {max(waits):.1f} ms)")
+
+    def stats(self):
+        """Snapshot of the scheduler counters"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters['batch_sizes'] = dict(self._counters['batch_sizes'])
+
+        batched_requests = sum(
+            size * count for size, count in counters['batch_sizes'].items())
+        counters['queue_depth'] = self._queue.qsize()
+        counters['mean_batch_size'] = (
+            batched_requests / counters['batches'] if counters['batches'] else 0.0)
+        counters['mean_queue_wait_ms'] = (
+            counters['queue_wait_ms_total'] / batched_requests if batched_requests else 0.0)
+        counters['max_batch_size'] = self.max_batch_size
+        counters['max_wait_ms'] = self.max_wait * 1000
+        return counters
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide batching scheduler, creating it on first use"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                from .inference import get_local_predictor
+                _scheduler = BatchScheduler(
+                    get_local_predictor(),
+                    max_batch_size=getattr(settings, 'ML_BATCH_MAX_SIZE', 8),
+                    max_wait_ms=getattr(settings, 'ML_BATCH_MAX_WAIT_MS', 10),
+                    max_queue_depth=getattr(
+                        settings, 'ML_BATCH_MAX_QUEUE_DEPTH', 64),
+                )
+    return _scheduler
+
+
+def scheduler_stats():
+    """Counters for the batching scheduler, or None if it hasn't been used"""
+    return _scheduler.stats() if _scheduler is not None else None
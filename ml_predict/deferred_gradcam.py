@@ -0,0 +1,120 @@
+# ml_predict/deferred_gradcam.py
+"""
+Grad-CAMs generated after the prediction response (ML_DEFER_GRADCAM).
+
+Most clinicians only read the confidence table, so the predict endpoint
+can answer as soon as the models have scored the image. The prediction is
+saved with gradcam_status 'pending' and, once that transaction commits, a
+bounded background pool builds its Grad-CAMs. get_gradcam_image answers
+202 until they are ready.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import PredictionResult
+from .pipeline import gradcam_diseases, store_gradcams
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_queued = set()  # Prediction ids submitted in this process and not yet done
+_counters = {
+    'scheduled': 0,
+    'generated': 0,
+    'failed': 0,
+    'skipped': 0,
+    'generate_ms_total': 0.0,
+}
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ML_DEFERRED_GRADCAM_WORKERS', 1),
+                    thread_name_prefix='deferred-gradcam')
+    return _executor
+
+
+def _submit(prediction_id):
+    with _lock:
+        if prediction_id in _queued:
+            return
+        _queued.add(prediction_id)
+        _counters['scheduled'] += 1
+    _get_executor().submit(_generate, prediction_id)
+
+
+def schedule_gradcams(prediction_id):
+    """Build a pending prediction's Grad-CAMs in the background once the
+    current transaction commits (straight away outside one)"""
+    transaction.on_commit(lambda: _submit(prediction_id))
+
+
+def is_overdue(prediction):
+    """Whether a pending or running Grad-CAM has taken so long its worker
+    probably died (ML_DEFERRED_GRADCAM_TIMEOUT_SECONDS)"""
+    timeout = getattr(settings, 'ML_DEFERRED_GRADCAM_TIMEOUT_SECONDS', 300)
+    return prediction.created_at < timezone.now() - timedelta(seconds=timeout)
+
+
+def ensure_scheduled(prediction):
+    """Queue a pending prediction here if no worker in this process has it,
+    e.g. because the process that made it exited first"""
+    if prediction.gradcam_status == 'pending':
+        _submit(prediction.id)
+
+
+def _generate(prediction_id):
+    close_old_connections()
+    started = time.perf_counter()
+    outcome = 'failed'
+    try:
+        # Claim it, so a worker in another process doesn't build it too
+        claimed = PredictionResult.objects.filter(
+            id=prediction_id, gradcam_status='pending').update(gradcam_status='running')
+        if not claimed:
+            outcome = 'skipped'
+            return
+        prediction = PredictionResult.objects.get(id=prediction_id)
+
+        from .inference import get_predictor
+        gradcam_files = get_predictor().generate_gradcams(
+            prediction.xray_image.path,
+            gradcam_diseases(prediction.predicted_disease, prediction.all_predictions))
+        if store_gradcams(prediction, gradcam_files):
+            outcome = 'generated'
+    except PredictionResult.DoesNotExist:
+        outcome = 'skipped'
+    except Exception as e:
+        logger.error(f"Deferred Grad-CAM for prediction {prediction_id} failed: {str(e)}")
+        PredictionResult.objects.filter(id=prediction_id).update(gradcam_status='failed')
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _lock:
+            _queued.discard(prediction_id)
+            _counters[outcome] += 1
+            if outcome != 'skipped':
+                _counters['generate_ms_total'] += elapsed_ms
+        close_old_connections()
+    logger.info(f"Deferred Grad-CAMs for prediction {prediction_id} {outcome} in {elapsed_ms:.0f} ms")
+
+
+def deferred_gradcam_stats():
+    with _lock:
+        counters = dict(_counters)
+        counters['queued'] = len(_queued)
+    finished = counters['generated'] + counters['failed']
+    counters['generate_ms_avg'] = counters['generate_ms_total'] / finished if finished else None
+    return counters
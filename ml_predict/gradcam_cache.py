@@ -0,0 +1,256 @@
+# ml_predict/gradcam_cache.py
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .rendering import IMAGE_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# Raw heatmaps are cached next to the overlays drawn from them, as
+# rendering.pack_heatmaps() blobs
+HEATMAP_FORMAT = 'npz'
+
+# Suffixes of the files the cache writes, one per format
+_EXTENSIONS = tuple(f'.{image_format}' for image_format in (*IMAGE_FORMATS, HEATMAP_FORMAT))
+
+
+class GradCAMCacheKey(namedtuple(
+        'GradCAMCacheKey',
+        ['image_hash', 'disease', 'model_version', 'layer_name', 'render', 'image_format'],
+        defaults=['', 'png'])):
+    """Content address of one encoded Grad-CAM overlay; render identifies the
+    rendering settings (colormap, resolution cap) and image_format the
+    encoding (png, webp or jpeg)
+
+    Entries without a model_version (overlays rendered from a stored
+    heatmap, addressed by its contents) survive invalidate().
+    """
+
+    @property
+    def digest(self):
+        return hashlib.sha256(
+            f"{self.image_hash}:{self.disease}:{self.model_version}:{self.layer_name}"
+            f":{self.render}:{self.image_format}".encode()
+        ).hexdigest()
+
+    @property
+    def heatmap_key(self):
+        """Key of the raw heatmap behind this overlay, whatever its rendering"""
+        return self._replace(render='', image_format=HEATMAP_FORMAT)
+
+    @property
+    def filename(self):
+        # disease and model version lead the name so stale versions can be
+        # found without an index
+        return f"{self.disease}-{self.model_version}-{self.digest[:32]}.{self.image_format}"
+
+
+class GradCAMCache:
+    """Two-tier cache of encoded Grad-CAM images and their heatmaps: an
+    in-memory LRU over a size-capped directory"""
+
+    def __init__(self, directory, max_memory_bytes, max_disk_bytes):
+        self.directory = str(directory)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> encoded bytes, oldest first
+        self._memory_bytes = 0
+        self._disk_bytes = None  # Measured lazily
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'puts': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'invalidations': 0,
+        }
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.filename)
+
+    def get(self, key):
+        """Return the cached bytes for a key, or None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Touch so disk eviction sees it as recently used
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+
+        with self._lock:
+            self._counters['disk_hits'] += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store encoded bytes in both tiers"""
+        with self._lock:
+            self._counters['puts'] += 1
+            self._remember(key, data)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            try:
+                replaced_bytes = os.stat(path).st_size
+            except OSError:
+                replaced_bytes = 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write Grad-CAM cache entry: {str(e)}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data) - replaced_bytes
+            over_budget = self._measure_disk() > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _remember(self, key, data):
+        """Add to the memory tier and evict least recently used entries (lock held)"""
+        if len(data) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._counters['memory_evictions'] += 1
+
+    def _disk_entries(self):
+        """(path, size, mtime) for every cache file"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(_EXTENSIONS):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _measure_disk(self):
+        """Current disk tier size (lock held)"""
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+        return self._disk_bytes
+
+    def _evict_disk(self):
+        """Delete least recently used files until the disk tier is under budget"""
+        # Rescan: other workers share the directory
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self._counters['disk_evictions'] += evicted
+
+    def invalidate(self, disease, current_version=None):
+        """Drop entries for a disease, keeping only those for current_version
+        and those not tied to a model version"""
+        with self._lock:
+            stale = [
+                key for key in self._memory
+                if key.disease == disease and key.model_version
+                and key.model_version != current_version
+            ]
+            for key in stale:
+                self._memory_bytes -= len(self._memory.pop(key))
+
+        removed = 0
+        for path, _, _ in self._disk_entries():
+            parts = os.path.basename(path).split('-', 2)
+            if len(parts) != 3 or parts[0] != disease or parts[1] in ('', current_version):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+
+        with self._lock:
+            self._disk_bytes = None
+            self._counters['invalidations'] += len(stale) + removed
+        if stale or removed:
+            logger.info(
+                f"Invalidated {len(stale) + removed} cached Grad-CAMs for {disease}")
+
+    def stats(self):
+        """Snapshot of the cache counters and tier sizes"""
+        with self._lock:
+            counters = dict(self._counters)
+            counters['memory_entries'] = len(self._memory)
+            counters['memory_bytes'] = self._memory_bytes
+            counters['disk_bytes'] = self._measure_disk()
+        lookups = counters['memory_hits'] + counters['disk_hits'] + counters['misses']
+        counters['hit_rate'] = (
+            (counters['memory_hits'] + counters['disk_hits']) / lookups if lookups else 0.0)
+        return counters
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_gradcam_cache():
+    """Return the process-wide Grad-CAM cache, or None when disabled"""
+    global _cache
+    if not getattr(settings, 'ML_GRADCAM_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GradCAMCache(
+                    os.path.join(str(settings.MEDIA_ROOT), 'gradcam_cache'),
+                    max_memory_bytes=getattr(
+                        settings, 'ML_GRADCAM_CACHE_MEMORY_BYTES', 32 * 1024 * 1024),
+                    max_disk_bytes=getattr(
+                        settings, 'ML_GRADCAM_CACHE_DISK_BYTES', 512 * 1024 * 1024),
+                )
+    return _cache
+
+
+def gradcam_cache_stats():
+    """Counters for the Grad-CAM cache, or None if it hasn't been used"""
+    return _cache.stats() if _cache is not None else None
@@ -0,0 +1,52 @@
+# ml_predict/hashing.py
+import hashlib
+from django.core.files.uploadhandler import FileUploadHandler
+
+CHUNK_SIZE = 64 * 1024
+
+
+def sha256_file(path):
+    """SHA-256 hex digest of a file on disk, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256_chunks(django_file):
+    """SHA-256 hex digest of a Django File/UploadedFile, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in django_file.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+    django_file.seek(0)
+    return digest.hexdigest()
+
+
+class ContentHashUploadHandler(FileUploadHandler):
+    """Hash uploaded files as they stream in, without buffering them
+
+    Must come first in request.upload_handlers; every chunk is passed on
+    unchanged to the next handler, which stores the file as usual. The
+    digests end up in request.upload_content_hashes keyed by field name.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self._digest = None
+        if request is not None:
+            request.upload_content_hashes = {}
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.request is not None:
+            self.request.upload_content_hashes[self.field_name] = self._digest.hexdigest()
+        # Let the next handler build the file object
+        return None
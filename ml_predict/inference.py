@@ -0,0 +1,103 @@
+# ml_predict/inference.py
+"""
+Lazily initialised, process-wide ChestXrayPredictor.
+
+Importing this module is cheap: TensorFlow, OpenCV and the Keras models
+are only loaded by the first get_local_predictor() call (the first
+inference request, the health check, the warmup_models command or the
+gunicorn post_worker_init hook).
+
+When ML_INFERENCE_SOCKET is set, get_predictor() returns a RemotePredictor
+that runs inference in the shared daemon (manage.py run_inference_server)
+and only loads the models in-process if the daemon can't be reached.
+"""
+import threading
+import time
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_predictor = None
+_predictor_lock = threading.Lock()
+_remote_predictor = None
+
+
+def get_predictor(wait=True):
+    """Return the predictor the views should use: the daemon client or the in-process one"""
+    remote = get_remote_predictor()
+    if remote is not None:
+        return remote
+    return get_local_predictor(wait=wait)
+
+
+def get_remote_predictor():
+    """The RemotePredictor for ML_INFERENCE_SOCKET, or None when no daemon is configured"""
+    global _remote_predictor
+    socket_path = getattr(settings, 'ML_INFERENCE_SOCKET', '')
+    if not socket_path:
+        return None
+    if _remote_predictor is None:
+        with _predictor_lock:
+            if _remote_predictor is None:
+                from .inference_server import InferenceClient, RemotePredictor
+                client = InferenceClient(
+                    socket_path,
+                    timeout=getattr(settings, 'ML_INFERENCE_TIMEOUT_SECONDS', 120),
+                    connect_timeout=getattr(settings, 'ML_INFERENCE_CONNECT_TIMEOUT', 1.0))
+                _remote_predictor = RemotePredictor(
+                    client, get_local_predictor,
+                    fallback=getattr(settings, 'ML_INFERENCE_FALLBACK', True),
+                    ring_timeout=getattr(settings, 'ML_SHM_ACQUIRE_TIMEOUT', 5.0))
+    return _remote_predictor
+
+
+def get_local_predictor(wait=True):
+    """Return the in-process predictor, loading TensorFlow and the models on first use
+
+    Models load concurrently in the background. With wait=True this blocks
+    until the predictor can serve (any model ready when ML_SERVE_PARTIAL is
+    on, otherwise all of them), up to ML_LOAD_TIMEOUT_SECONDS.
+    """
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                started = time.perf_counter()
+                from .utils import ChestXrayPredictor
+                _predictor = ChestXrayPredictor(wait=False)
+                logger.info(
+                    f"Predictor initialised in {time.perf_counter() - started:.2f}s, "
+                    f"loading models in the background")
+    if wait:
+        _predictor.wait_until_ready(
+            timeout=getattr(settings, 'ML_LOAD_TIMEOUT_SECONDS', 300),
+            partial=getattr(settings, 'ML_SERVE_PARTIAL', True))
+    return _predictor
+
+
+def predictor_loaded():
+    """Whether the predictor has been initialised in this process"""
+    return _predictor is not None
+
+
+def predictor_readiness():
+    """Load report for the health check, without waiting for the models"""
+    remote = get_remote_predictor()
+    if remote is not None and remote.available():
+        return dict(remote.status(refresh=True)['load_report'], daemon=True)
+    if _predictor is None:
+        return {'status': 'not_loaded', 'loading_complete': False, 'models': {}, 'daemon': False}
+    return dict(_predictor.load_report(), daemon=False)
+
+
+def warm_up():
+    """Start loading the models now instead of on the first request
+
+    Nothing to do in web workers whose inference daemon is up.
+    """
+    remote = get_remote_predictor()
+    if remote is not None and (remote.available() or not remote.fallback):
+        return remote
+    return get_local_predictor(wait=False)
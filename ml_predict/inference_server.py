@@ -0,0 +1,540 @@
+# ml_predict/inference_server.py
+"""
+Out-of-process inference over a Unix domain socket.
+
+One daemon (manage.py run_inference_server) holds TensorFlow and the
+models; gunicorn workers talk to it through RemotePredictor, which has the
+same interface the views use on ChestXrayPredictor.
+
+Every message is one frame:
+
+    header   !2sBBII  magic b'CX', protocol version, op (request) or
+                      status (response), metadata length, payload length
+    metadata UTF-8 JSON
+    payload  raw bytes (concatenated encoded Grad-CAMs and heatmaps in responses)
+
+Images are passed by path; the daemon and the web workers share the media
+directory, so only a few hundred bytes cross the socket per request. With
+ML_SHM_TRANSPORT the workers also preprocess the image themselves and hand
+the model inputs over in a shared-memory slot (see shm_transport).
+"""
+import os
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+import socketserver
+
+from django.conf import settings
+
+from .batching import SchedulerBusy
+from .rendering import GradCAMFile, format_for_name, pack_heatmaps, unpack_heatmaps
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CX'
+PROTOCOL_VERSION = 3
+HEADER = struct.Struct('!2sBBII')
+MAX_METADATA_BYTES = 1024 * 1024
+MAX_PAYLOAD_BYTES = 256 * 1024 * 1024
+
+OP_PING = 0
+OP_STATUS = 1
+OP_PREDICT = 2
+OP_GRADCAMS = 3
+OP_PREDICT_TENSORS = 4  # Model inputs already in a shared-memory slot
+OP_HEATMAPS = 5  # Raw Grad-CAM heatmaps, not rendered
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_BUSY = 2  # The daemon's batching queue is full; retry later
+
+
+class DaemonUnavailable(Exception):
+    """The inference daemon could not be reached"""
+
+
+class InferenceError(Exception):
+    """The inference daemon reported an error for a request"""
+
+
+class ProtocolError(Exception):
+    """A malformed frame was received"""
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionResetError("Connection closed mid-frame")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(sock, code, metadata=None, payload=b''):
+    """Write one frame; payload may be bytes or a list of byte strings"""
+    meta_bytes = json.dumps(metadata or {}, separators=(',', ':')).encode()
+    if not isinstance(payload, (bytes, bytearray)):
+        payload = b''.join(payload)
+    sock.sendall(
+        HEADER.pack(MAGIC, PROTOCOL_VERSION, code, len(meta_bytes), len(payload))
+        + meta_bytes + payload)
+
+
+def recv_frame(sock):
+    """Read one frame; returns (code, metadata, payload) or None on a clean EOF"""
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    header = first + _recv_exact(sock, HEADER.size - len(first))
+    magic, version, code, meta_length, payload_length = HEADER.unpack(header)
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unexpected frame header {header!r}")
+    if meta_length > MAX_METADATA_BYTES or payload_length > MAX_PAYLOAD_BYTES:
+        raise ProtocolError("Frame too large")
+    metadata = json.loads(_recv_exact(sock, meta_length)) if meta_length else {}
+    payload = _recv_exact(sock, payload_length) if payload_length else b''
+    return code, metadata, payload
+
+
+def _pack_gradcams(gradcam_files):
+    """Split {disease: ContentFile} into (metadata entries, payload chunks)
+
+    Each entry is [disease, image format, image length, heatmap blob
+    length]; the format is the one the daemon encoded in, and the heatmap
+    blob follows the image and is empty when the file has no heatmap.
+    """
+    entries = []
+    chunks = []
+    for disease, gradcam_file in (gradcam_files or {}).items():
+        if gradcam_file is None:
+            continue
+        data = gradcam_file.read()
+        gradcam_file.seek(0)
+        heatmap = getattr(gradcam_file, 'heatmap', None)
+        heatmap_data = pack_heatmaps({disease: heatmap}) if heatmap is not None else b''
+        entries.append([
+            disease, format_for_name(gradcam_file.name), len(data), len(heatmap_data)])
+        chunks.append(data)
+        chunks.append(heatmap_data)
+    return entries, chunks
+
+
+def _unpack_gradcams(entries, payload):
+    gradcam_files = {}
+    offset = 0
+    for disease, image_format, length, heatmap_length in entries:
+        data = payload[offset:offset + length]
+        offset += length
+        heatmap = unpack_heatmaps(payload[offset:offset + heatmap_length]).get(disease)
+        offset += heatmap_length
+        gradcam_files[disease] = GradCAMFile(
+            data, name=f'gradcam_{disease}.{image_format}', heatmap=heatmap)
+    return gradcam_files
+
+
+class _InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """Serve frames on one client connection until it closes"""
+
+    def handle(self):
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except (OSError, ProtocolError) as e:
+                logger.warning(f"Dropping inference client: {str(e)}")
+                return
+            if frame is None:
+                return
+
+            op, metadata, _ = frame
+            started = time.perf_counter()
+            try:
+                response, payload = self.server.dispatch(op, metadata)
+                send_frame(self.request, STATUS_OK, response, payload)
+            except OSError:
+                return
+            except SchedulerBusy as e:
+                logger.warning(f"Inference request (op {op}) rejected: {str(e)}")
+                try:
+                    send_frame(self.request, STATUS_BUSY, {'error': str(e)})
+                except OSError:
+                    return
+            except Exception as e:
+                logger.error(f"Inference request (op {op}) failed: {str(e)}")
+                try:
+                    send_frame(self.request, STATUS_ERROR, {'error': str(e)})
+                except OSError:
+                    return
+            logger.debug(
+                f"Inference op {op} served in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server running requests against one in-process predictor"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, predictor, ring=None):
+        self.socket_path = socket_path
+        self.predictor = predictor
+        self.ring = ring  # SharedTensorRing owned by this server, if any
+        self._remove_stale_socket()
+        super().__init__(socket_path, _InferenceRequestHandler)
+        # Web workers usually run as the same user/group as the daemon
+        os.chmod(socket_path, 0o660)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(
+            f"An inference server is already listening on {self.socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        if self.ring is not None:
+            self.ring.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def dispatch(self, op, metadata):
+        """Run one request; returns (response metadata, payload chunks)"""
+        predictor = self.predictor
+        if op == OP_PING:
+            return {}, b''
+
+        if op == OP_STATUS:
+            from .batching import scheduler_stats
+            from .gradcam_cache import gradcam_cache_stats
+            return {
+                'models': list(predictor.models),
+                'available_diseases': predictor.available_diseases,
+                'model_set_version': predictor.model_set_version,
+                'load_report': predictor.load_report(),
+                'batching': scheduler_stats(),
+                'gradcam_cache': gradcam_cache_stats(),
+                'input_shapes': [list(shape) for shape in predictor.shape_groups],
+                'shm': self.ring.describe() if self.ring is not None else None,
+                'pid': os.getpid(),
+            }, b''
+
+        if op == OP_PREDICT:
+            return self._predict(
+                metadata['image_path'], metadata.get('secondary_threshold'),
+                explain=metadata.get('explain', True))
+
+        if op == OP_PREDICT_TENSORS:
+            if self.ring is None or metadata.get('token') != self.ring.token:
+                # Written to a segment from before a daemon restart
+                response, chunks = self._predict(
+                    metadata['image_path'], metadata.get('secondary_threshold'),
+                    explain=metadata.get('explain', True))
+                response['ring_stale'] = True
+                return response, chunks
+            # Read the tensors in place; the worker keeps the slot claimed
+            # until this reply arrives
+            views = self.ring.views(metadata['slot'], metadata['layout'])
+            inputs = {tuple(view.shape[1:]): view for view in views}
+            return self._predict(
+                metadata['image_path'], metadata.get('secondary_threshold'), inputs,
+                explain=metadata.get('explain', True))
+
+        if op == OP_GRADCAMS:
+            gradcam_files = predictor.generate_gradcams(
+                metadata['image_path'], metadata['diseases'],
+                refresh_cache=metadata.get('refresh_cache', False),
+                fast_encoding=metadata.get('fast_encoding', False))
+            entries, chunks = _pack_gradcams(gradcam_files)
+            return {'gradcams': entries}, chunks
+
+        if op == OP_HEATMAPS:
+            heatmaps = predictor.generate_heatmaps(metadata['image_path'], metadata['diseases'])
+            return {'diseases': list(heatmaps)}, [pack_heatmaps(heatmaps)]
+
+        raise InferenceError(f"Unknown op {op}")
+
+    def _predict(self, image_path, secondary_threshold, inputs=None, explain=True):
+        """Score an image, with its Grad-CAMs unless explain is off"""
+        predictor = self.predictor
+        if getattr(settings, 'ML_BATCHING_ENABLED', False):
+            # Coalesce with requests from other workers, then build the
+            # Grad-CAMs in one go
+            from .batching import get_scheduler
+            result = get_scheduler().predict(
+                image_path,
+                timeout=getattr(settings, 'ML_BATCH_TIMEOUT_SECONDS', 60),
+                inputs=inputs)
+            gradcam_files = {}
+            if explain:
+                predicted_disease = result['predicted_disease']
+                diseases = [predicted_disease]
+                if secondary_threshold is not None:
+                    diseases += [
+                        disease for disease, confidence in result['all_predictions'].items()
+                        if disease != predicted_disease and confidence > secondary_threshold
+                    ]
+                gradcam_files = predictor.generate_gradcams(image_path, diseases)
+        elif not explain:
+            result, gradcam_files = predictor.predict(image_path, inputs=inputs), {}
+        else:
+            result, gradcam_files = predictor.predict_and_explain(
+                image_path, secondary_threshold=secondary_threshold, inputs=inputs)
+        entries, chunks = _pack_gradcams(gradcam_files)
+        return {'result': result, 'gradcams': entries}, chunks
+
+
+class InferenceClient:
+    """Client for the inference daemon with one reusable connection per thread"""
+
+    def __init__(self, socket_path, timeout=120.0, connect_timeout=1.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise DaemonUnavailable(
+                f"Cannot connect to inference daemon at {self.socket_path}: {str(e)}")
+        sock.settimeout(self.timeout)
+        return sock
+
+    def close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            self._local.sock = None
+            sock.close()
+
+    def call(self, op, metadata=None, timeout=None):
+        """Send one request and return (metadata, payload)"""
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            reused = sock is not None
+            if sock is None:
+                sock = self._local.sock = self._connect()
+            sock.settimeout(timeout or self.timeout)
+            try:
+                send_frame(sock, op, metadata)
+                frame = recv_frame(sock)
+                if frame is None:
+                    raise ConnectionResetError("Inference daemon closed the connection")
+            except socket.timeout:
+                # The daemon may still answer later; don't read that reply
+                # as the response to the next request
+                self.close()
+                raise TimeoutError("Inference daemon did not answer in time")
+            except (OSError, ProtocolError) as e:
+                self.close()
+                # A reused connection may have been closed by a daemon
+                # restart; retry once on a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise DaemonUnavailable(f"Inference daemon connection failed: {str(e)}")
+
+            status_code, response, payload = frame
+            if status_code == STATUS_BUSY:
+                raise SchedulerBusy(response.get('error', 'Inference daemon is busy'))
+            if status_code != STATUS_OK:
+                raise InferenceError(response.get('error', 'Inference daemon error'))
+            return response, payload
+
+    def ping(self):
+        self.call(OP_PING, timeout=self.connect_timeout)
+
+
+class RemotePredictor:
+    """ChestXrayPredictor facade that runs inference in the daemon
+
+    Falls back to the in-process predictor (loading it on first need) when
+    the daemon is unreachable, unless ML_INFERENCE_FALLBACK is off.
+    """
+
+    remote = True
+    STATUS_TTL_SECONDS = 2.0
+    FALLBACK_LOG_INTERVAL_SECONDS = 60.0
+
+    def __init__(self, client, local_predictor_factory, fallback=True, ring_timeout=5.0):
+        self.client = client
+        self.ring_timeout = ring_timeout
+        self._ring = None
+        self._local_predictor_factory = local_predictor_factory
+        self.fallback = fallback
+        self._status = None
+        self._status_at = 0.0
+        self._fallback_logged_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def _local(self, error):
+        if not self.fallback:
+            raise error
+        now = time.monotonic()
+        if now - self._fallback_logged_at > self.FALLBACK_LOG_INTERVAL_SECONDS:
+            self._fallback_logged_at = now
+            logger.warning(f"{str(error)}; falling back to in-process inference")
+        return self._local_predictor_factory()
+
+    def available(self):
+        """Whether the daemon answers right now"""
+        try:
+            self.client.ping()
+            return True
+        except (DaemonUnavailable, TimeoutError):
+            return False
+
+    def status(self, refresh=False):
+        """Daemon status, cached briefly since the views read it several times"""
+        with self._lock:
+            if (not refresh and self._status is not None
+                    and time.monotonic() - self._status_at < self.STATUS_TTL_SECONDS):
+                return self._status
+        status, _ = self.client.call(OP_STATUS)
+        with self._lock:
+            self._status = status
+            self._status_at = time.monotonic()
+        return status
+
+    @property
+    def models(self):
+        try:
+            return dict.fromkeys(self.status()['models'])
+        except DaemonUnavailable as e:
+            return self._local(e).models
+
+    @property
+    def available_diseases(self):
+        try:
+            return self.status()['available_diseases']
+        except DaemonUnavailable as e:
+            return self._local(e).available_diseases
+
+    @property
+    def model_set_version(self):
+        try:
+            return self.status()['model_set_version']
+        except DaemonUnavailable as e:
+            return self._local(e).model_set_version
+
+    def load_report(self):
+        try:
+            return self.status()['load_report']
+        except DaemonUnavailable as e:
+            return self._local(e).load_report()
+
+    def _get_ring(self, status):
+        """This process's attachment to the daemon's shared-memory ring, if it has one"""
+        description = status.get('shm')
+        if description is None:
+            return None
+        with self._lock:
+            if self._ring is not None and self._ring.token != description['token']:
+                # The daemon restarted with a new segment
+                self._ring.close()
+                self._ring = None
+            if self._ring is None:
+                from .shm_transport import SharedTensorRing
+                try:
+                    self._ring = SharedTensorRing.attach(description)
+                except OSError as e:
+                    logger.warning(f"Cannot attach to the inference ring: {str(e)}")
+                    return None
+            return self._ring
+
+    def _call_predict(self, image_path, secondary_threshold, explain=True):
+        request = {
+            'image_path': str(image_path),
+            'secondary_threshold': secondary_threshold,
+            'explain': explain,
+        }
+        status = self.status()
+        ring = self._get_ring(status)
+        input_shapes = [tuple(shape) for shape in status.get('input_shapes', [])]
+        layout = ring.layout([(1,) + shape for shape in input_shapes]) if ring else None
+        if layout is None:
+            return self.client.call(OP_PREDICT, request)
+
+        from .shm_transport import RingFull
+        from .preprocessing import load_image, resize_for_shape
+
+        # Decode here and resize straight into the slot, so the daemon
+        # only runs the models
+        image = load_image(image_path)
+        try:
+            slot = ring.acquire(timeout=self.ring_timeout)
+        except RingFull as e:
+            raise SchedulerBusy(str(e))
+        try:
+            for input_shape, view in zip(input_shapes, ring.views(slot, layout)):
+                resize_for_shape(image, input_shape, out=view)
+            response, payload = self.client.call(OP_PREDICT_TENSORS, dict(
+                request, slot=slot, layout=layout, token=ring.token))
+        finally:
+            ring.release(slot)
+        if response.get('ring_stale'):
+            self.status(refresh=True)
+        return response, payload
+
+    def ring_stats(self):
+        """Slot counters for this process, or None if it doesn't use the ring"""
+        ring = self._ring
+        return ring.stats() if ring is not None else None
+
+    def predict(self, image_path):
+        try:
+            response, _ = self._call_predict(image_path, None, explain=False)
+        except DaemonUnavailable as e:
+            return self._local(e).predict(image_path)
+        return response['result']
+
+    def predict_and_explain(self, image_path, secondary_threshold=None):
+        try:
+            response, payload = self._call_predict(image_path, secondary_threshold)
+        except DaemonUnavailable as e:
+            return self._local(e).predict_and_explain(
+                image_path, secondary_threshold=secondary_threshold)
+        return response['result'], _unpack_gradcams(response['gradcams'], payload)
+
+    def generate_gradcams(self, image_path, diseases, refresh_cache=False, fast_encoding=False):
+        try:
+            response, payload = self.client.call(OP_GRADCAMS, {
+                'image_path': str(image_path),
+                'diseases': list(diseases),
+                'refresh_cache': refresh_cache,
+                'fast_encoding': fast_encoding,
+            })
+        except DaemonUnavailable as e:
+            return self._local(e).generate_gradcams(
+                image_path, diseases, refresh_cache=refresh_cache, fast_encoding=fast_encoding)
+        return _unpack_gradcams(response['gradcams'], payload)
+
+    def generate_heatmaps(self, image_path, diseases):
+        try:
+            _, payload = self.client.call(OP_HEATMAPS, {
+                'image_path': str(image_path),
+                'diseases': list(diseases),
+            })
+        except DaemonUnavailable as e:
+            return self._local(e).generate_heatmaps(image_path, diseases)
+        return unpack_heatmaps(payload)
+
+    def generate_gradcam_for_prediction(self, image_path, disease, confidence_threshold=0.1,
+                                        refresh_cache=False):
+        return self.generate_gradcams(
+            image_path, [disease], refresh_cache=refresh_cache).get(disease)
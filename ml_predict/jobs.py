@@ -0,0 +1,175 @@
+# ml_predict/jobs.py
+"""
+Database-backed queue of prediction jobs.
+
+In async mode (ML_ASYNC_PREDICTIONS) the predict view stores the upload
+and a PredictionJob and returns 202 straight away; worker threads started
+by manage.py run_prediction_workers claim queued jobs with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers on any number
+of hosts drain the same table without taking the same job twice. With
+ML_PREDICTION_JOBS_EAGER the job runs inside the request instead (for
+tests and single-process development).
+"""
+import os
+import socket
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import PredictionJob
+from .batching import SchedulerBusy
+from .pipeline import find_memoised_prediction, reuse_prediction, run_prediction
+from .single_flight import SingleFlightTimeout, claim, flight_key
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def enqueue_prediction(prediction_result, user=None):
+    """Queue a saved prediction for scoring; returns its PredictionJob"""
+    job = PredictionJob.objects.create(prediction=prediction_result, created_by=user)
+    logger.info(f"Queued prediction job {job.id} for prediction {prediction_result.id}")
+    if getattr(settings, 'ML_PREDICTION_JOBS_EAGER', False):
+        from .inference import get_predictor
+        job = claim_next_job(job_id=job.id)
+        if job is not None:
+            run_job(job, get_predictor())
+    return job
+
+
+def claim_next_job(job_id=None):
+    """Mark the oldest queued job (or the given one) running and return it, or None"""
+    with transaction.atomic():
+        jobs = PredictionJob.objects.select_for_update(skip_locked=True).filter(status='queued')
+        if job_id is not None:
+            jobs = jobs.filter(id=job_id)
+        job = jobs.order_by('created_at').first()
+        if job is None:
+            return None
+        job.status = 'running'
+        job.stage = 'claimed'
+        job.attempts += 1
+        job.worker = worker_name()
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'stage', 'attempts', 'worker', 'started_at'])
+    return job
+
+
+def _update_progress(job, stage, percent):
+    job.stage = stage
+    job.progress = percent
+    PredictionJob.objects.filter(id=job.id).update(stage=stage, progress=percent)
+
+
+def _requeue(job, reason):
+    logger.warning(f"Requeueing prediction job {job.id}: {reason}")
+    PredictionJob.objects.filter(id=job.id).update(
+        status='queued', stage='', progress=0, error=reason, worker='', started_at=None)
+
+
+def run_job(job, predictor):
+    """Score a claimed job's prediction; the job ends up succeeded, failed or requeued"""
+    prediction_result = job.prediction
+    if prediction_result is None:
+        PredictionJob.objects.filter(id=job.id).update(
+            status='failed', error='Prediction was deleted', finished_at=timezone.now())
+        return
+
+    def progress(stage, percent):
+        _update_progress(job, stage, percent)
+
+    try:
+        if getattr(settings, 'ML_PREDICTION_MEMOIZATION', True) and predictor.available_diseases:
+            model_version = predictor.model_set_version
+            prediction_result.model_version = model_version
+            # Identical X-rays queued together are scored once, like
+            # concurrent synchronous uploads
+            with claim(flight_key('predict', prediction_result.content_hash, model_version)):
+                prior = find_memoised_prediction(prediction_result.content_hash, model_version)
+                if prior is not None and prior.id != prediction_result.id:
+                    reuse_prediction(prediction_result, prior)
+                else:
+                    run_prediction(prediction_result, predictor, progress)
+        else:
+            run_prediction(prediction_result, predictor, progress)
+
+    except (SchedulerBusy, SingleFlightTimeout) as e:
+        if job.attempts < getattr(settings, 'ML_PREDICTION_JOB_MAX_ATTEMPTS', 3):
+            _requeue(job, str(e))
+            return
+        _fail(job, e)
+        return
+    except Exception as e:
+        _fail(job, e)
+        return
+
+    PredictionJob.objects.filter(id=job.id).update(
+        status='succeeded', stage='done', progress=100, error='',
+        finished_at=timezone.now())
+    logger.info(f"Prediction job {job.id} succeeded")
+
+
+def _fail(job, error):
+    logger.error(f"Prediction job {job.id} failed: {str(error)}")
+    prediction_result = job.prediction
+    PredictionJob.objects.filter(id=job.id).update(
+        status='failed', error=str(error), finished_at=timezone.now())
+    # Like a failed synchronous request, don't leave a half-filled prediction
+    try:
+        prediction_result.delete()
+    except Exception as delete_error:
+        logger.error(f"Error deleting failed prediction: {delete_error}")
+
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker died mid-run (running for longer than
+    ML_PREDICTION_JOB_TIMEOUT_SECONDS); returns how many
+
+    Jobs that have already used ML_PREDICTION_JOB_MAX_ATTEMPTS fail
+    instead, so an input that keeps crashing workers isn't retried forever.
+    """
+    timeout = getattr(settings, 'ML_PREDICTION_JOB_TIMEOUT_SECONDS', 600)
+    max_attempts = getattr(settings, 'ML_PREDICTION_JOB_MAX_ATTEMPTS', 3)
+    stale_before = timezone.now() - timedelta(seconds=timeout)
+    requeued = 0
+    with transaction.atomic():
+        stale = list(PredictionJob.objects.select_for_update(skip_locked=True).filter(
+            status='running', started_at__lt=stale_before))
+        for job in stale:
+            reason = f"Worker {job.worker} did not finish within {timeout}s"
+            if job.attempts >= max_attempts:
+                _fail(job, f"{reason} on {job.attempts} attempts")
+            else:
+                _requeue(job, reason)
+                requeued += 1
+    return requeued
+
+
+def work(predictor, stop, poll_interval=1.0):
+    """Claim and run jobs until stop (a threading.Event) is set"""
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            job = claim_next_job()
+        except Exception as e:
+            logger.error(f"Could not claim a prediction job: {str(e)}")
+            job = None
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        run_job(job, predictor)
+
+
+def job_stats():
+    """Number of jobs in each status"""
+    counts = dict(
+        PredictionJob.objects.values_list('status').annotate(count=Count('id')))
+    return {status: counts.get(status, 0) for status, _ in PredictionJob.STATUS_CHOICES}
@@ -0,0 +1,107 @@
+# ml_predict/latency_budget.py
+"""
+Latency budgets for the predict pipeline.
+
+A request gets ML_PREDICTION_BUDGET_MS from the moment the view starts.
+Scoring the image always runs; the stages that can be dropped (the
+primary Grad-CAM, the secondary Grad-CAMs and tight PNG compression) only
+run when the time left covers their estimated duration, an exponentially
+weighted average of how long they have taken in this process, plus
+ML_PREDICTION_BUDGET_RESERVE_MS for saving and serializing the result.
+Otherwise they're deferred or skipped, and the response says which.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# Weight of the latest duration in a stage's moving average
+EWMA_ALPHA = 0.2
+
+_timings = {}  # stage -> counters
+_timings_lock = threading.Lock()
+
+
+def _timing(stage):
+    """A stage's counters; called with the lock held"""
+    return _timings.setdefault(stage, {
+        'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'ewma_ms': None, 'dropped': 0})
+
+
+def _record(stage, elapsed_ms):
+    with _timings_lock:
+        timing = _timing(stage)
+        timing['count'] += 1
+        timing['total_ms'] += elapsed_ms
+        timing['max_ms'] = max(timing['max_ms'], elapsed_ms)
+        timing['ewma_ms'] = elapsed_ms if timing['ewma_ms'] is None else (
+            EWMA_ALPHA * elapsed_ms + (1 - EWMA_ALPHA) * timing['ewma_ms'])
+
+
+def estimate_ms(stage):
+    """Expected duration of a stage, or 0 before it has been measured"""
+    with _timings_lock:
+        timing = _timings.get(stage)
+        return timing['ewma_ms'] if timing and timing['ewma_ms'] is not None else 0.0
+
+
+class LatencyBudget:
+    """Time left for one request, and what was timed, deferred or skipped"""
+
+    def __init__(self, budget_ms=0, reserve_ms=0):
+        # budget_ms of 0 means unlimited: stages are still timed
+        self.budget_ms = budget_ms
+        self.reserve_ms = reserve_ms
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.dropped = []
+
+    @property
+    def limited(self):
+        return bool(self.budget_ms)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def remaining_ms(self):
+        if not self.limited:
+            return float('inf')
+        return self.budget_ms - self.elapsed_ms()
+
+    def allows(self, *stages):
+        """Whether the stages' estimated durations fit in the time left"""
+        return self.remaining_ms() >= sum(estimate_ms(stage) for stage in stages) + self.reserve_ms
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of this request"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed_ms
+            _record(name, elapsed_ms)
+
+    def drop(self, stage, action):
+        """Note that a stage was 'deferred', 'skipped' or run 'degraded'"""
+        self.dropped.append({'stage': stage, 'action': action})
+        with _timings_lock:
+            _timing(stage)['dropped'] += 1
+
+    def report(self):
+        return {
+            'budget_ms': self.budget_ms or None,
+            'elapsed_ms': round(self.elapsed_ms(), 1),
+            'stages_ms': {stage: round(ms, 1) for stage, ms in self.timings.items()},
+            'skipped_stages': self.dropped,
+        }
+
+
+def stage_timing_stats():
+    """Per-stage duration counters for tuning the budget"""
+    with _timings_lock:
+        return {
+            stage: dict(
+                timing, mean_ms=timing['total_ms'] / timing['count'] if timing['count'] else 0.0)
+            for stage, timing in _timings.items()
+        }
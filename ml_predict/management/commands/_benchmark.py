@@ -0,0 +1,44 @@
+# ml_predict/management/commands/_benchmark.py
+import os
+import time
+import numpy as np
+from django.conf import settings
+
+
+def default_benchmark_images(limit=5):
+    """Pick a few uploaded X-rays to benchmark against"""
+    upload_dir = os.path.join(str(settings.MEDIA_ROOT), 'xray_uploads')
+    if not os.path.isdir(upload_dir):
+        return []
+    names = sorted(os.listdir(upload_dir))[:limit]
+    return [os.path.join(upload_dir, name) for name in names]
+
+
+def time_calls(func, iterations, warmup=3):
+    """Call func repeatedly and return per-call latencies in milliseconds"""
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarise_latencies(samples):
+    """Summarise latency samples (ms) as mean and percentiles"""
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'p99': float(np.percentile(samples, 99)),
+    }
+
+
+def format_latencies(label, summary):
+    return (f"{label:<24} mean {summary['mean']:8.2f} ms  "
+            f"p50 {summary['p50']:8.2f} ms  p95 {summary['p95']:8.2f} ms  "
+            f"p99 {summary['p99']:8.2f} ms")
@@ -0,0 +1,63 @@
+# ml_predict/management/commands/backfill_content_hashes.py
+from django.core.management.base import BaseCommand
+
+from ml_predict.hashing import sha256_chunks
+from ml_predict.models import PredictionResult
+
+
+class Command(BaseCommand):
+    help = 'Compute content hashes for existing predictions so identical uploads can reuse them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument(
+            '--model-version',
+            help='Model set version to record on rows that have none')
+        parser.add_argument(
+            '--assume-current-models', action='store_true',
+            help='Record the currently deployed model set version on rows that have none '
+                 '(only if those rows were scored by the current model files)')
+
+    def handle(self, *args, **options):
+        model_version = options['model_version']
+        if options['assume_current_models']:
+            from ml_predict.inference import get_predictor
+            predictor = get_predictor()
+            model_version = predictor.model_set_version
+            self.stdout.write(f"Current model set version: {model_version}")
+
+        queryset = PredictionResult.objects.filter(
+            content_hash__isnull=True).exclude(xray_image='').order_by('id')
+        total = queryset.count()
+        self.stdout.write(f"Hashing {total} predictions")
+
+        hashed = 0
+        missing = 0
+        last_id = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            updated = []
+            for prediction in batch:
+                try:
+                    with prediction.xray_image.open('rb') as f:
+                        prediction.content_hash = sha256_chunks(f)
+                except (OSError, ValueError) as e:
+                    self.stderr.write(
+                        f"Prediction {prediction.id}: could not read X-ray ({e})")
+                    missing += 1
+                    continue
+                if model_version and not prediction.model_version:
+                    prediction.model_version = model_version
+                updated.append(prediction)
+
+            PredictionResult.objects.bulk_update(
+                updated, ['content_hash', 'model_version'])
+            hashed += len(updated)
+            self.stdout.write(f"  {hashed}/{total}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Hashed {hashed} predictions ({missing} with missing files)"))
@@ -0,0 +1,71 @@
+# ml_predict/management/commands/benchmark_encoding.py
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ml_predict import rendering
+from ml_predict.preprocessing import load_image
+from ._benchmark import time_calls, summarise_latencies, format_latencies
+from .benchmark_rendering import _synthetic_xray
+
+# (label, format, settings, fast) compared by default
+ENCODERS = [
+    ('PNG level 1', 'png', {'ML_GRADCAM_FAST_PNG_COMPRESS_LEVEL': 1}, True),
+    ('PNG level 6', 'png', {'ML_GRADCAM_PNG_COMPRESS_LEVEL': 6}, False),
+    ('PNG level 9', 'png', {'ML_GRADCAM_PNG_COMPRESS_LEVEL': 9}, False),
+    ('WebP q80 method 0', 'webp', {'ML_GRADCAM_WEBP_QUALITY': 80}, True),
+    ('WebP q80 method 4', 'webp', {'ML_GRADCAM_WEBP_QUALITY': 80, 'ML_GRADCAM_WEBP_METHOD': 4}, False),
+    ('JPEG q85', 'jpeg', {'ML_GRADCAM_JPEG_QUALITY': 85}, False),
+    ('JPEG q95', 'jpeg', {'ML_GRADCAM_JPEG_QUALITY': 95}, False),
+]
+
+
+class Command(BaseCommand):
+    help = ('Compare encoding time and size of Grad-CAM overlays as PNG, WebP '
+            'and JPEG, to pick ML_GRADCAM_FORMAT and its quality settings')
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='X-ray images to overlay (defaults to a synthetic one)')
+        parser.add_argument('--size', type=int, default=2048,
+                            help='Side of the synthetic X-ray in pixels')
+        parser.add_argument('--heatmap-size', type=int, default=7,
+                            help='Side of the heatmap (the last conv layer)')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+
+    def handle(self, *args, **options):
+        if options['images']:
+            images = [load_image(path) for path in options['images']]
+        else:
+            images = [_synthetic_xray(options['size'])]
+        if options['heatmap_size'] < 1:
+            raise CommandError('--heatmap-size must be positive')
+        heatmap = np.random.default_rng(1).random(
+            (options['heatmap_size'], options['heatmap_size'])).astype(np.float32)
+
+        # Encode what the pipeline encodes: capped overlays
+        overlays = [rendering.render_overlay(rendering.prepare_base(image), heatmap)
+                    for image in images]
+        per_image = max(1, options['iterations'] // len(overlays))
+
+        results, mean_sizes = {}, {}
+        for label, image_format, encoder_settings, fast in ENCODERS:
+            with override_settings(**encoder_settings):
+                samples, sizes = [], []
+                for overlay in overlays:
+                    samples.extend(time_calls(
+                        lambda: rendering.encode_image(overlay, image_format, fast=fast),
+                        per_image, warmup=options['warmup']))
+                    sizes.append(len(rendering.encode_image(overlay, image_format, fast=fast)))
+            results[label] = summarise_latencies(samples)
+            mean_sizes[label] = sum(sizes) / len(sizes)
+            self.stdout.write(f"{format_latencies(label, results[label])}  "
+                              f"size={mean_sizes[label] / 1024:.1f}KB")
+
+        sizes = ', '.join(f'{overlay.shape[1]}x{overlay.shape[0]}' for overlay in overlays)
+        speedup = results['PNG level 6']['mean'] / results['WebP q80 method 4']['mean']
+        ratio = mean_sizes['WebP q80 method 4'] / mean_sizes['PNG level 6']
+        self.stdout.write(self.style.SUCCESS(
+            f"WebP encodes {speedup:.2f}x faster than PNG level 6 at {ratio:.0%} "
+            f"of the size ({sizes})"))
@@ -0,0 +1,49 @@
+# ml_predict/management/commands/benchmark_inference.py
+from django.core.management.base import BaseCommand, CommandError
+
+from ._benchmark import (
+    default_benchmark_images, time_calls, summarise_latencies, format_latencies)
+
+
+class Command(BaseCommand):
+    help = 'Compare per-request latency of the per-model loop and the fused inference graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='X-ray images to run (defaults to a few uploads)')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+
+    def handle(self, *args, **options):
+        from ml_predict.inference import get_local_predictor
+        predictor = get_local_predictor()
+
+        if not predictor.models:
+            raise CommandError('No ML models are loaded')
+
+        images = options['images'] or default_benchmark_images()
+        if not images:
+            raise CommandError('No images to benchmark with')
+
+        if predictor.fused_fn is None and predictor.build_fused_model() is None:
+            raise CommandError('Could not build the fused inference graph')
+
+        # Preprocess up front so both modes are timed on inference alone
+        inputs = [predictor.preprocess_for_models(predictor.load_image(path))
+                  for path in images]
+        per_image = max(1, options['iterations'] // len(inputs))
+
+        results = {}
+        for label, use_fused in (('per-model loop', False), ('fused graph', True)):
+            samples = []
+            for image_inputs in inputs:
+                samples.extend(time_calls(
+                    lambda: predictor.run_models(image_inputs, use_fused=use_fused),
+                    per_image, warmup=options['warmup']))
+            results[label] = summarise_latencies(samples)
+            self.stdout.write(format_latencies(label, results[label]))
+
+        speedup = results['per-model loop']['mean'] / results['fused graph']['mean']
+        self.stdout.write(self.style.SUCCESS(
+            f"Fused graph is {speedup:.2f}x faster per request "
+            f"({len(predictor.models)} models, {len(images)} images)"))
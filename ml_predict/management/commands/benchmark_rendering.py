@@ -0,0 +1,90 @@
+# ml_predict/management/commands/benchmark_rendering.py
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_predict import rendering
+from ml_predict.preprocessing import load_image
+from ._benchmark import time_calls, summarise_latencies, format_latencies
+
+
+def _synthetic_xray(size):
+    """A size x size grayscale-looking RGB image with some texture"""
+    rng = np.random.default_rng(0)
+    ramp = np.linspace(40, 200, size, dtype=np.float32)
+    pixels = ramp[None, :] * 0.5 + ramp[:, None] * 0.5 + rng.normal(0, 12, (size, size))
+    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    return Image.fromarray(np.repeat(pixels[:, :, None], 3, axis=2))
+
+
+def _matplotlib_overlay(image, heatmap, cm):
+    """The overlay as it was rendered before rendering.py"""
+    import cv2
+    original_img = np.asarray(image, dtype=np.uint8)
+    img_height, img_width = original_img.shape[:2]
+    heatmap_resized = cv2.resize(heatmap, (img_width, img_height))
+    heatmap_colored = (cm.jet(heatmap_resized)[:, :, :3] * 255).astype(np.uint8)
+    return cv2.addWeighted(original_img, 0.6, heatmap_colored, 0.4, 0)
+
+
+class Command(BaseCommand):
+    help = ('Compare Grad-CAM overlay rendering through matplotlib against the '
+            'LUT renderer, at full and capped resolution')
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='X-ray images to overlay (defaults to a synthetic one)')
+        parser.add_argument('--size', type=int, default=2048,
+                            help='Side of the synthetic X-ray in pixels')
+        parser.add_argument('--heatmap-size', type=int, default=7,
+                            help='Side of the heatmap (the last conv layer)')
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if options['images']:
+            images = [load_image(path) for path in options['images']]
+        else:
+            images = [_synthetic_xray(options['size'])]
+        if options['heatmap_size'] < 1:
+            raise CommandError('--heatmap-size must be positive')
+        heatmap = np.random.default_rng(1).random(
+            (options['heatmap_size'], options['heatmap_size'])).astype(np.float32)
+
+        modes = []
+        try:
+            import matplotlib.cm as cm
+            modes.append(('matplotlib (before)', lambda image: _matplotlib_overlay(image, heatmap, cm)))
+        except ImportError:
+            self.stdout.write('matplotlib is not installed; skipping the previous renderer')
+        modes.append(('LUT, full size', lambda image: rendering.render_overlay(
+            rendering.prepare_base(image, max_size=0), heatmap)))
+        modes.append((f'LUT, capped {rendering.max_resolution()}px', lambda image: rendering.render_overlay(
+            rendering.prepare_base(image), heatmap)))
+
+        per_image = max(1, options['iterations'] // len(images))
+        results = {}
+        for label, render in modes:
+            samples = []
+            for image in images:
+                samples.extend(time_calls(lambda: render(image), per_image, warmup=options['warmup']))
+            results[label] = summarise_latencies(samples)
+            self.stdout.write(format_latencies(label, results[label]))
+
+        # Each extra disease of a request only pays for the render itself
+        samples = []
+        for image in images:
+            base = rendering.prepare_base(image)
+            out = np.empty_like(base)
+            samples.extend(time_calls(
+                lambda: rendering.render_overlay(base, heatmap, out=out),
+                per_image, warmup=options['warmup']))
+        self.stdout.write(format_latencies('LUT, per extra disease', summarise_latencies(samples)))
+
+        sizes = ', '.join(f'{image.width}x{image.height}' for image in images)
+        if 'matplotlib (before)' in results:
+            speedup = results['matplotlib (before)']['mean'] / results['LUT, full size']['mean']
+            self.stdout.write(self.style.SUCCESS(
+                f"LUT renderer is {speedup:.2f}x faster at full size ({sizes})"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Rendered {sizes}"))
@@ -0,0 +1,110 @@
+# ml_predict/management/commands/benchmark_transport.py
+import os
+import tempfile
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_predict.preprocessing import load_image, preprocess_for_shapes
+from ml_predict.shm_transport import SharedTensorRing, slot_size
+from ._benchmark import (
+    default_benchmark_images, time_calls, summarise_latencies, format_latencies)
+
+
+def _reader(conn, ring_description):
+    """Stand-in for the inference daemon: receive a request, read every tensor, reply"""
+    # Spawned from the ring's creator, so it shares its resource tracker
+    ring = SharedTensorRing.attach(ring_description, untrack=False)
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            mode, body = message
+            if mode == 'pickle':
+                tensors = body
+            else:
+                slot, layout = body
+                tensors = ring.views(slot, layout)
+            # Touch every element, as a model's first layer would
+            conn.send(sum(float(tensor.sum()) for tensor in tensors))
+            del tensors
+    finally:
+        ring.close()
+
+
+class Command(BaseCommand):
+    help = ('Compare handing preprocessed X-ray tensors to another process by pickling '
+            'them against the shared-memory slot ring')
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='X-ray images to use (defaults to a few uploads)')
+        parser.add_argument('--shape', action='append', default=None,
+                            help='Model input shape as HxWxC; repeat for several '
+                                 '(default 224x224x3)')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--slots', type=int, default=4)
+
+    def handle(self, *args, **options):
+        images = options['images'] or default_benchmark_images()
+        if not images:
+            raise CommandError('No images to benchmark with')
+        try:
+            shapes = [tuple(int(size) for size in shape.split('x'))
+                      for shape in (options['shape'] or ['224x224x3'])]
+        except ValueError:
+            raise CommandError('Shapes look like 224x224x3')
+
+        # Preprocess up front so only the handoff is timed
+        inputs = [list(preprocess_for_shapes(load_image(path), shapes).values())
+                  for path in images]
+        tensor_bytes = sum(tensor.nbytes for tensor in inputs[0])
+
+        lock_prefix = os.path.join(tempfile.gettempdir(), f"chestcare-bench-{os.getpid()}")
+        ring = SharedTensorRing(
+            f"chestcare-bench-{os.getpid()}", slots=options['slots'],
+            slot_bytes=slot_size([(1,) + shape for shape in shapes]),
+            lock_prefix=lock_prefix, create=True)
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+        reader = multiprocessing.get_context('spawn').Process(
+            target=_reader, args=(child_conn, ring.describe()), daemon=True)
+        reader.start()
+
+        def pickle_handoff(tensors):
+            parent_conn.send(('pickle', tensors))
+            parent_conn.recv()
+
+        def shm_handoff(tensors):
+            with ring.slot() as slot:
+                layout = ring.write(slot, tensors)
+                parent_conn.send(('shm', (slot, layout)))
+                parent_conn.recv()
+
+        try:
+            per_image = max(1, options['iterations'] // len(inputs))
+            results = {}
+            for label, handoff in (('pickle', pickle_handoff),
+                                   ('shared memory', shm_handoff)):
+                samples = []
+                for tensors in inputs:
+                    samples.extend(time_calls(
+                        lambda: handoff(tensors), per_image, warmup=options['warmup']))
+                results[label] = summarise_latencies(samples)
+                self.stdout.write(format_latencies(label, results[label]))
+        finally:
+            parent_conn.send(None)
+            reader.join(timeout=5)
+            ring.close()
+            for index in range(ring.slots):
+                try:
+                    os.unlink(f"{lock_prefix}.slot{index}.lock")
+                except OSError:
+                    pass
+
+        speedup = results['pickle']['mean'] / results['shared memory']['mean']
+        self.stdout.write(self.style.SUCCESS(
+            f"Shared memory is {speedup:.2f}x faster per handoff "
+            f"({tensor_bytes / 1024:.0f} KiB of tensors per request, {len(images)} images)"))
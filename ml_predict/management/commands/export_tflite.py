@@ -0,0 +1,113 @@
+# ml_predict/management/commands/export_tflite.py
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ._benchmark import default_benchmark_images, time_calls, summarise_latencies
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+class Command(BaseCommand):
+    help = ('Convert the disease models to TFLite (float32, float16, dynamic-range int8) '
+            'and report latency, size and confidence drift against Keras')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variants', nargs='+', default=None,
+                            help='Variants to export (default: all)')
+        parser.add_argument('--diseases', nargs='+', default=None,
+                            help='Diseases to export (default: all)')
+        parser.add_argument('--validation-dir', default=None,
+                            help='Folder of X-rays to measure drift on (defaults to a few uploads)')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--tolerance', type=float, default=0.01,
+                            help='Largest acceptable confidence drift from Keras')
+
+    def handle(self, *args, **options):
+        import tensorflow as tf
+        from ml_predict.preprocessing import load_image, resize_for_shape
+        from ml_predict.tflite import VARIANTS, TFLiteModel, convert, tflite_path
+        from ml_predict.utils import ChestXrayPredictor, extract_confidence
+
+        variants = options['variants'] or list(VARIANTS)
+        unknown = set(variants) - set(VARIANTS)
+        if unknown:
+            raise CommandError(f"Unknown variants: {', '.join(sorted(unknown))}")
+
+        model_files = ChestXrayPredictor.MODEL_FILES
+        diseases = options['diseases'] or list(model_files)
+        unknown = set(diseases) - set(model_files)
+        if unknown:
+            raise CommandError(f"Unknown diseases: {', '.join(sorted(unknown))}")
+
+        if options['validation_dir']:
+            folder = options['validation_dir']
+            images = sorted(
+                os.path.join(folder, name) for name in os.listdir(folder)
+                if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            images = default_benchmark_images(limit=20)
+        if not images:
+            raise CommandError('No validation images')
+        decoded = [load_image(path) for path in images]
+
+        recommendations = {}
+        for disease in diseases:
+            model_path = os.path.join(str(settings.ML_PREDICT_PATH), model_files[disease])
+            if not os.path.exists(model_path):
+                self.stderr.write(f"{disease}: model file not found, skipped")
+                continue
+
+            model = tf.keras.models.load_model(model_path)
+            input_shape = tuple(model.input_shape[1:])
+            batches = [resize_for_shape(image, input_shape) for image in decoded]
+
+            reference = [
+                extract_confidence(disease, model.predict(batch, verbose=0))
+                for batch in batches]
+            keras_ms = summarise_latencies(time_calls(
+                lambda: model.predict(batches[0], verbose=0),
+                options['iterations'], warmup=options['warmup']))['mean']
+
+            self.stdout.write(
+                f"\n{disease} ({len(images)} validation images)\n"
+                f"  {'variant':<9} {'size KiB':>9} {'mean ms':>8} {'max drift':>10}\n"
+                f"  {'keras':<9} {os.path.getsize(model_path) / 1024:9.0f} "
+                f"{keras_ms:8.2f} {0.0:10.6f}")
+
+            acceptable = []
+            for variant in variants:
+                path = tflite_path(model_files[disease], variant)
+                with open(path, 'wb') as f:
+                    f.write(convert(model, variant))
+                tflite_model = TFLiteModel(
+                    path, num_threads=getattr(settings, 'ML_TFLITE_THREADS', 0))
+
+                drift = max(
+                    abs(extract_confidence(disease, tflite_model.predict(batch)) - expected)
+                    for batch, expected in zip(batches, reference))
+                mean_ms = summarise_latencies(time_calls(
+                    lambda: tflite_model.predict(batches[0]),
+                    options['iterations'], warmup=options['warmup']))['mean']
+                size = os.path.getsize(path)
+
+                within = drift <= options['tolerance']
+                if within:
+                    acceptable.append((mean_ms, size, variant))
+                self.stdout.write(
+                    f"  {variant:<9} {size / 1024:9.0f} {mean_ms:8.2f} {drift:10.6f}"
+                    f"{'' if within else '  over tolerance'}")
+
+            if acceptable:
+                recommendations[disease] = min(acceptable)[2]
+
+        if recommendations:
+            self.stdout.write('')
+            for disease, variant in recommendations.items():
+                self.stdout.write(self.style.SUCCESS(
+                    f"{disease}: fastest variant within {options['tolerance']} is {variant}"))
+            self.stdout.write(
+                "ML_INFERENCE_BACKENDS=" + ','.join(
+                    f"{disease}=tflite:{variant}" for disease, variant in recommendations.items()))
@@ -0,0 +1,66 @@
+# ml_predict/management/commands/run_inference_server.py
+import os
+import hashlib
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Load the ML models once and serve predictions and Grad-CAMs to the web '
+            'workers over a Unix domain socket')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket', default=None,
+            help='Socket path (defaults to ML_INFERENCE_SOCKET)')
+
+    def handle(self, *args, **options):
+        socket_path = options['socket'] or getattr(settings, 'ML_INFERENCE_SOCKET', '')
+        if not socket_path:
+            raise CommandError('Pass --socket or set ML_INFERENCE_SOCKET')
+
+        from ml_predict.inference import get_local_predictor
+        from ml_predict.inference_server import InferenceServer
+
+        predictor = get_local_predictor(wait=False)
+        readiness = predictor.wait_until_ready(partial=False)
+        if not predictor.models:
+            raise CommandError('No ML models are loaded')
+        self.stdout.write(
+            f"Models {readiness}: {', '.join(predictor.models)} "
+            f"(version {predictor.model_set_version})")
+
+        ring = None
+        if getattr(settings, 'ML_SHM_TRANSPORT', False):
+            from ml_predict.shm_transport import SharedTensorRing
+            ring = SharedTensorRing(
+                f"chestcare-{hashlib.sha1(socket_path.encode()).hexdigest()[:12]}",
+                slots=getattr(settings, 'ML_SHM_SLOTS', 8),
+                slot_bytes=getattr(settings, 'ML_SHM_SLOT_BYTES', 4 * 1024 * 1024),
+                lock_prefix=socket_path, create=True)
+            self.stdout.write(
+                f"Shared-memory ring {ring.name}: {ring.slots} x {ring.slot_bytes} bytes")
+
+        try:
+            server = InferenceServer(socket_path, predictor, ring=ring)
+        except (OSError, RuntimeError) as e:
+            if ring is not None:
+                ring.close()
+            raise CommandError(str(e))
+
+        # serve_forever blocks the main thread, so shut down from another one
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(f"Inference server listening on {socket_path} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        self.stdout.write("Inference server stopped")
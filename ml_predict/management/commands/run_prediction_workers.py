@@ -0,0 +1,64 @@
+# ml_predict/management/commands/run_prediction_workers.py
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Load the ML models and run worker threads that drain the queued '
+            'prediction jobs (see ML_ASYNC_PREDICTIONS)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help='Worker threads (defaults to ML_PREDICTION_WORKER_THREADS)')
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait before looking again when the queue is empty')
+
+    def handle(self, *args, **options):
+        threads = options['threads'] or getattr(settings, 'ML_PREDICTION_WORKER_THREADS', 2)
+        if threads < 1:
+            raise CommandError('--threads must be at least 1')
+
+        from ml_predict.inference import get_predictor
+        from ml_predict.jobs import requeue_stale_jobs, work
+
+        predictor = get_predictor()
+        if not predictor.available_diseases:
+            raise CommandError('No ML models are loaded')
+
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} jobs left running by a dead worker")
+
+        stop = threading.Event()
+
+        def shut_down(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shut_down)
+        signal.signal(signal.SIGINT, shut_down)
+
+        workers = [
+            threading.Thread(
+                target=work, args=(predictor, stop, options['poll_interval']),
+                name=f'prediction-worker-{index}')
+            for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(
+            f"{threads} prediction workers running on "
+            f"{', '.join(predictor.available_diseases)}")
+
+        # Look for jobs orphaned by other dead workers now and then
+        interval = max(60, getattr(settings, 'ML_PREDICTION_JOB_TIMEOUT_SECONDS', 600) // 2)
+        while not stop.wait(interval):
+            requeue_stale_jobs()
+
+        # Let in-flight jobs finish
+        for worker in workers:
+            worker.join()
+        self.stdout.write('Prediction workers stopped')
@@ -0,0 +1,31 @@
+# ml_predict/management/commands/warmup_models.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Load the ML models and report how long TensorFlow and model loading take'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        from ml_predict.inference import get_local_predictor
+        predictor = get_local_predictor(wait=False)
+        predictor.wait_until_ready(partial=False)
+        elapsed = time.perf_counter() - started
+
+        if not predictor.models:
+            raise CommandError('No ML models are loaded')
+
+        self.stdout.write(
+            f"Loaded {len(predictor.models)} models in {elapsed:.2f}s: "
+            f"{', '.join(predictor.models)}")
+        for disease, model_status in predictor.load_report()['models'].items():
+            timings = ''
+            if model_status['load_ms'] is not None:
+                timings = f" (load {model_status['load_ms']:.0f} ms"
+                if model_status['warmup_ms'] is not None:
+                    timings += f", warm-up {model_status['warmup_ms']:.0f} ms"
+                timings += ')'
+            self.stdout.write(f"  {disease}: {model_status['state']}{timings}")
+        self.stdout.write(f"Model set version: {predictor.model_set_version}")
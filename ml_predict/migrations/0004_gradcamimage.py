@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-17 02:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0003_predictionresult_gradcam_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradCAMImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('disease', models.CharField(choices=[('cardiomegaly', 'Cardiomegaly'), ('pneumonia', 'Pneumonia'), ('tuberculosis', 'Tuberculosis'), ('pulmonary_hypertension', 'Pulmonary Hypertension')], max_length=50)),
+                ('image', models.ImageField(upload_to='gradcam_uploads/')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('prediction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gradcams', to='ml_predict.predictionresult')),
+            ],
+            options={
+                'unique_together': {('prediction', 'disease')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 02:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0004_gradcamimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictionresult',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='predictionresult',
+            name='model_version',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
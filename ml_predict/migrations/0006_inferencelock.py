@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 02:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0005_predictionresult_content_hash_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InferenceLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('owner', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 02:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0007_predictionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictionresult',
+            name='gradcam_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('running', 'Running'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=10, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 03:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0008_predictionresult_gradcam_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictionresult',
+            name='gradcam_heatmaps',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
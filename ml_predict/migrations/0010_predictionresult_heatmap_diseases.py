@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-17 03:48
+
+from io import BytesIO
+
+import numpy as np
+from django.db import migrations, models
+
+
+def list_stored_heatmaps(apps, schema_editor):
+    PredictionResult = apps.get_model('ml_predict', 'PredictionResult')
+    predictions = PredictionResult.objects.exclude(gradcam_heatmaps=None).only('gradcam_heatmaps')
+    for prediction in predictions.iterator():
+        if not prediction.gradcam_heatmaps:
+            continue
+        with np.load(BytesIO(bytes(prediction.gradcam_heatmaps)), allow_pickle=False) as archive:
+            prediction.heatmap_diseases = list(archive.files)
+        prediction.save(update_fields=['heatmap_diseases'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml_predict', '0009_predictionresult_gradcam_heatmaps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictionresult',
+            name='heatmap_diseases',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(list_stored_heatmaps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,264 @@
+# ml_predict/model_manager.py
+"""
+Keeps the resident disease models within a memory budget.
+
+Every request leases the models it runs. Unleased models that haven't been
+used for ML_MODEL_IDLE_SECONDS, or the least recently used ones once the
+resident total exceeds ML_MODEL_MEMORY_BUDGET_MB, are unloaded; pinned
+models (ML_PINNED_MODELS) never are. An unloaded model is reloaded by the
+first request that needs it while concurrent requests for it wait for
+that load instead of starting their own.
+
+Footprints are the bytes of weights (and TFLite flatbuffers) the model's
+backend holds, so the budget is approximate: TensorFlow's own overhead
+and traced graphs come on top, and a request can briefly hold more than
+the budget while every model it needs is leased.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def process_rss_bytes():
+    """Resident set size of this process, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ModelManager:
+    """Tracks model footprints and use, and unloads or reloads models to fit a budget"""
+
+    def __init__(self, load, unload, budget_bytes=0, idle_seconds=0, pinned=(),
+                 load_timeout=None):
+        # load(disease) -> bool brings a model back; unload(disease) drops it
+        self._load = load
+        self._unload = unload
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        self.pinned = set(pinned)
+        self.load_timeout = load_timeout
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._load_locks = {}
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'loads': 0,
+            'load_failures': 0,
+            'load_ms_total': 0.0,
+            'budget_evictions': 0,
+            'idle_evictions': 0,
+        }
+        if idle_seconds:
+            threading.Thread(
+                target=self._sweep, name='model-sweeper', daemon=True).start()
+
+    def _entry(self, disease):
+        entry = self._entries.get(disease)
+        if entry is None:
+            entry = self._entries[disease] = {
+                'resident': False,
+                'footprint_bytes': 0,
+                'last_used': time.monotonic(),
+                'leases': 0,
+                'loads': 0,
+                'unloads': 0,
+                'hits': 0,
+                'misses': 0,
+            }
+            self._load_locks[disease] = threading.Lock()
+        return entry
+
+    def loaded(self, disease, footprint_bytes):
+        """Record that a model is resident (at boot or after a reload)"""
+        with self._lock:
+            entry = self._entry(disease)
+            entry['resident'] = True
+            entry['footprint_bytes'] = footprint_bytes
+            entry['last_used'] = time.monotonic()
+            entry['loads'] += 1
+
+    def resident_bytes(self):
+        with self._lock:
+            return self._resident_bytes()
+
+    def _resident_bytes(self):
+        return sum(
+            entry['footprint_bytes'] for entry in self._entries.values() if entry['resident'])
+
+    @contextmanager
+    def use(self, diseases):
+        """Make the models resident (reloading any that were unloaded) and
+        keep them so until the block exits
+
+        A model that can't be reloaded is skipped, as if it were missing.
+        """
+        # Lease the resident models first, so making room for a reload
+        # can't evict one this request is about to use
+        with self._lock:
+            diseases = sorted(
+                diseases, key=lambda disease: not self._entry(disease)['resident'])
+        leased = []
+        try:
+            for disease in diseases:
+                if self._acquire(disease):
+                    leased.append(disease)
+            yield
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                for disease in leased:
+                    entry = self._entries[disease]
+                    entry['leases'] -= 1
+                    entry['last_used'] = now
+            self.enforce_budget()
+
+    def _acquire(self, disease):
+        with self._lock:
+            entry = self._entry(disease)
+            if entry['resident']:
+                entry['leases'] += 1
+                entry['hits'] += 1
+                self._counters['hits'] += 1
+                return True
+
+        # Single flight: one request reloads, the others wait for it
+        load_lock = self._load_locks[disease]
+        if not load_lock.acquire(timeout=-1 if self.load_timeout is None else self.load_timeout):
+            logger.error(f"Timed out waiting for the {disease} model to reload")
+            return False
+        try:
+            with self._lock:
+                # Reserved before loading so it can't be evicted straight away
+                entry['leases'] += 1
+                if entry['resident']:
+                    entry['hits'] += 1
+                    self._counters['coalesced'] += 1
+                    return True
+                entry['misses'] += 1
+                self._counters['misses'] += 1
+
+            self._make_room(entry['footprint_bytes'], exclude=disease)
+            started = time.perf_counter()
+            loaded = False
+            try:
+                loaded = self._load(disease)
+            except Exception as e:
+                logger.error(f"Error reloading {disease} model: {str(e)}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            with self._lock:
+                self._counters['load_ms_total'] += elapsed_ms
+                if loaded:
+                    self._counters['loads'] += 1
+                else:
+                    self._counters['load_failures'] += 1
+                    entry['leases'] -= 1
+            if loaded:
+                logger.info(f"Reloaded {disease} model on demand in {elapsed_ms:.0f} ms")
+            return loaded
+        finally:
+            load_lock.release()
+
+    def _claim_victim(self, reason, exclude=None, idle_before=None):
+        """Mark the least recently used model that may be unloaded as evicted
+
+        Called with the lock held. Returns the disease with its load lock
+        held, so a reload can't start until the unload has finished, or None.
+        """
+        candidates = sorted(
+            (entry['last_used'], disease) for disease, entry in self._entries.items()
+            if entry['resident'] and not entry['leases'] and disease not in self.pinned
+            and disease != exclude
+            and (idle_before is None or entry['last_used'] < idle_before)
+        )
+        for _, disease in candidates:
+            # Held by a request about to lease it
+            if not self._load_locks[disease].acquire(blocking=False):
+                continue
+            entry = self._entries[disease]
+            entry['resident'] = False
+            entry['unloads'] += 1
+            self._counters[f'{reason}_evictions'] += 1
+            return disease
+        return None
+
+    def _unload_claimed(self, disease):
+        try:
+            self._unload(disease)
+        except Exception as e:
+            logger.error(f"Error unloading {disease} model: {str(e)}")
+        finally:
+            self._load_locks[disease].release()
+
+    def _make_room(self, needed_bytes, exclude=None):
+        if not self.budget_bytes:
+            return
+        while True:
+            with self._lock:
+                if self._resident_bytes() + needed_bytes <= self.budget_bytes:
+                    return
+                victim = self._claim_victim('budget', exclude=exclude)
+                if victim is None:
+                    return
+            self._unload_claimed(victim)
+            logger.info(f"Unloaded {victim} model to stay within the memory budget")
+
+    def enforce_budget(self):
+        """Unload least recently used models until the resident total fits"""
+        self._make_room(0)
+
+    def evict_idle(self):
+        """Unload models that haven't been used for idle_seconds"""
+        if not self.idle_seconds:
+            return
+        idle_before = time.monotonic() - self.idle_seconds
+        while True:
+            with self._lock:
+                victim = self._claim_victim('idle', idle_before=idle_before)
+                if victim is None:
+                    return
+            self._unload_claimed(victim)
+            logger.info(
+                f"Unloaded {victim} model after {self.idle_seconds}s without use")
+
+    def _sweep(self):
+        interval = max(1.0, min(self.idle_seconds / 2, 60.0))
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"Idle model eviction failed: {str(e)}")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self._counters)
+            counters['models'] = {
+                disease: {
+                    'resident': entry['resident'],
+                    'pinned': disease in self.pinned,
+                    'footprint_bytes': entry['footprint_bytes'],
+                    'idle_seconds': round(now - entry['last_used'], 1),
+                    'leases': entry['leases'],
+                    'loads': entry['loads'],
+                    'unloads': entry['unloads'],
+                    'hits': entry['hits'],
+                    'misses': entry['misses'],
+                }
+                for disease, entry in self._entries.items()
+            }
+            counters['resident_bytes'] = self._resident_bytes()
+        counters['budget_bytes'] = self.budget_bytes
+        counters['idle_seconds'] = self.idle_seconds
+        counters['process_rss_bytes'] = process_rss_bytes()
+        return counters
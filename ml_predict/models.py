@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 from dashboard.models import Patient, Disease
 
@@ -18,12 +18,32 @@ class PredictionResult(models.Model):
     xray_image = models.ImageField(upload_to='xray_uploads/')
     gradcam_image = models.ImageField(
         upload_to='gradcam_uploads/', null=True, blank=True)  # New field
+    # Progress of the Grad-CAMs when they are generated after the response
+    # (ML_DEFER_GRADCAM); null for predictions made before it was tracked
+    GRADCAM_STATUSES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+    gradcam_status = models.CharField(
+        max_length=10, choices=GRADCAM_STATUSES, null=True, blank=True)
+    # Raw conv-resolution Grad-CAM heatmaps (float16, see
+    # rendering.pack_heatmaps), from which overlays are rendered on demand
+    gradcam_heatmaps = models.BinaryField(null=True, blank=True)
+    # Diseases in gradcam_heatmaps, so listing them doesn't unpack the blob
+    heatmap_diseases = models.JSONField(default=list, blank=True)
     predicted_disease = models.CharField(
         max_length=50, choices=DISEASE_TYPES, null=True, blank=True)
     confidence_score = models.FloatField(
         null=True, blank=True)  # Allow null values
     all_predictions = models.JSONField(
         null=True, blank=True)  # Allow null values
+    # SHA-256 of the uploaded X-ray and the model set that scored it, used
+    # to reuse results for byte-identical uploads
+    content_hash = models.CharField(
+        max_length=64, null=True, blank=True, db_index=True)
+    model_version = models.CharField(max_length=64, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     reviewed_by_doctor = models.ForeignKey(
         'dashboard.Doctor',
@@ -40,3 +60,113 @@ class PredictionResult(models.Model):
         if self.predicted_disease and self.confidence_score:
             return f"{self.patient} - {self.predicted_disease} ({self.confidence_score:.2f})"
         return f"{self.patient} - Prediction Failed"
+
+    def get_gradcam_file(self, disease):
+        """Return the stored Grad-CAM file for a disease, if there is one"""
+        if disease == self.predicted_disease:
+            return self.gradcam_image or None
+        gradcam = self.gradcams.filter(disease=disease).first()
+        return gradcam.image if gradcam else None
+
+    def get_heatmaps(self):
+        """Stored raw heatmaps as {disease: float16 array}"""
+        from .rendering import unpack_heatmaps
+        return unpack_heatmaps(self.gradcam_heatmaps)
+
+    def save_heatmaps(self, heatmaps):
+        """Add or replace stored heatmaps for some diseases"""
+        from .rendering import pack_heatmaps
+        with transaction.atomic():
+            # Re-read under a lock so concurrent writers don't drop each other's
+            current = PredictionResult.objects.select_for_update().filter(
+                id=self.id).values_list('gradcam_heatmaps', flat=True).first()
+            self.gradcam_heatmaps = current
+            stored = self.get_heatmaps()
+            stored.update(heatmaps)
+            self.gradcam_heatmaps = pack_heatmaps(stored)
+            self.heatmap_diseases = list(stored)
+            PredictionResult.objects.filter(id=self.id).update(
+                gradcam_heatmaps=self.gradcam_heatmaps, heatmap_diseases=self.heatmap_diseases)
+
+    def save_gradcam(self, disease, gradcam_file):
+        """Store a Grad-CAM, replacing any existing one for the same disease"""
+        from .rendering import format_for_name
+        file_name = f'gradcam_{self.id}_{disease}.{format_for_name(gradcam_file.name)}'
+        heatmap = getattr(gradcam_file, 'heatmap', None)
+        if heatmap is not None:
+            self.save_heatmaps({disease: heatmap})
+        if disease == self.predicted_disease:
+            if self.gradcam_image:
+                self.gradcam_image.delete(save=False)
+            self.gradcam_status = 'ready'
+            self.gradcam_image.save(file_name, gradcam_file, save=False)
+            # Only these fields: a full save of this instance would write back
+            # heatmaps another writer stored since it was loaded
+            self.save(update_fields=['gradcam_image', 'gradcam_status'])
+            return self.gradcam_image
+
+        gradcam, _ = GradCAMImage.objects.get_or_create(
+            prediction=self, disease=disease)
+        if gradcam.image:
+            gradcam.image.delete(save=False)
+        gradcam.image.save(file_name, gradcam_file, save=True)
+        return gradcam.image
+
+
+class GradCAMImage(models.Model):
+    """Grad-CAM visualization for a non-primary disease of a prediction"""
+    prediction = models.ForeignKey(
+        PredictionResult, on_delete=models.CASCADE, related_name='gradcams')
+    disease = models.CharField(
+        max_length=50, choices=PredictionResult.DISEASE_TYPES)
+    image = models.ImageField(upload_to='gradcam_uploads/')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('prediction', 'disease')
+
+    def __str__(self):
+        return f"{self.prediction_id} - {self.disease}"
+
+
+class InferenceLock(models.Model):
+    """Held by the worker computing a result other workers want too (see single_flight)"""
+    key = models.CharField(max_length=255, unique=True)
+    owner = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.owner})"
+
+
+class PredictionJob(models.Model):
+    """A queued prediction, scored by run_prediction_workers instead of in the request"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    prediction = models.OneToOneField(
+        PredictionResult, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='job')
+    created_by = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    stage = models.CharField(max_length=50, blank=True, default='')
+    progress = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status})"
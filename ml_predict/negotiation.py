@@ -0,0 +1,33 @@
+# ml_predict/negotiation.py
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+class ImageAwareContentNegotiation(DefaultContentNegotiation):
+    """DRF's negotiation, except that clients accepting only images (such as
+    an <img> loading a Grad-CAM with Accept: image/webp) get JSON error and
+    status bodies instead of a 406; the image itself is negotiated by the
+    view"""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            accepts = [
+                media_type.split(';')[0].strip()
+                for media_type in request.META.get('HTTP_ACCEPT', '').split(',')
+            ]
+            if format_suffix or not accepts or not all(
+                    media_type.startswith('image/') for media_type in accepts):
+                raise
+            return renderers[0], renderers[0].media_type
+
+
+def image_aware_negotiation(view):
+    """Use ImageAwareContentNegotiation for an @api_view function view
+
+    DRF has no decorator for content_negotiation_class; apply this one
+    above @api_view.
+    """
+    view.cls.content_negotiation_class = ImageAwareContentNegotiation
+    return view
@@ -0,0 +1,287 @@
+# ml_predict/pipeline.py
+"""
+The prediction pipeline shared by the predict view and the job workers:
+score a saved X-ray with every model, store the result and its Grad-CAMs.
+"""
+import os
+import logging
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from .models import PredictionResult
+from .batching import get_scheduler
+from .latency_budget import LatencyBudget
+
+logger = logging.getLogger(__name__)
+
+
+def find_memoised_prediction(content_hash, model_version):
+    """Latest successful prediction for the same X-ray bytes and model set"""
+    return PredictionResult.objects.filter(
+        content_hash=content_hash,
+        model_version=model_version,
+        predicted_disease__isnull=False,
+        confidence_score__isnull=False,
+    ).order_by('-created_at').first()
+
+
+def reuse_prediction(prediction_result, prior):
+    """Fill a prediction from a prior one for the same image instead of running inference
+
+    Returns whether the primary Grad-CAM is available.
+    """
+    logger.info(
+        f"Reusing prediction {prior.id} for identical X-ray {prediction_result.content_hash[:12]}")
+
+    # The X-ray bytes are identical, so point at the stored file rather than
+    # keeping another copy (a queued job has already saved its own)
+    if prediction_result.pk and prediction_result.xray_image.name != prior.xray_image.name:
+        prediction_result.xray_image.delete(save=False)
+    prediction_result.xray_image = prior.xray_image.name
+    prediction_result.predicted_disease = prior.predicted_disease
+    prediction_result.confidence_score = prior.confidence_score
+    prediction_result.all_predictions = prior.all_predictions
+    prediction_result.gradcam_heatmaps = prior.gradcam_heatmaps
+    prediction_result.heatmap_diseases = prior.heatmap_diseases
+    prediction_result.save()
+
+    # Grad-CAM files get replaced on regenerate, so copy them instead of
+    # sharing them between predictions
+    gradcam_available = False
+    prior_gradcams = [(prior.predicted_disease, prior.gradcam_image)] + [
+        (gradcam.disease, gradcam.image) for gradcam in prior.gradcams.all()]
+    for disease, gradcam_image in prior_gradcams:
+        if not gradcam_image:
+            continue
+        try:
+            with gradcam_image.open('rb') as f:
+                prediction_result.save_gradcam(disease, ContentFile(
+                    f.read(), name=os.path.basename(gradcam_image.name)))
+            if disease == prediction_result.predicted_disease:
+                gradcam_available = True
+        except Exception as e:
+            logger.warning(
+                f"Could not copy Grad-CAM for {disease} from prediction {prior.id}: {str(e)}")
+
+    if not gradcam_available and getattr(settings, 'ML_DEFER_GRADCAM', False):
+        # The prior one's are still being built (or failed): build these too
+        from .deferred_gradcam import schedule_gradcams
+        prediction_result.gradcam_status = 'pending'
+        prediction_result.save(update_fields=['gradcam_status'])
+        schedule_gradcams(prediction_result.id)
+    return gradcam_available
+
+
+def _no_progress(stage, percent):
+    pass
+
+
+def secondary_threshold():
+    """Confidence above which other diseases get a Grad-CAM too, or None"""
+    if getattr(settings, 'ML_SECONDARY_GRADCAMS', True):
+        return getattr(settings, 'ML_GRADCAM_CONFIDENCE_THRESHOLD', 0.3)
+    return None
+
+
+def gradcam_diseases(predicted_disease, all_predictions):
+    """The predicted disease followed by the others that get a Grad-CAM"""
+    diseases = [predicted_disease]
+    threshold = secondary_threshold()
+    if threshold is not None:
+        diseases += [
+            disease for disease, confidence in all_predictions.items()
+            if disease != predicted_disease and confidence > threshold
+        ]
+    return diseases
+
+
+def store_gradcams(prediction_result, gradcam_files):
+    """Save a prediction's Grad-CAMs; returns whether the primary one was stored"""
+    predicted_disease = prediction_result.predicted_disease
+    all_predictions = prediction_result.all_predictions
+    gradcam_available = False
+
+    gradcam_file = gradcam_files.get(predicted_disease)
+    if gradcam_file:
+        try:
+            prediction_result.save_gradcam(predicted_disease, gradcam_file)
+            logger.info(
+                "Primary Grad-CAM image generated and saved successfully")
+            gradcam_available = True
+        except Exception as e:
+            logger.error(f"Failed to save primary Grad-CAM: {str(e)}")
+    else:
+        logger.warning("Primary Grad-CAM generation failed")
+
+    # Store Grad-CAMs for other diseases above the confidence threshold
+    for disease, additional_gradcam in gradcam_files.items():
+        if disease == predicted_disease:
+            continue
+        try:
+            prediction_result.save_gradcam(
+                disease, additional_gradcam)
+            logger.info(
+                f"Additional Grad-CAM for {disease} (confidence: {all_predictions[disease]:.3f}) saved")
+        except Exception as e:
+            logger.warning(
+                f"Failed to save additional Grad-CAM for {disease}: {str(e)}")
+
+    if not gradcam_available:
+        prediction_result.gradcam_status = 'failed'
+        prediction_result.save(update_fields=['gradcam_status'])
+    return gradcam_available
+
+
+def run_prediction(prediction_result, predictor, progress=_no_progress, budget=None):
+    """Score a saved prediction's X-ray and store the result and Grad-CAMs
+
+    progress(stage, percent) is called as the pipeline moves on. With
+    ML_DEFER_GRADCAM the Grad-CAMs are left to a background worker once the
+    transaction commits. With a limited LatencyBudget the Grad-CAMs are
+    built separately from scoring, so the ones that don't fit in the time
+    left can be deferred or skipped. Returns whether the primary Grad-CAM
+    is available now; raises on failure (including SchedulerBusy), leaving
+    the caller to clean up.
+    """
+    if budget is None:
+        budget = LatencyBudget()
+    logger.info(
+        f"Starting prediction for image: {prediction_result.xray_image.path}")
+
+    # Check if predictor has loaded models
+    if not predictor.available_diseases:
+        raise Exception(
+            "No ML models loaded. Please check model files and logs.")
+
+    # Make the prediction. Batched requests are coalesced with concurrent
+    # ones and get their Grad-CAMs separately; otherwise the Grad-CAMs come
+    # from the same forward pass. The inference daemon does its own batching.
+    defer_gradcam = getattr(settings, 'ML_DEFER_GRADCAM', False)
+    progress('inference', 10)
+    gradcam_files = None
+    if getattr(settings, 'ML_BATCHING_ENABLED', False) and not predictor.remote:
+        with budget.stage('inference'):
+            prediction = get_scheduler().predict(
+                prediction_result.xray_image.path,
+                timeout=getattr(settings, 'ML_BATCH_TIMEOUT_SECONDS', 60))
+    elif defer_gradcam or budget.limited:
+        with budget.stage('inference'):
+            prediction = predictor.predict(prediction_result.xray_image.path)
+    else:
+        with budget.stage('inference_and_gradcam'):
+            prediction, gradcam_files = predictor.predict_and_explain(
+                prediction_result.xray_image.path,
+                secondary_threshold=secondary_threshold())
+
+    if not prediction:
+        raise Exception("Prediction returned None or empty result")
+
+    required_keys = ['predicted_disease',
+                     'confidence_score', 'all_predictions']
+    missing_keys = [
+        key for key in required_keys if key not in prediction]
+    if missing_keys:
+        raise Exception(
+            f"Prediction missing required keys: {missing_keys}")
+
+    predicted_disease = prediction['predicted_disease']
+    if predicted_disease is None or predicted_disease == '':
+        raise Exception("Predicted disease is null or empty")
+
+    confidence_score = prediction['confidence_score']
+    if confidence_score is None or np.isnan(confidence_score) or np.isinf(confidence_score):
+        raise Exception(
+            f"Invalid confidence score: {confidence_score}")
+
+    all_predictions = prediction['all_predictions']
+    if all_predictions is None:
+        raise Exception("All predictions is null")
+
+    # Update prediction result with validated data
+    prediction_result.predicted_disease = predicted_disease
+    prediction_result.confidence_score = float(confidence_score)
+    prediction_result.all_predictions = all_predictions
+
+    if defer_gradcam:
+        _defer_gradcams(prediction_result)
+        return False
+    prediction_result.save()
+
+    # Generate Grad-CAM visualization for the predicted disease (primary)
+    progress('gradcam', 60)
+    logger.info(
+        f"Generating Grad-CAM for primary prediction: {predicted_disease}")
+
+    if gradcam_files is None and budget.limited:
+        gradcam_files = _budgeted_gradcams(
+            prediction_result, predictor, budget,
+            gradcam_diseases(predicted_disease, all_predictions))
+        if gradcam_files is None:
+            return False
+    elif gradcam_files is None:
+        # Batched predictions: build every Grad-CAM in one go. Timed apart
+        # from 'gradcam', whose estimate covers the primary Grad-CAM alone
+        try:
+            with budget.stage('batched_gradcams'):
+                gradcam_files = predictor.generate_gradcams(
+                    prediction_result.xray_image.path,
+                    gradcam_diseases(predicted_disease, all_predictions))
+        except Exception as gradcam_error:
+            gradcam_files = {}
+            logger.error(
+                f"Primary Grad-CAM generation error: {str(gradcam_error)}")
+
+    progress('saving', 90)
+    with budget.stage('saving'):
+        return store_gradcams(prediction_result, gradcam_files)
+
+
+def _defer_gradcams(prediction_result):
+    """Save the prediction as pending and build its Grad-CAMs in the background"""
+    from .deferred_gradcam import schedule_gradcams
+    prediction_result.gradcam_status = 'pending'
+    prediction_result.save()
+    schedule_gradcams(prediction_result.id)
+
+
+def _budgeted_gradcams(prediction_result, predictor, budget, diseases):
+    """Build the Grad-CAMs that fit in the budget's time left
+
+    Under pressure the PNGs are compressed less; if even the primary
+    Grad-CAM doesn't fit it is deferred to the background (returns None),
+    and secondary ones that don't fit are left for on-demand generation.
+    """
+    primary, secondary = diseases[0], diseases[1:]
+    if not budget.allows('gradcam'):
+        budget.drop('gradcam', 'deferred')
+        if secondary:
+            budget.drop('secondary_gradcams', 'deferred')
+        _defer_gradcams(prediction_result)
+        return None
+
+    fast_encoding = not budget.allows('gradcam', 'secondary_gradcams')
+    if fast_encoding:
+        budget.drop('png_encoding', 'degraded')
+
+    gradcam_files = {}
+    try:
+        with budget.stage('gradcam'):
+            gradcam_files.update(predictor.generate_gradcams(
+                prediction_result.xray_image.path, [primary],
+                fast_encoding=fast_encoding))
+    except Exception as gradcam_error:
+        logger.error(f"Primary Grad-CAM generation error: {str(gradcam_error)}")
+
+    if secondary and budget.allows('secondary_gradcams'):
+        try:
+            with budget.stage('secondary_gradcams'):
+                gradcam_files.update(predictor.generate_gradcams(
+                    prediction_result.xray_image.path, secondary,
+                    fast_encoding=fast_encoding))
+        except Exception as gradcam_error:
+            logger.error(f"Secondary Grad-CAM generation error: {str(gradcam_error)}")
+    elif secondary:
+        budget.drop('secondary_gradcams', 'skipped')
+    return gradcam_files
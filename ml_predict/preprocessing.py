@@ -0,0 +1,37 @@
+# ml_predict/preprocessing.py
+"""
+Image decoding and resizing for the disease models.
+
+Only needs PIL and NumPy, so web workers that hand inference off to the
+daemon can prepare model inputs without importing TensorFlow.
+"""
+import numpy as np
+from PIL import Image
+
+
+def load_image(image_path):
+    """Open and decode an X-ray image once, as RGB"""
+    with Image.open(image_path) as image:
+        return image.convert('RGB')
+
+
+def resize_for_shape(image, input_shape, out=None):
+    """Resize a decoded image to an input shape and normalise it to float32
+
+    Writes into out (a (1, height, width, channels) float32 array) when
+    given, e.g. a view on a shared-memory slot.
+    """
+    height, width = input_shape[0], input_shape[1]
+    resized = np.asarray(image.resize((width, height)))
+    if out is None:
+        out = np.empty((1,) + tuple(input_shape), dtype=np.float32)
+    np.divide(resized, 255.0, out=out[0], casting='unsafe')
+    return out
+
+
+def preprocess_for_shapes(image, input_shapes):
+    """Produce one preprocessed tensor per distinct model input shape"""
+    return {
+        input_shape: resize_for_shape(image, input_shape)
+        for input_shape in input_shapes
+    }
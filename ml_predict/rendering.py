@@ -0,0 +1,275 @@
+# ml_predict/rendering.py
+"""
+Grad-CAM overlay rendering.
+
+A heatmap is quantised to uint8 at conv resolution, resized to the output
+size and coloured through a 256-entry RGB lookup table with
+cv2.applyColorMap, then blended with the X-ray in place. Nothing is
+expanded to float64 RGBA along the way, the decoded X-ray is shared by
+every disease of a request, and the output is capped at
+ML_GRADCAM_MAX_RESOLUTION on its longest side.
+"""
+import os
+import threading
+from io import BytesIO
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import File
+from PIL import Image
+
+# Colormap name -> OpenCV colormap used to build its lookup table. OpenCV
+# is imported by the functions that use it, so the views can import this
+# module without loading it.
+COLORMAPS = {
+    'jet': 'COLORMAP_JET',
+    'turbo': 'COLORMAP_TURBO',
+    'inferno': 'COLORMAP_INFERNO',
+    'viridis': 'COLORMAP_VIRIDIS',
+    'hot': 'COLORMAP_HOT',
+    'bone': 'COLORMAP_BONE',
+}
+
+DEFAULT_ALPHA = 0.4  # Weight of the heatmap in the blend
+
+# Output format -> (PIL format, content type)
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+EXTENSIONS = {'.png': 'png', '.webp': 'webp', '.jpeg': 'jpeg', '.jpg': 'jpeg'}
+
+_scratch = threading.local()  # Per-thread buffers reused across renders
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(name):
+    """The colormap as a (256, 1, 3) uint8 RGB lookup table"""
+    import cv2
+    if name not in COLORMAPS:
+        raise ValueError(f"Unknown colormap {name!r}; expected one of {', '.join(COLORMAPS)}")
+    levels = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    # OpenCV's tables are BGR; flipped once here so renders come out RGB
+    lut = cv2.applyColorMap(levels, getattr(cv2, COLORMAPS[name]))[:, :, ::-1]
+    return np.ascontiguousarray(lut)
+
+
+def max_resolution():
+    """Longest side of a rendered overlay in pixels (0 = the X-ray's own size)"""
+    return getattr(settings, 'ML_GRADCAM_MAX_RESOLUTION', 1024)
+
+
+def stored_format():
+    """Format Grad-CAMs are encoded in when they're generated (ML_GRADCAM_FORMAT)"""
+    return getattr(settings, 'ML_GRADCAM_FORMAT', 'png')
+
+
+def format_for_name(name):
+    """Image format of a stored Grad-CAM, from its file name"""
+    return EXTENSIONS.get(os.path.splitext(name or '')[1].lower(), 'png')
+
+
+def render_signature():
+    """The settings that change how an overlay looks, for cache keys"""
+    return (f"{getattr(settings, 'ML_GRADCAM_COLORMAP', 'jet')}:{max_resolution()}"
+            f":{stored_format()}")
+
+
+def output_size(width, height, max_size=None):
+    """(width, height) scaled down so the longest side is at most max_size"""
+    max_size = max_resolution() if max_size is None else max_size
+    longest = max(width, height)
+    if not max_size or longest <= max_size:
+        return width, height
+    scale = max_size / longest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_base(image, max_size=None):
+    """Turn a decoded X-ray (PIL image or array) into the contiguous uint8 RGB
+    array overlays are drawn on, downscaled to the output size
+
+    Done once per request and shared by every disease's overlay.
+    """
+    import cv2
+    if hasattr(image, 'mode'):
+        # PIL: convert and downscale before copying the pixels out
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        size = output_size(image.width, image.height, max_size)
+        if size != image.size:
+            # Integer reduction is much cheaper than a general resize
+            factor = min(image.width // size[0], image.height // size[1])
+            if factor >= 2:
+                image = image.reduce(factor)
+            if image.size != size:
+                image = image.resize(size, resample=Image.Resampling.BOX)
+        return np.asarray(image, dtype=np.uint8)
+
+    base = np.asarray(image, dtype=np.uint8)
+    if base.ndim == 2:
+        base = cv2.cvtColor(base, cv2.COLOR_GRAY2RGB)
+    height, width = base.shape[:2]
+    size = output_size(width, height, max_size)
+    if size != (width, height):
+        base = cv2.resize(base, size, interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(base)
+
+
+def _buffer(name, shape):
+    """A per-thread scratch array, reallocated only when the shape changes"""
+    buffer = getattr(_scratch, name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        setattr(_scratch, name, buffer)
+    return buffer
+
+
+def render_overlay(base, heatmap, alpha=DEFAULT_ALPHA, colormap='jet', out=None):
+    """Blend a [0, 1] heatmap over a prepare_base() image
+
+    Returns a uint8 RGB array the size of base, written into out when given
+    (it must match base's shape).
+    """
+    import cv2
+    height, width = base.shape[:2]
+
+    # Quantise at conv resolution (a few hundred values), then upsample
+    levels = _buffer('levels', np.shape(heatmap))
+    np.multiply(heatmap, 255, out=levels, casting='unsafe')
+    heat = _buffer('heat', (height, width))
+    cv2.resize(levels, (width, height), dst=heat, interpolation=cv2.INTER_LINEAR)
+
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    cv2.applyColorMap(heat, colormap_lut(colormap), dst=out)
+    cv2.addWeighted(base, 1 - alpha, out, alpha, 0, dst=out)
+    return out
+
+
+def encoder_options(image_format, fast=False):
+    """PIL save options for a format, from the ML_GRADCAM_* settings; fast
+    trades size for encoding time"""
+    if image_format == 'png':
+        # Lossless, so the level only trades size for time
+        if fast:
+            return {'compress_level': getattr(settings, 'ML_GRADCAM_FAST_PNG_COMPRESS_LEVEL', 1)}
+        return {'compress_level': getattr(settings, 'ML_GRADCAM_PNG_COMPRESS_LEVEL', 6)}
+    if image_format == 'webp':
+        return {
+            'quality': getattr(settings, 'ML_GRADCAM_WEBP_QUALITY', 80),
+            'method': 0 if fast else getattr(settings, 'ML_GRADCAM_WEBP_METHOD', 4),
+        }
+    return {'quality': getattr(settings, 'ML_GRADCAM_JPEG_QUALITY', 85)}
+
+
+def encode_image(overlay, image_format='png', fast=False, out=None):
+    """Encode an RGB overlay as PNG, WebP or JPEG
+
+    Writes into out (a binary file object) and returns it when given,
+    otherwise returns the bytes.
+    """
+    pil_format, _ = IMAGE_FORMATS[image_format]
+    target = BytesIO() if out is None else out
+    Image.fromarray(overlay).save(
+        target, format=pil_format, **encoder_options(image_format, fast))
+    return target.getvalue() if out is None else out
+
+
+class GradCAMFile(File):
+    """An encoded Grad-CAM overlay along with the heatmap it was drawn from
+
+    Wraps the buffer the encoder wrote into (or bytes received from the
+    inference daemon), so storage reads the encoded image without it
+    being copied into another file object first.
+    """
+
+    def __init__(self, content, name=None, heatmap=None):
+        super().__init__(content if hasattr(content, 'read') else BytesIO(content), name=name)
+        self.heatmap = heatmap
+
+    def __bool__(self):
+        return True
+
+    def open(self, mode=None):
+        self.seek(0)
+        return self
+
+    def close(self):
+        pass
+
+
+def encode_gradcam(overlay, name, image_format=None, fast=False, heatmap=None):
+    """Encode an overlay straight into a GradCAMFile named name plus the
+    format's extension (ML_GRADCAM_FORMAT by default)"""
+    image_format = image_format or stored_format()
+    buffer = encode_image(overlay, image_format, fast=fast, out=BytesIO())
+    buffer.seek(0)
+    return GradCAMFile(buffer, name=f'{name}.{image_format}', heatmap=heatmap)
+
+
+def negotiate_format(accept, preferred='png'):
+    """The image format an Accept header prefers
+
+    Explicitly listed types beat image/* and */*; ties go to preferred
+    (the stored format, which needs no re-encoding). Falls back to
+    preferred when the header accepts none of the formats.
+    """
+    if not accept:
+        return preferred
+    ranges = []
+    for item in accept.split(','):
+        media_type, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media_type.strip().lower(), quality))
+
+    def rank(image_format):
+        content_type = IMAGE_FORMATS[image_format][1]
+        best = None
+        for media_type, quality in ranges:
+            if media_type == content_type:
+                specificity = 2
+            elif media_type == 'image/*':
+                specificity = 1
+            elif media_type == '*/*':
+                specificity = 0
+            else:
+                continue
+            # The most specific matching range decides the quality
+            if best is None or specificity > best[1]:
+                best = (quality, specificity)
+        return best or (0.0, -1)
+
+    ranked = [(rank(image_format), image_format == preferred, image_format)
+              for image_format in IMAGE_FORMATS]
+    (quality, _), _, image_format = max(ranked)
+    return image_format if quality > 0 else preferred
+
+
+def compact_heatmap(heatmap):
+    """A heatmap as stored: float16 at conv resolution, a few hundred bytes"""
+    return np.asarray(heatmap, dtype=np.float16)
+
+
+def pack_heatmaps(heatmaps):
+    """Serialise {disease: heatmap} into one compact blob"""
+    buffer = BytesIO()
+    np.savez(buffer, **{disease: compact_heatmap(heatmap) for disease, heatmap in heatmaps.items()})
+    return buffer.getvalue()
+
+
+def unpack_heatmaps(data):
+    """{disease: float16 heatmap} from a pack_heatmaps() blob"""
+    if not data:
+        return {}
+    with np.load(BytesIO(bytes(data)), allow_pickle=False) as archive:
+        return {disease: archive[disease] for disease in archive.files}
@@ -30,13 +30,15 @@
 #     def get_patient_name(self, obj):
 #         return f"{obj.patient.first_name} {obj.patient.last_name}"
 from rest_framework import serializers
-from .models import PredictionResult
+from .models import PredictionJob, PredictionResult
 from dashboard.models import Patient
 
 
 class XrayPredictionSerializer(serializers.Serializer):
     patient_id = serializers.IntegerField()
     xray_image = serializers.ImageField()
+    # Appointment the X-ray was taken for; emergency ones get priority
+    appointment_id = serializers.IntegerField(required=False)
 
     def validate_patient_id(self, value):
         try:
@@ -48,15 +50,42 @@ class XrayPredictionSerializer(serializers.Serializer):
 
 class PredictionResultSerializer(serializers.ModelSerializer):
     patient_name = serializers.SerializerMethodField()
+    gradcam_diseases = serializers.SerializerMethodField()
 
     class Meta:
         model = PredictionResult
         fields = [
             'id', 'patient', 'patient_name', 'xray_image', 'gradcam_image',  # Added gradcam_image
             'predicted_disease', 'confidence_score', 'all_predictions',
-            'created_at', 'reviewed_by_doctor', 'doctor_confirmed'
+            'created_at', 'reviewed_by_doctor', 'doctor_confirmed',
+            'gradcam_diseases', 'gradcam_status', 'heatmap_diseases'
         ]
-        read_only_fields = ['id', 'created_at']
+        read_only_fields = ['id', 'created_at', 'gradcam_status', 'heatmap_diseases']
 
     def get_patient_name(self, obj):
         return f"{obj.patient.first_name} {obj.patient.last_name}"
+
+    def get_gradcam_diseases(self, obj):
+        """Diseases that already have a stored Grad-CAM (list views prefetch gradcams)"""
+        diseases = [gradcam.disease for gradcam in obj.gradcams.all()]
+        if obj.gradcam_image and obj.predicted_disease:
+            diseases.insert(0, obj.predicted_disease)
+        return diseases
+
+
+class PredictionJobSerializer(serializers.ModelSerializer):
+    prediction = serializers.SerializerMethodField()
+
+    class Meta:
+        model = PredictionJob
+        fields = [
+            'id', 'status', 'stage', 'progress', 'error', 'attempts',
+            'created_at', 'started_at', 'finished_at', 'prediction'
+        ]
+        read_only_fields = fields
+
+    def get_prediction(self, obj):
+        """The finished PredictionResult once the job has succeeded"""
+        if obj.status != 'succeeded' or obj.prediction is None:
+            return None
+        return PredictionResultSerializer(obj.prediction).data
@@ -0,0 +1,220 @@
+# ml_predict/shm_transport.py
+"""
+Zero-copy handoff of preprocessed model inputs to the inference daemon.
+
+The daemon creates a ring of fixed-size slots in one shared-memory segment.
+A web worker claims a free slot, writes its float32 tensors straight into
+it and sends only the slot index, shapes and offsets over the socket; the
+daemon reads them in place as NumPy views.
+
+Slot lifecycle: free -> claimed (the worker holds an flock on the slot's
+lock file) -> written -> read by the daemon while the worker waits for the
+reply -> released by the worker. Locks are dropped by the kernel if a
+worker dies, so a crashed request can't leak a slot. When every slot is
+claimed, acquire() waits up to a timeout and then raises RingFull.
+"""
+import os
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ALIGNMENT = 64
+
+
+class RingFull(Exception):
+    """Every shared-memory slot stayed in use for the whole acquire timeout"""
+
+
+def _aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def slot_size(shapes):
+    """Bytes a slot needs to hold float32 tensors of the given shapes"""
+    return sum(_aligned(int(np.prod(shape)) * 4) for shape in shapes)
+
+
+class SharedTensorRing:
+    """Ring of reusable shared-memory slots for float32 model inputs"""
+
+    def __init__(self, name, slots, slot_bytes, lock_prefix, create=False, token=None,
+                 untrack=True):
+        self.name = name
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.lock_prefix = lock_prefix
+        self.owner = create
+        # Identifies this segment; a restarted daemon creates a new one under
+        # the same name, and readers reject slots written to the old one
+        self.token = token or (os.urandom(8).hex() if create else None)
+        self._shm = self._open(create, untrack)
+        self._local_locks = [threading.Lock() for _ in range(slots)]
+        self._lock_fds = [None] * slots
+        self._next = 0
+        self._counters = {
+            'acquired': 0,
+            'waits': 0,
+            'full': 0,
+            'wait_ms_total': 0.0,
+        }
+        self._counter_lock = threading.Lock()
+
+    def _open(self, create, untrack):
+        size = self.slots * self.slot_bytes
+        if not create:
+            shm = shared_memory.SharedMemory(name=self.name)
+            if not untrack:
+                return shm
+            # Before Python 3.13 attaching registers the segment with this
+            # process's resource tracker, which would unlink it on exit.
+            # Children of the creating process share its tracker, so they
+            # pass untrack=False instead.
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+            return shm
+
+        try:
+            return shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a daemon that didn't shut down cleanly
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.close()
+            stale.unlink()
+            return shared_memory.SharedMemory(name=self.name, create=True, size=size)
+
+    def describe(self):
+        """What a client needs to attach to this ring"""
+        return {
+            'name': self.name,
+            'slots': self.slots,
+            'slot_bytes': self.slot_bytes,
+            'lock_prefix': self.lock_prefix,
+            'token': self.token,
+        }
+
+    def _lock_fd(self, index):
+        fd = self._lock_fds[index]
+        if fd is None:
+            fd = self._lock_fds[index] = os.open(
+                f"{self.lock_prefix}.slot{index}.lock", os.O_RDWR | os.O_CREAT, 0o660)
+        return fd
+
+    def _try_claim(self, index):
+        # The thread lock keeps threads of this process apart; the flock
+        # keeps processes apart
+        if not self._local_locks[index].acquire(blocking=False):
+            return False
+        try:
+            fcntl.flock(self._lock_fd(index), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._local_locks[index].release()
+            return False
+
+    def acquire(self, timeout=5.0):
+        """Claim a free slot, waiting up to timeout seconds; returns its index"""
+        started = time.perf_counter()
+        delay = 0.0005
+        waited = False
+        while True:
+            start = self._next
+            for step in range(self.slots):
+                index = (start + step) % self.slots
+                if self._try_claim(index):
+                    self._next = (index + 1) % self.slots
+                    wait_ms = (time.perf_counter() - started) * 1000
+                    with self._counter_lock:
+                        self._counters['acquired'] += 1
+                        self._counters['waits'] += int(waited)
+                        self._counters['wait_ms_total'] += wait_ms
+                    return index
+
+            if time.perf_counter() - started >= timeout:
+                with self._counter_lock:
+                    self._counters['full'] += 1
+                raise RingFull(f"All {self.slots} shared-memory slots are in use")
+            waited = True
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+
+    def release(self, index):
+        fcntl.flock(self._lock_fd(index), fcntl.LOCK_UN)
+        self._local_locks[index].release()
+
+    @contextmanager
+    def slot(self, timeout=5.0):
+        index = self.acquire(timeout)
+        try:
+            yield index
+        finally:
+            self.release(index)
+
+    def layout(self, shapes):
+        """Byte offsets for float32 tensors of the given shapes, or None if they don't fit"""
+        if slot_size(shapes) > self.slot_bytes:
+            return None
+        layout = []
+        offset = 0
+        for shape in shapes:
+            layout.append([[int(size) for size in shape], offset])
+            offset += _aligned(int(np.prod(shape)) * 4)
+        return layout
+
+    def views(self, index, layout):
+        """float32 arrays backed by the slot's memory (no copy)"""
+        base = index * self.slot_bytes
+        return [
+            np.ndarray(tuple(shape), dtype=np.float32,
+                       buffer=self._shm.buf, offset=base + offset)
+            for shape, offset in layout
+        ]
+
+    @classmethod
+    def attach(cls, description, untrack=True):
+        """Open a ring created by another process from its describe() output"""
+        return cls(description['name'], description['slots'], description['slot_bytes'],
+                   description['lock_prefix'], token=description['token'], untrack=untrack)
+
+    def write(self, index, tensors):
+        """Copy arrays into a slot; returns the layout to send to the reader"""
+        layout = self.layout([tensor.shape for tensor in tensors])
+        if layout is None:
+            raise ValueError("Tensors don't fit in a shared-memory slot")
+        for view, tensor in zip(self.views(index, layout), tensors):
+            view[...] = tensor
+        return layout
+
+    def stats(self):
+        with self._counter_lock:
+            counters = dict(self._counters)
+        counters['slots'] = self.slots
+        counters['slot_bytes'] = self.slot_bytes
+        return counters
+
+    def close(self):
+        for fd in self._lock_fds:
+            if fd is not None:
+                os.close(fd)
+        self._lock_fds = [None] * self.slots
+        try:
+            self._shm.close()
+        except BufferError:
+            # A request thread still holds a view; the mapping goes with the process
+            pass
+        if self.owner:
+            # The lock files stay: workers still holding them must keep
+            # agreeing with a restarted daemon on which slots are claimed
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,160 @@
+# ml_predict/single_flight.py
+"""
+Coalesce concurrent identical inference and Grad-CAM work.
+
+Requests for the same operation on the same X-ray content (and disease)
+share one computation: the first caller to claim the key does the work
+while the others wait for it to finish and then pick up what it stored
+(the Grad-CAM file, the Grad-CAM cache entry or the memoised prediction)
+instead of computing it again.
+
+Within a process the leader holds an Event the followers wait on. Across
+gunicorn workers the leader also holds a row in the InferenceLock table;
+the leader of another process polls until that row goes away. Rows older
+than ML_SINGLE_FLIGHT_LOCK_TTL_SECONDS belong to a worker that died and
+are taken over.
+"""
+import os
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+_flights = {}  # key -> Event set when this process's leader finishes
+_flights_lock = threading.Lock()
+_counters = {
+    'leaders': 0,
+    'local_followers': 0,
+    'remote_waits': 0,
+    'timeouts': 0,
+    'stale_locks': 0,
+    'lock_errors': 0,
+}
+_counters_lock = threading.Lock()
+
+
+class SingleFlightTimeout(Exception):
+    """The request computing the same result didn't finish in time"""
+
+
+def flight_key(operation, image_hash, *qualifiers):
+    """Key for an operation on an X-ray's content, e.g. ('gradcam', hash, 'pneumonia')"""
+    return ':'.join([operation, *[str(part) for part in qualifiers], image_hash])
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _try_lock(key, ttl):
+    """Insert the key's lock row; returns True if this process now holds it"""
+    from .models import InferenceLock
+    now = timezone.now()
+    # A row left behind by a worker that died
+    if InferenceLock.objects.filter(key=key, expires_at__lt=now).delete()[0]:
+        _count('stale_locks')
+        logger.warning(f"Took over expired single-flight lock {key}")
+    try:
+        with transaction.atomic():
+            InferenceLock.objects.create(
+                key=key, owner=_owner(), expires_at=now + timedelta(seconds=ttl))
+        return True
+    except IntegrityError:
+        return False
+
+
+def _unlock(key):
+    from .models import InferenceLock
+    try:
+        InferenceLock.objects.filter(key=key, owner=_owner()).delete()
+    except DatabaseError as e:
+        logger.error(f"Could not release single-flight lock {key}: {str(e)}")
+
+
+@contextmanager
+def claim(key, timeout=None):
+    """Become the one caller computing key, or wait for the one that is
+
+    Yields True to the leader, which holds the key until the block exits,
+    and False to a caller that waited for another request to finish; it
+    should look for that request's stored result before computing
+    anything itself (the leader may have failed). Raises
+    SingleFlightTimeout after waiting timeout seconds
+    (ML_SINGLE_FLIGHT_TIMEOUT_SECONDS by default).
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'ML_SINGLE_FLIGHT_TIMEOUT_SECONDS', 60)
+    deadline = time.monotonic() + timeout
+
+    with _flights_lock:
+        done = _flights.get(key)
+        if done is None:
+            done = _flights[key] = threading.Event()
+            local_leader = True
+        else:
+            local_leader = False
+
+    if not local_leader:
+        _count('local_followers')
+        if not done.wait(timeout):
+            _count('timeouts')
+            raise SingleFlightTimeout(f"Timed out waiting for {key}")
+        yield False
+        return
+
+    db_locked = False
+    try:
+        waited = False
+        if getattr(settings, 'ML_SINGLE_FLIGHT_DB', True):
+            ttl = getattr(settings, 'ML_SINGLE_FLIGHT_LOCK_TTL_SECONDS', 300)
+            delay = 0.05
+            try:
+                while not _try_lock(key, ttl):
+                    # Another worker is computing it
+                    if not waited:
+                        waited = True
+                        _count('remote_waits')
+                    if time.monotonic() + delay > deadline:
+                        _count('timeouts')
+                        raise SingleFlightTimeout(f"Timed out waiting for {key}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.5)
+                # Held even after waiting: the row is ours to delete
+                db_locked = True
+            except DatabaseError as e:
+                # No lock table (e.g. before migrating): coalesce in-process only
+                _count('lock_errors')
+                logger.error(f"Single-flight lock unavailable for {key}: {str(e)}")
+
+        if waited:
+            yield False
+        else:
+            _count('leaders')
+            yield True
+    finally:
+        if db_locked:
+            _unlock(key)
+        with _flights_lock:
+            _flights.pop(key, None)
+        done.set()
+
+
+def single_flight_stats():
+    with _counters_lock:
+        counters = dict(_counters)
+    with _flights_lock:
+        counters['in_flight'] = len(_flights)
+    return counters
@@ -1,3 +1,1631 @@
-from django.test import TestCase
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase, override_settings
+
+
+def _binary_model():
+    """Tiny stand-in for the single-sigmoid-output disease models"""
+    import tensorflow as tf
+    inputs = tf.keras.Input(shape=(32, 32, 3))
+    x = tf.keras.layers.Conv2D(4, 3, activation='relu', name='conv')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(1, activation='sigmoid')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def _softmax_model():
+    """Tiny stand-in for the two-class softmax disease models"""
+    import tensorflow as tf
+    return tf.keras.Sequential([
+        tf.keras.Input(shape=(16, 16, 1)),
+        tf.keras.layers.Conv2D(4, 3, activation='relu', name='conv'),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(2, activation='softmax'),
+    ])
+
+
+class BackendConformanceTests(SimpleTestCase):
+    """Every registered inference backend must behave like the Keras model it serves"""
+
+    # Largest acceptable difference from Keras, per backend spec
+    TOLERANCES = {
+        'keras': 1e-6,
+        'tf_function': 1e-6,
+        'xla': 1e-5,
+        'tflite:float32': 1e-5,
+        'tflite:float16': 1e-2,
+        'tflite:int8': 5e-2,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from ml_predict.tflite import VARIANTS, convert
+
+        cls.model_dir = tempfile.mkdtemp(prefix='chestcare-backends-')
+        cls.settings_override = override_settings(ML_PREDICT_PATH=cls.model_dir)
+        cls.settings_override.enable()
+
+        cls.models = {}
+        for name, build in (('binary', _binary_model), ('softmax', _softmax_model)):
+            model = build()
+            model_path = os.path.join(cls.model_dir, f"{name}_model.keras")
+            model.save(model_path)
+            for variant in VARIANTS:
+                with open(os.path.join(cls.model_dir, f"{name}_model.{variant}.tflite"),
+                          'wb') as f:
+                    f.write(convert(model, variant))
+            cls.models[name] = (model, model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.model_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def specs(self):
+        from ml_predict.backends import BACKENDS
+        from ml_predict.tflite import VARIANTS
+        for name in BACKENDS:
+            if name == 'tflite':
+                for variant in VARIANTS:
+                    yield f"tflite:{variant}"
+            else:
+                yield name
+
+    def test_every_backend_has_a_tolerance(self):
+        self.assertEqual(set(self.specs()), set(self.TOLERANCES))
+
+    def test_predictions_match_keras(self):
+        from ml_predict.backends import create_backend
+        rng = np.random.default_rng(0)
+        for spec in self.specs():
+            for name, (model, model_path) in self.models.items():
+                with self.subTest(spec=spec, model=name):
+                    backend = create_backend(spec, model, model_path)
+                    self.assertEqual(backend.spec, spec)
+                    self.assertEqual(backend.input_shape, model.input_shape)
+                    for batch_size in (1, 3):
+                        batch = rng.random(
+                            (batch_size,) + model.input_shape[1:], dtype=np.float32)
+                        expected = model(batch, training=False).numpy()
+                        outputs = backend.predict_batch(batch)
+                        self.assertIsInstance(outputs, np.ndarray)
+                        self.assertEqual(outputs.shape, expected.shape)
+                        self.assertEqual(outputs.dtype, np.float32)
+                        np.testing.assert_allclose(
+                            outputs, expected, atol=self.TOLERANCES[spec])
+
+    def test_memory_report_and_version(self):
+        from ml_predict.backends import create_backend
+        model, model_path = self.models['binary']
+        for spec in self.specs():
+            with self.subTest(spec=spec):
+                backend = create_backend(spec, model, model_path)
+                report = backend.memory_report()
+                self.assertEqual(report['backend'], spec)
+                self.assertGreater(report['parameters'], 0)
+                self.assertGreater(report['weight_bytes'], 0)
+                self.assertTrue(backend.version('abc'))
+
+    def test_shared_gradcam_pass_matches_predictions(self):
+        from ml_predict.backends import create_backend
+        from ml_predict.utils import GradCAMGenerator
+        batch = np.random.default_rng(1).random((1, 32, 32, 3), dtype=np.float32)
+        model, model_path = self.models['binary']
+        generator = GradCAMGenerator(model)
+        for spec in self.specs():
+            backend = create_backend(spec, model, model_path)
+            with self.subTest(spec=spec):
+                if backend.shares_gradcam_pass:
+                    self.assertTrue(backend.supports_gradcam)
+                    predictions, heatmap = generator.explain(batch)
+                    self.assertIsNotNone(heatmap)
+                    np.testing.assert_array_equal(
+                        predictions, backend.predict_batch(batch))
+
+    def test_xla_pads_to_precompiled_buckets(self):
+        from ml_predict.backends import create_backend
+        model, model_path = self.models['softmax']
+        with self.settings(ML_XLA_BATCH_BUCKETS=(1, 4)):
+            backend = create_backend('xla', model, model_path)
+        self.assertEqual(set(backend.compile_ms), {1, 4})
+
+        batch = np.random.default_rng(2).random((6, 16, 16, 1), dtype=np.float32)
+        expected = model(batch, training=False).numpy()
+        for size in (1, 3, 6):
+            np.testing.assert_allclose(
+                backend.predict_batch(batch[:size]), expected[:size],
+                atol=self.TOLERANCES['xla'])
+
+        stats = backend.stats()
+        # 1 -> 1; 3 -> 4 (one padded row); 6 -> 4 + 2 -> 4 (two padded rows)
+        self.assertEqual(stats['bucket_hits'], {'1': 1, '4': 3})
+        self.assertEqual(stats['padded_rows'], 3)
+        self.assertEqual(stats['split_batches'], 1)
+
+    def test_unavailable_backends(self):
+        from ml_predict.backends import BackendUnavailable, create_backend
+        model, model_path = self.models['binary']
+        missing_path = os.path.join(self.model_dir, 'missing_model.keras')
+        for spec, path in (('tflite:float32', missing_path),
+                           ('tflite:int4', model_path),
+                           ('onnx', model_path)):
+            with self.subTest(spec=spec):
+                with self.assertRaises(BackendUnavailable):
+                    create_backend(spec, model, path)
+
+    def test_predictor_serves_diseases_with_configured_backends(self):
+        from ml_predict.utils import ChestXrayPredictor
+
+        model_files = {
+            'cardiomegaly': 'binary_model.keras',
+            'tuberculosis': 'softmax_model.keras',
+        }
+        with override_settings(
+                ML_INFERENCE_BACKEND='keras',
+                ML_INFERENCE_BACKENDS={'tuberculosis': 'tflite:float32'},
+                ML_LOAD_WORKERS=1,
+                ML_FUSED_INFERENCE=False,
+                ML_GRADCAM_CACHE_ENABLED=False), \
+                mock.patch.object(ChestXrayPredictor, 'MODEL_FILES', model_files):
+            predictor = ChestXrayPredictor()
+
+        self.assertEqual(
+            {disease: backend.spec for disease, backend in predictor.backends.items()},
+            {'cardiomegaly': 'keras', 'tuberculosis': 'tflite:float32'})
+        self.assertEqual(predictor.model_status['tuberculosis']['backend'], 'tflite:float32')
+        self.assertIn('flatbuffer_bytes', predictor.model_status['tuberculosis']['memory'])
+
+    def test_export_tflite_writes_variants_and_recommends_one(self):
+        from io import StringIO
+        from PIL import Image
+        from django.core.management import CommandError, call_command
+        from ml_predict.utils import ChestXrayPredictor
+
+        export_dir = tempfile.mkdtemp(prefix='chestcare-export-')
+        self.addCleanup(shutil.rmtree, export_dir, ignore_errors=True)
+        shutil.copy(self.models['binary'][1], export_dir)
+        validation_dir = os.path.join(export_dir, 'validation')
+        os.mkdir(validation_dir)
+        Image.new('RGB', (40, 40), (120, 80, 40)).save(os.path.join(validation_dir, 'a.png'))
+
+        out = StringIO()
+        with self.settings(ML_PREDICT_PATH=export_dir), \
+                mock.patch.object(ChestXrayPredictor, 'MODEL_FILES', {
+                    'cardiomegaly': 'binary_model.keras',
+                    'pneumonia': 'missing_model.keras'}):
+            call_command('export_tflite', '--variants', 'float32', 'float16',
+                         '--validation-dir', validation_dir, '--iterations', '1',
+                         '--warmup', '0', '--tolerance', '0.05', stdout=out, stderr=StringIO())
+            with self.assertRaises(CommandError):
+                call_command('export_tflite', '--variants', 'int4', stdout=StringIO())
+
+        self.assertEqual(
+            sorted(name for name in os.listdir(export_dir) if name.endswith('.tflite')),
+            ['binary_model.float16.tflite', 'binary_model.float32.tflite'])
+        self.assertRegex(out.getvalue(), r'ML_INFERENCE_BACKENDS=cardiomegaly=tflite:float(16|32)')
+
+
+class PredictorTests(SimpleTestCase):
+    """ChestXrayPredictor over tiny saved models: preprocessing, inference
+    and Grad-CAMs"""
+
+    @staticmethod
+    def _rgb_softmax_model():
+        import tensorflow as tf
+        return tf.keras.Sequential([
+            tf.keras.Input(shape=(24, 24, 3)),
+            tf.keras.layers.Conv2D(4, 3, activation='relu', name='conv'),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(2, activation='softmax'),
+        ])
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from PIL import Image
+
+        cls.model_dir = tempfile.mkdtemp(prefix='chestcare-predictor-')
+        # Two models share the 32x32 input; tuberculosis has its own
+        cls.model_files = {
+            'cardiomegaly': 'cardiomegaly_model.keras',
+            'pneumonia': 'pneumonia_model.keras',
+            'tuberculosis': 'tuberculosis_model.keras',
+        }
+        builders = {
+            'cardiomegaly': _binary_model,
+            'pneumonia': _binary_model,
+            'tuberculosis': cls._rgb_softmax_model,
+        }
+        for disease, model_file in cls.model_files.items():
+            builders[disease]().save(os.path.join(cls.model_dir, model_file))
+
+        cls.image_path = os.path.join(cls.model_dir, 'xray.png')
+        pixels = np.random.default_rng(4).integers(0, 256, (64, 48), dtype=np.uint8)
+        Image.fromarray(pixels).save(cls.image_path)
+        cls.predictor = cls.build_predictor()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    @classmethod
+    def build_predictor(cls, **overrides):
+        from ml_predict.utils import ChestXrayPredictor
+        options = {
+            'ML_PREDICT_PATH': cls.model_dir,
+            'ML_INFERENCE_BACKEND': 'keras',
+            'ML_INFERENCE_BACKENDS': {},
+            'ML_FUSED_INFERENCE': False,
+            'ML_SHARE_BACKBONES': False,
+            'ML_GRADCAM_CACHE_ENABLED': False,
+            **overrides,
+        }
+        with override_settings(**options), \
+                mock.patch.object(ChestXrayPredictor, 'MODEL_FILES', cls.model_files):
+            return ChestXrayPredictor()
+
+    def test_image_is_decoded_once_and_resized_per_input_shape(self):
+        from ml_predict import preprocessing
+        with mock.patch.object(preprocessing, 'load_image',
+                               wraps=preprocessing.load_image) as load_image, \
+                mock.patch.object(preprocessing, 'resize_for_shape',
+                                  wraps=preprocessing.resize_for_shape) as resize:
+            result = self.predictor.predict(self.image_path)
+        self.assertEqual(load_image.call_count, 1)
+        self.assertEqual(
+            sorted(call.args[1] for call in resize.call_args_list),
+            [(24, 24, 3), (32, 32, 3)])
+
+        image = preprocessing.load_image(self.image_path)
+        for disease, model in self.predictor.models.items():
+            batch = preprocessing.resize_for_shape(image, model.input_shape[1:])
+            expected = self.predictor._extract_confidence(
+                disease, model(batch, training=False).numpy())
+            self.assertAlmostEqual(result['all_predictions'][disease], expected, places=5)
+
+    def test_fused_graph_matches_the_per_model_loop(self):
+        predictor = self.build_predictor(ML_FUSED_INFERENCE=True)
+        self.assertIsNotNone(predictor.fused_fn)
+        self.assertEqual(sorted(predictor.fused_diseases), sorted(self.model_files))
+        # Same-shape models share one graph input
+        self.assertEqual(sorted(predictor.fused_shapes), [(24, 24, 3), (32, 32, 3)])
+
+        inputs = predictor.preprocess_for_models(predictor.load_image(self.image_path))
+        fused = predictor.run_models(inputs)
+        separate = predictor.run_models(inputs, use_fused=False)
+        self.assertEqual(list(fused), list(separate))
+        for disease in fused:
+            np.testing.assert_allclose(fused[disease], separate[disease], atol=1e-6)
+        self.assertEqual(predictor.fused_fn.experimental_get_tracing_count(), 1)
+
+    def test_fused_graph_covers_the_models_left_resident(self):
+        from ml_predict.model_manager import ModelManager
+        loaded = ModelManager.loaded
+
+        # A budget that fits one model evicts the others at boot
+        with mock.patch.object(ModelManager, 'loaded',
+                               lambda manager, disease, size: loaded(manager, disease, 600 * 1024)):
+            predictor = self.build_predictor(ML_FUSED_INFERENCE=True, ML_MODEL_MEMORY_BUDGET_MB=1)
+            self.assertEqual(len(predictor.models), 1)
+            self.assertIsNotNone(predictor.fused_fn)
+            self.assertEqual(predictor.fused_diseases, list(predictor.models))
+
+            # Reloaded models join the graph for the request using them, and
+            # it's rebuilt over the resident one once they're evicted again
+            inputs = predictor.preprocess_for_models(predictor.load_image(self.image_path))
+            with self.settings(ML_PREDICT_PATH=self.model_dir, ML_FUSED_INFERENCE=True,
+                               ML_SHARE_BACKBONES=False), \
+                    predictor.model_manager.use(predictor.available_diseases):
+                self.assertEqual(sorted(predictor.fused_diseases), sorted(self.model_files))
+                fused = predictor.run_models(inputs)
+                separate = predictor.run_models(inputs, use_fused=False)
+            self.assertEqual(sorted(fused), sorted(self.model_files))
+            for disease in fused:
+                np.testing.assert_allclose(fused[disease], separate[disease], atol=1e-6)
+            self.assertEqual(len(predictor.models), 1)
+            self.assertEqual(predictor.fused_diseases, list(predictor.models))
+
+    def test_gradcam_step_is_built_and_traced_once(self):
+        generator = self.predictor.gradcam_generators['cardiomegaly']
+        gradcam_fn = generator._get_gradcam_fn(generator.layer_name)
+        rng = np.random.default_rng(5)
+        for _ in range(3):
+            heatmap = generator.generate_gradcam(
+                rng.random((32, 32, 3), dtype=np.float32))
+            self.assertEqual(heatmap.shape, (30, 30))
+            self.assertGreaterEqual(heatmap.min(), 0)
+            self.assertLessEqual(heatmap.max(), 1)
+        self.assertIs(generator._get_gradcam_fn(generator.layer_name), gradcam_fn)
+        self.assertEqual(list(generator._grad_models), [generator.layer_name])
+        # Traced during warm-up only
+        self.assertEqual(gradcam_fn.experimental_get_tracing_count(), 1)
+
+        # The Sequential model gets its gradient model replayed on a new input
+        generator = self.predictor.gradcam_generators['tuberculosis']
+        heatmap = generator.generate_gradcam(
+            rng.random((1, 24, 24, 3), dtype=np.float32), class_index=1)
+        self.assertEqual(heatmap.shape, (22, 22))
+
+    def test_primary_gradcam_comes_from_the_prediction_pass(self):
+        expected = self.predictor.predict(self.image_path)
+        backend_class = type(self.predictor.backends['cardiomegaly'])
+        with mock.patch.object(backend_class, 'predict_batch') as predict_batch:
+            result, gradcam_files = self.predictor.predict_and_explain(self.image_path)
+        # Keras-served models share the Grad-CAM step's forward pass
+        predict_batch.assert_not_called()
+
+        self.assertEqual(result['predicted_disease'], expected['predicted_disease'])
+        for disease, confidence in expected['all_predictions'].items():
+            self.assertAlmostEqual(result['all_predictions'][disease], confidence, places=5)
+        self.assertEqual(list(gradcam_files), [expected['predicted_disease']])
+        gradcam = gradcam_files[expected['predicted_disease']]
+        self.assertTrue(gradcam.name.startswith('gradcam_'))
+        self.assertIsNotNone(gradcam.heatmap)
+
+    def test_gradcams_for_every_disease_above_the_threshold(self):
+        from ml_predict import preprocessing
+        result, gradcam_files = self.predictor.predict_and_explain(
+            self.image_path, secondary_threshold=0.0)
+        self.assertEqual(sorted(gradcam_files), sorted(result['all_predictions']))
+
+        result, gradcam_files = self.predictor.predict_and_explain(
+            self.image_path, secondary_threshold=1.0)
+        self.assertEqual(list(gradcam_files), [result['predicted_disease']])
+
+        # Several diseases on request: one decode, every one rendered
+        with mock.patch.object(preprocessing, 'load_image',
+                               wraps=preprocessing.load_image) as load_image:
+            gradcam_files = self.predictor.generate_gradcams(
+                self.image_path, ['pneumonia', 'tuberculosis', 'unknown'])
+        self.assertEqual(load_image.call_count, 1)
+        self.assertEqual(sorted(gradcam_files), ['pneumonia', 'tuberculosis'])
+
+    def test_cached_gradcams_keep_their_heatmaps(self):
+        media_root = tempfile.mkdtemp(prefix='chestcare-predictor-media-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        with self.settings(MEDIA_ROOT=media_root, ML_GRADCAM_CACHE_ENABLED=True), \
+                mock.patch('ml_predict.gradcam_cache._cache', None):
+            generated = self.predictor.generate_gradcams(self.image_path, ['pneumonia'])
+            with mock.patch.object(self.predictor, '_compute_heatmaps') as compute:
+                cached = self.predictor.generate_gradcams(self.image_path, ['pneumonia'])
+            compute.assert_not_called()
+        self.assertEqual(cached['pneumonia'].read(), generated['pneumonia'].read())
+        np.testing.assert_array_equal(cached['pneumonia'].heatmap, generated['pneumonia'].heatmap)
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    """Concurrent predictions share forward passes; a full queue is rejected"""
+
+    class Predictor:
+        def __init__(self):
+            self.batch_sizes = []
+            self.started = threading.Event()
+            self.release = threading.Event()
+            self.release.set()
+
+        def run_models(self, inputs):
+            self.started.set()
+            self.release.wait(5)
+            batch = inputs[(1,)]
+            self.batch_sizes.append(len(batch))
+            return {'pneumonia': batch * 2}
+
+        def summarise_outputs(self, outputs):
+            return {'confidence_score': float(outputs['pneumonia'][0, 0])}
+
+    @staticmethod
+    def inputs(value):
+        return {(1,): np.array([[value]], dtype=np.float32)}
+
+    def test_concurrent_requests_are_coalesced(self):
+        from ml_predict.batching import BatchScheduler
+        predictor = self.Predictor()
+        scheduler = BatchScheduler(predictor, max_batch_size=4, max_wait_ms=2000)
+        futures = [scheduler.submit(None, inputs=self.inputs(value)) for value in range(4)]
+
+        # Each request gets its own row of the batched outputs
+        self.assertEqual([future.result(5)['confidence_score'] for future in futures],
+                         [0.0, 2.0, 4.0, 6.0])
+        self.assertEqual(predictor.batch_sizes, [4])
+        stats = scheduler.stats()
+        self.assertEqual((stats['requests'], stats['batches']), (4, 1))
+        self.assertEqual(stats['mean_batch_size'], 4.0)
+
+    def test_full_queue_raises_scheduler_busy(self):
+        from ml_predict.batching import BatchScheduler, SchedulerBusy
+        predictor = self.Predictor()
+        predictor.release.clear()
+        scheduler = BatchScheduler(
+            predictor, max_batch_size=1, max_wait_ms=0, max_queue_depth=1)
+        running = scheduler.submit(None, inputs=self.inputs(1))
+        predictor.started.wait(5)
+        queued = scheduler.submit(None, inputs=self.inputs(2))
+        with self.assertRaises(SchedulerBusy):
+            scheduler.submit(None, inputs=self.inputs(3))
+
+        predictor.release.set()
+        self.assertEqual(running.result(5)['confidence_score'], 2.0)
+        self.assertEqual(queued.result(5)['confidence_score'], 4.0)
+        self.assertEqual(scheduler.stats()['rejected'], 1)
+
+
+class ModelLoadingTests(SimpleTestCase):
+    """The predictor is built lazily and its models load concurrently"""
+
+    def test_startup_does_not_import_tensorflow_or_opencv(self):
+        import subprocess
+        import sys
+        from django.conf import settings
+        script = (
+            "import sys, django; django.setup(); "
+            "from django.urls import resolve; resolve('/api/ml/predict/'); "
+            "import ml_predict.views, ml_predict.inference; "
+            "print('tensorflow' in sys.modules, 'cv2' in sys.modules, "
+            "ml_predict.inference.predictor_loaded())")
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='ChestCare.settings')
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=str(settings.BASE_DIR), env=env,
+            capture_output=True, text=True, timeout=120, check=True).stdout
+        self.assertEqual(output.split()[-3:], ['False', 'False', 'False'])
+
+    def test_predictor_is_created_once_on_first_use(self):
+        from ml_predict import inference
+        predictor = mock.Mock()
+        predictor.wait_until_ready.return_value = 'ready'
+        with mock.patch.object(inference, '_predictor', None), \
+                mock.patch('ml_predict.utils.ChestXrayPredictor',
+                           return_value=predictor) as predictor_class, \
+                self.settings(ML_INFERENCE_SOCKET=''):
+            self.assertEqual(inference.predictor_readiness()['status'], 'not_loaded')
+            threads = [threading.Thread(target=inference.get_predictor) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            self.assertIs(inference.get_predictor(), predictor)
+        # Loading runs in the background; callers wait until it can serve
+        predictor_class.assert_called_once_with(wait=False)
+        self.assertEqual(predictor.wait_until_ready.call_count, 5)
+
+    def test_models_load_concurrently_and_report_readiness(self):
+        import tensorflow as tf
+        from ml_predict.utils import ChestXrayPredictor
+
+        model_dir = tempfile.mkdtemp(prefix='chestcare-loading-')
+        self.addCleanup(shutil.rmtree, model_dir, ignore_errors=True)
+        for name in ('cardiomegaly', 'pneumonia'):
+            _binary_model().save(os.path.join(model_dir, f'{name}_model.keras'))
+        model_files = {
+            'cardiomegaly': 'cardiomegaly_model.keras',
+            'pneumonia': 'pneumonia_model.keras',
+            'tuberculosis': 'tuberculosis_model.keras',  # Not deployed
+        }
+
+        load_model = tf.keras.models.load_model
+        active = []
+        overlap = threading.Event()
+
+        def slow_load(path, *args, **kwargs):
+            active.append(path)
+            if len(active) > 1:
+                overlap.set()
+            overlap.wait(2)
+            try:
+                return load_model(path, *args, **kwargs)
+            finally:
+                active.remove(path)
+
+        with override_settings(
+                ML_PREDICT_PATH=model_dir, ML_LOAD_WORKERS=2, ML_INFERENCE_BACKEND='keras',
+                ML_INFERENCE_BACKENDS={}, ML_FUSED_INFERENCE=False,
+                ML_SHARE_BACKBONES=False, ML_GRADCAM_CACHE_ENABLED=False), \
+                mock.patch.object(ChestXrayPredictor, 'MODEL_FILES', model_files), \
+                mock.patch.object(tf.keras.models, 'load_model', side_effect=slow_load):
+            predictor = ChestXrayPredictor(wait=False)
+            self.assertEqual(predictor.wait_until_ready(timeout=60, partial=False), 'partial')
+
+        # Both models were deserialised at the same time
+        self.assertTrue(overlap.is_set())
+        report = predictor.load_report()
+        self.assertTrue(report['loading_complete'])
+        self.assertEqual(
+            {disease: model['state'] for disease, model in report['models'].items()},
+            {'cardiomegaly': 'ready', 'pneumonia': 'ready', 'tuberculosis': 'missing'})
+        self.assertGreater(report['models']['pneumonia']['warmup_ms'], 0)
+        self.assertEqual(predictor.available_diseases, ['cardiomegaly', 'pneumonia'])
+
+
+class SharedBackboneTests(SimpleTestCase):
+    """Models built on the same frozen base run it once; anything else stays separate"""
+
+    @staticmethod
+    def _transfer_model(backbone, units):
+        import tensorflow as tf
+        inputs = tf.keras.Input(shape=(32, 32, 3))
+        x = backbone(inputs)
+        x = tf.keras.layers.GlobalAveragePooling2D()(x)
+        outputs = tf.keras.layers.Dense(units, activation='softmax' if units > 1 else 'sigmoid')(x)
+        return tf.keras.Model(inputs, outputs)
+
+    @staticmethod
+    def _backbone():
+        import tensorflow as tf
+        inputs = tf.keras.Input(shape=(32, 32, 3))
+        x = tf.keras.layers.Conv2D(4, 3, activation='relu')(inputs)
+        backbone = tf.keras.Model(inputs, x, name='base')
+        backbone.trainable = False
+        return backbone
+
+    def _copy_of(self, backbone, scale=1.0):
+        copy = self._backbone()
+        copy.set_weights([weight * scale for weight in backbone.get_weights()])
+        return copy
+
+    def test_identical_backbones_are_shared(self):
+        from ml_predict.backbone_sharing import find_shared_backbones
+        backbone = self._backbone()
+        models = {
+            'cardiomegaly': self._transfer_model(backbone, 1),
+            # Built separately, as after loading from its own file
+            'pneumonia': self._transfer_model(self._copy_of(backbone), 2),
+            'tuberculosis': _binary_model(),
+        }
+        groups = find_shared_backbones(models)
+        self.assertEqual([group.diseases for group in groups], [['cardiomegaly', 'pneumonia']])
+
+        group = groups[0]
+        self.assertGreater(group.flops_saved, 0)
+        self.assertEqual(group.flops_saved, group.backbone_flops)
+        batch = np.random.default_rng(3).random((3, 32, 32, 3), dtype=np.float32)
+        for disease, outputs in group.predict(batch).items():
+            np.testing.assert_allclose(
+                outputs, models[disease](batch, training=False).numpy(), atol=1e-6)
+
+    def test_different_weights_keep_separate_graphs(self):
+        from ml_predict.backbone_sharing import find_shared_backbones
+        backbone = self._backbone()
+        models = {
+            'cardiomegaly': self._transfer_model(backbone, 1),
+            'pneumonia': self._transfer_model(self._copy_of(backbone, scale=1.01), 1),
+        }
+        self.assertEqual(find_shared_backbones(models), [])
+
+
+class ModelManagerTests(SimpleTestCase):
+    """Budget and idle eviction, pinning and single-flight reloads"""
+
+    def setUp(self):
+        from ml_predict.model_manager import ModelManager
+        self.load_calls = []
+        self.unload_calls = []
+        self.release_load = threading.Event()
+        self.release_load.set()
+        self.manager = ModelManager(
+            load=self._load, unload=self.unload_calls.append,
+            budget_bytes=250, pinned=['cardiomegaly'])
+        for disease in ('cardiomegaly', 'pneumonia', 'tuberculosis'):
+            self.manager.loaded(disease, 100)
+
+    def _load(self, disease):
+        self.release_load.wait(5)
+        self.load_calls.append(disease)
+        self.manager.loaded(disease, 100)
+        return True
+
+    def resident(self):
+        return sorted(
+            disease for disease, model in self.manager.stats()['models'].items()
+            if model['resident'])
+
+    def test_least_recently_used_unpinned_model_is_evicted(self):
+        with self.manager.use(['tuberculosis']):
+            pass
+        self.manager.enforce_budget()
+        self.assertEqual(self.unload_calls, ['pneumonia'])
+        self.assertEqual(self.resident(), ['cardiomegaly', 'tuberculosis'])
+
+        # Reloading pneumonia makes room by evicting tuberculosis, not the pin
+        with self.manager.use(['pneumonia']):
+            self.assertEqual(self.resident(), ['cardiomegaly', 'pneumonia'])
+        stats = self.manager.stats()
+        self.assertEqual(self.load_calls, ['pneumonia'])
+        self.assertEqual(stats['budget_evictions'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertLessEqual(stats['resident_bytes'], 250)
+
+    def test_models_in_use_are_not_evicted(self):
+        with self.manager.use(['pneumonia', 'tuberculosis']):
+            self.manager.enforce_budget()
+            self.assertEqual(self.unload_calls, [])
+        self.assertEqual(len(self.unload_calls), 1)
+
+    def test_concurrent_reloads_are_coalesced(self):
+        self.manager.budget_bytes = 0
+        self.manager.idle_seconds = 0.01
+        time.sleep(0.02)
+        self.manager.evict_idle()
+        self.assertEqual(sorted(self.unload_calls), ['pneumonia', 'tuberculosis'])
+
+        def request():
+            with self.manager.use(['pneumonia']):
+                pass
+
+        self.release_load.clear()
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        self.release_load.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.load_calls, ['pneumonia'])
+        self.assertEqual(self.manager.stats()['coalesced'], 3)
+
+
+class GradCAMCacheTests(SimpleTestCase):
+    """The two-tier Grad-CAM cache: memory LRU, disk spill and invalidation"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chestcare-gradcam-cache-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def cache(self, max_memory_bytes=1024, max_disk_bytes=4096):
+        from ml_predict.gradcam_cache import GradCAMCache
+        return GradCAMCache(self.directory, max_memory_bytes, max_disk_bytes)
+
+    def test_key_addresses_content(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        key = GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv', 'jet:1024:png')
+        self.assertEqual(key.digest, GradCAMCacheKey(*key).digest)
+        for field, value in (('image_hash', 'other'), ('disease', 'tuberculosis'),
+                             ('model_version', 'v2'), ('layer_name', 'conv_2'),
+                             ('render', 'turbo:1024:png'), ('image_format', 'webp')):
+            with self.subTest(field=field):
+                self.assertNotEqual(key._replace(**{field: value}).digest, key.digest)
+        self.assertEqual(key.filename, f'pneumonia-v1-{key.digest[:32]}.png')
+
+    def test_memory_tier_is_least_recently_used(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        cache = self.cache(max_memory_bytes=250)
+        keys = [GradCAMCacheKey(f'img{index}', 'pneumonia', 'v1', 'conv') for index in range(3)]
+        cache.put(keys[0], b'0' * 100)
+        cache.put(keys[1], b'1' * 100)
+        self.assertEqual(cache.get(keys[0]), b'0' * 100)  # Now the most recent
+        cache.put(keys[2], b'2' * 100)
+
+        stats = cache.stats()
+        self.assertEqual((stats['memory_entries'], stats['memory_bytes']), (2, 200))
+        self.assertEqual(stats['memory_evictions'], 1)
+        self.assertEqual(stats['memory_hits'], 1)
+        # The evicted entry is still on disk
+        self.assertEqual(cache.get(keys[1]), b'1' * 100)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+    def test_disk_tier_is_shared_and_size_bounded(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        keys = [GradCAMCacheKey(f'img{index}', 'pneumonia', 'v1', 'conv') for index in range(3)]
+        writer = self.cache(max_disk_bytes=250)
+        writer.put(keys[0], b'0' * 100)
+        writer.put(keys[1], b'1' * 100)
+
+        # Another worker finds them on disk
+        reader = self.cache(max_disk_bytes=250)
+        self.assertEqual(reader.get(keys[0]), b'0' * 100)
+        self.assertIsNone(reader.get(GradCAMCacheKey('missing', 'pneumonia', 'v1', 'conv')))
+        stats = reader.stats()
+        self.assertEqual((stats['disk_hits'], stats['misses']), (1, 1))
+
+        # Over budget the least recently read file goes
+        os.utime(os.path.join(self.directory, keys[1].filename), (1, 1))
+        writer.put(keys[2], b'2' * 100)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), sorted([keys[0].filename, keys[2].filename]))
+        self.assertEqual(writer.stats()['disk_bytes'], 200)
+
+    def test_invalidate_drops_other_model_versions(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        cache = self.cache()
+        old = GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv')
+        current = GradCAMCacheKey('img', 'pneumonia', 'v2', 'conv')
+        other = GradCAMCacheKey('img', 'tuberculosis', 'v1', 'conv')
+        for key in (old, current, other):
+            cache.put(key, key.model_version.encode())
+
+        cache.invalidate('pneumonia', current_version='v2')
+        self.assertEqual(cache.stats()['invalidations'], 2)  # Memory and disk
+        self.assertIsNone(cache.get(old))
+        self.assertIsNone(self.cache().get(old))
+        self.assertEqual(cache.get(current), b'v2')
+        self.assertEqual(cache.get(other), b'v1')
+
+    def test_model_reload_keeps_overlays_rendered_from_heatmaps(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        cache = self.cache()
+        generated = GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv')
+        overlay = GradCAMCacheKey('img', 'pneumonia', '', 'heatmap', 'overlay:webp')
+        cache.put(generated, b'generated')
+        cache.put(overlay, b'overlay')
+
+        cache.invalidate('pneumonia', current_version='v2')
+        self.assertIsNone(cache.get(generated))
+        self.assertEqual(cache.get(overlay), b'overlay')
+        self.assertEqual(self.cache().get(overlay), b'overlay')
+
+    def test_entries_are_named_and_accounted_by_format(self):
+        from ml_predict.gradcam_cache import GradCAMCacheKey
+        cache = self.cache(max_disk_bytes=2500)
+        webp = GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv', 'jet', 'webp')
+        jpeg = GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv', 'jet', 'jpeg')
+        cache.put(webp, b'w' * 1000)
+        cache.put(jpeg, b'j' * 1000)
+        # Both are drawn from one heatmap
+        self.assertEqual(webp.heatmap_key, jpeg.heatmap_key)
+        cache.put(webp.heatmap_key, b'h' * 100)
+        self.assertEqual(
+            sorted(os.path.splitext(name)[1] for name in os.listdir(self.directory)),
+            ['.jpeg', '.npz', '.webp'])
+        self.assertEqual(cache.stats()['disk_bytes'], 2100)
+
+        # Over the disk budget the oldest entry goes, whatever its format
+        os.utime(os.path.join(self.directory, webp.filename), (1, 1))
+        cache.put(GradCAMCacheKey('img', 'pneumonia', 'v1', 'conv', 'jet'), b'p' * 1000)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, webp.filename)))
+        self.assertEqual(cache.stats()['disk_evictions'], 1)
+
+        cache.invalidate('pneumonia', current_version='v2')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class RenderingTests(SimpleTestCase):
+    """LUT overlays: colours, blending and the resolution cap"""
+
+    def test_lut_is_rgb_jet(self):
+        from ml_predict.rendering import colormap_lut
+        lut = colormap_lut('jet')
+        self.assertEqual((lut.shape, lut.dtype), ((256, 1, 3), np.uint8))
+        # Jet runs from dark blue to dark red
+        self.assertGreater(lut[0, 0, 2], lut[0, 0, 0])
+        self.assertGreater(lut[255, 0, 0], lut[255, 0, 2])
+        with self.assertRaises(ValueError):
+            colormap_lut('rainbow-ish')
+
+    def test_overlay_blends_and_caps_resolution(self):
+        from PIL import Image
+        from ml_predict.rendering import colormap_lut, prepare_base, render_overlay
+        image = Image.new('RGB', (300, 200), (100, 100, 100))
+        heatmap = np.ones((7, 7), dtype=np.float32)
+
+        with self.settings(ML_GRADCAM_MAX_RESOLUTION=150):
+            base = prepare_base(image)
+        self.assertEqual(base.shape, (100, 150, 3))
+
+        overlay = render_overlay(base, heatmap, alpha=0.4)
+        expected = np.rint(0.6 * 100 + 0.4 * colormap_lut('jet')[255, 0]).astype(int)
+        np.testing.assert_allclose(overlay[50, 75].astype(int), expected, atol=1)
+        self.assertEqual(prepare_base(image, max_size=0).shape, (200, 300, 3))
+
+    def test_format_is_negotiated_from_accept(self):
+        from ml_predict.rendering import negotiate_format
+        browser = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+        self.assertEqual(negotiate_format(browser), 'webp')
+        self.assertEqual(negotiate_format('*/*'), 'png')
+        self.assertEqual(negotiate_format('*/*', preferred='webp'), 'webp')
+        self.assertEqual(negotiate_format('image/png;q=0.5, image/jpeg'), 'jpeg')
+        self.assertEqual(negotiate_format('image/webp;q=0, image/*'), 'png')
+        self.assertEqual(negotiate_format('application/json'), 'png')
+        self.assertEqual(negotiate_format(None, preferred='jpeg'), 'jpeg')
+
+    def test_gradcams_are_encoded_in_the_configured_format(self):
+        from io import BytesIO
+        from PIL import Image
+        from ml_predict.rendering import encode_gradcam, format_for_name
+        overlay = np.full((32, 48, 3), 120, dtype=np.uint8)
+        with self.settings(ML_GRADCAM_FORMAT='webp'):
+            gradcam = encode_gradcam(overlay, 'gradcam_pneumonia')
+        self.assertEqual(gradcam.name, 'gradcam_pneumonia.webp')
+        self.assertEqual(Image.open(BytesIO(gradcam.read())).format, 'WEBP')
+        self.assertEqual(format_for_name('predictions/gradcam_1.jpg'), 'jpeg')
+        self.assertEqual(format_for_name(''), 'png')
+
+
+class InferenceServerTests(SimpleTestCase):
+    """The inference daemon's frame protocol and the RemotePredictor client"""
+
+    class Predictor:
+        models = {'pneumonia': None}
+        available_diseases = ['pneumonia']
+        model_set_version = 'v1'
+        shape_groups = {}
+
+        def load_report(self):
+            return {'status': 'ready'}
+
+        def predict(self, image_path, inputs=None):
+            from ml_predict.batching import SchedulerBusy
+            if image_path == 'broken.png':
+                raise ValueError('Cannot decode broken.png')
+            if image_path == 'busy.png':
+                raise SchedulerBusy('Prediction queue is full')
+            return {'predicted_disease': 'pneumonia', 'confidence_score': 0.9,
+                    'all_predictions': {'pneumonia': 0.9}}
+
+        def predict_and_explain(self, image_path, secondary_threshold=None, inputs=None):
+            from ml_predict.rendering import GradCAMFile
+            return self.predict(image_path), {
+                'pneumonia': GradCAMFile(b'png', name='gradcam_pneumonia.png')}
+
+    def start_server(self):
+        from ml_predict.inference_server import InferenceServer
+        directory = tempfile.mkdtemp(prefix='chestcare-daemon-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        socket_path = os.path.join(directory, 'inference.sock')
+        server = InferenceServer(socket_path, self.Predictor())
+        thread = threading.Thread(
+            target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, socket_path
+
+    def test_frames_round_trip_and_other_versions_are_rejected(self):
+        import socket
+        from ml_predict import inference_server as daemon
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+
+        daemon.send_frame(left, daemon.OP_PREDICT, {'image_path': 'x.png'}, [b'ab', b'cd'])
+        self.assertEqual(daemon.recv_frame(right),
+                         (daemon.OP_PREDICT, {'image_path': 'x.png'}, b'abcd'))
+
+        for header in (
+                daemon.HEADER.pack(daemon.MAGIC, daemon.PROTOCOL_VERSION + 1, 0, 0, 0),
+                daemon.HEADER.pack(b'XX', daemon.PROTOCOL_VERSION, 0, 0, 0),
+                daemon.HEADER.pack(daemon.MAGIC, daemon.PROTOCOL_VERSION, 0,
+                                   daemon.MAX_METADATA_BYTES + 1, 0)):
+            with self.subTest(header=header):
+                left.sendall(header)
+                with self.assertRaises(daemon.ProtocolError):
+                    daemon.recv_frame(right)
+        left.close()
+        self.assertIsNone(daemon.recv_frame(right))
+
+    def test_remote_predictor_runs_requests_in_the_daemon(self):
+        from ml_predict.batching import SchedulerBusy
+        from ml_predict.inference_server import (
+            DaemonUnavailable, InferenceClient, InferenceError, RemotePredictor)
+        server, socket_path = self.start_server()
+        client = InferenceClient(socket_path, timeout=5)
+        self.addCleanup(client.close)
+        local = mock.Mock()
+        remote = RemotePredictor(client, lambda: local)
+
+        self.assertTrue(remote.available())
+        self.assertEqual(remote.model_set_version, 'v1')
+        self.assertEqual(remote.predict('x.png')['predicted_disease'], 'pneumonia')
+        result, gradcam_files = remote.predict_and_explain('x.png')
+        self.assertEqual(gradcam_files['pneumonia'].read(), b'png')
+        # Errors in the daemon come back as errors, not a dropped connection
+        with self.assertRaisesMessage(InferenceError, 'Cannot decode broken.png'):
+            remote.predict('broken.png')
+        # A full queue in the daemon is busy, like a full queue in-process
+        with self.assertRaisesMessage(SchedulerBusy, 'Prediction queue is full'):
+            remote.predict('busy.png')
+        self.assertTrue(remote.available())
+        local.predict.assert_not_called()
+
+        # Without a daemon the in-process predictor takes over, if allowed
+        server.shutdown()
+        server.server_close()
+        client.close()
+        self.assertFalse(remote.available())
+        remote.predict('x.png')
+        local.predict.assert_called_once_with('x.png')
+        with self.assertRaises(DaemonUnavailable):
+            RemotePredictor(client, lambda: local, fallback=False).predict('x.png')
+
+    def test_heatmaps_cross_the_daemon_socket_with_their_gradcams(self):
+        from django.core.files.base import ContentFile
+        from ml_predict.inference_server import _pack_gradcams, _unpack_gradcams
+        from ml_predict.rendering import GradCAMFile
+        heatmap = np.linspace(0, 1, 49, dtype=np.float32).reshape(7, 7)
+        entries, chunks = _pack_gradcams({
+            'pneumonia': GradCAMFile(b'webp-1', name='gradcam_pneumonia.webp', heatmap=heatmap),
+            'tuberculosis': ContentFile(b'png-22', name='gradcam_tuberculosis.png'),
+        })
+        # Named by the format the daemon encoded in, not the client's setting
+        with self.settings(ML_GRADCAM_FORMAT='jpeg'):
+            files = _unpack_gradcams(entries, b''.join(chunks))
+        self.assertEqual(files['pneumonia'].name, 'gradcam_pneumonia.webp')
+        self.assertEqual(files['tuberculosis'].name, 'gradcam_tuberculosis.png')
+        self.assertEqual(files['pneumonia'].read(), b'webp-1')
+        np.testing.assert_allclose(files['pneumonia'].heatmap, heatmap, atol=1e-3)
+        self.assertEqual(files['tuberculosis'].read(), b'png-22')
+        self.assertIsNone(files['tuberculosis'].heatmap)
+
+
+class SharedTensorRingTests(SimpleTestCase):
+    """Shared-memory slots: claiming, zero-copy reads and stale segments"""
+
+    def ring(self, slots=2, slot_bytes=4096):
+        from ml_predict.shm_transport import SharedTensorRing
+        directory = tempfile.mkdtemp(prefix='chestcare-ring-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        ring = SharedTensorRing(
+            f'chestcare-test-{os.getpid()}-{id(directory)}', slots, slot_bytes,
+            os.path.join(directory, 'ring'), create=True)
+        self.addCleanup(ring.close)
+        return ring
+
+    def attach(self, ring):
+        from ml_predict.shm_transport import SharedTensorRing
+        # Same process as the creator, so it shares its resource tracker
+        attached = SharedTensorRing.attach(ring.describe(), untrack=False)
+        self.addCleanup(attached.close)
+        return attached
+
+    def test_slots_are_claimed_and_released_across_attachments(self):
+        from ml_predict.shm_transport import RingFull
+        ring = self.ring()
+        worker = self.attach(ring)
+        first = worker.acquire(timeout=0.1)
+        second = worker.acquire(timeout=0.1)
+        self.assertEqual(sorted([first, second]), [0, 1])
+        # The flocks keep other processes (here another attachment) out
+        with self.assertRaises(RingFull):
+            ring.acquire(timeout=0.05)
+        self.assertEqual(ring.stats()['full'], 1)
+
+        worker.release(first)
+        self.assertEqual(ring.acquire(timeout=0.1), first)
+        # A worker that dies drops its flocks with its file descriptors
+        worker.close()
+        with ring.slot(timeout=0.1) as index:
+            self.assertEqual(index, second)
+
+    def test_tensors_are_read_in_place(self):
+        ring = self.ring()
+        worker = self.attach(ring)
+        tensors = [np.full((1, 4, 4, 3), 0.5, dtype=np.float32),
+                   np.arange(6, dtype=np.float32).reshape(1, 2, 3)]
+        with worker.slot() as index:
+            layout = worker.write(index, tensors)
+            views = ring.views(index, layout)
+            for view, tensor in zip(views, tensors):
+                np.testing.assert_array_equal(view, tensor)
+            # Later writes show through the daemon's views: no copy
+            worker.views(index, layout)[1][0, 0, 0] = 42
+            self.assertEqual(views[1][0, 0, 0], 42)
+        self.assertIsNone(ring.layout([(1, 64, 64, 3)]))
+
+    def test_stale_ring_token_falls_back_to_the_image_path(self):
+        from ml_predict.inference_server import OP_PREDICT_TENSORS, InferenceServer
+        ring = self.ring()
+        directory = tempfile.mkdtemp(prefix='chestcare-daemon-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        predictor = InferenceServerTests.Predictor()
+        server = InferenceServer(os.path.join(directory, 'inference.sock'), predictor)
+        server.ring = ring
+        self.addCleanup(server.server_close)
+
+        with ring.slot() as index:
+            layout = ring.write(index, [np.ones((1, 2, 2, 3), dtype=np.float32)])
+            request = {'image_path': 'x.png', 'slot': index, 'layout': layout,
+                       'explain': False}
+            with mock.patch.object(predictor, 'predict', wraps=predictor.predict) as predict:
+                response, _ = server.dispatch(
+                    OP_PREDICT_TENSORS, dict(request, token=ring.token))
+                self.assertNotIn('ring_stale', response)
+                self.assertEqual(list(predict.call_args.kwargs['inputs']), [(2, 2, 3)])
+
+                # Written to the segment of a daemon that has since restarted
+                response, _ = server.dispatch(
+                    OP_PREDICT_TENSORS, dict(request, token='0' * 16))
+                self.assertTrue(response['ring_stale'])
+                self.assertIsNone(predict.call_args.kwargs['inputs'])
+
+    def test_client_reattaches_to_a_restarted_daemons_ring(self):
+        from ml_predict.inference_server import RemotePredictor
+        from ml_predict.shm_transport import SharedTensorRing
+        attach = SharedTensorRing.attach
+        remote = RemotePredictor(mock.Mock(), mock.Mock())
+        with mock.patch.object(SharedTensorRing, 'attach',
+                               side_effect=lambda description: attach(description, untrack=False)):
+            old = self.ring()
+            attached = remote._get_ring({'shm': old.describe()})
+            self.assertEqual(attached.token, old.token)
+            self.assertIs(remote._get_ring({'shm': old.describe()}), attached)
+
+            new = self.ring()
+            self.assertEqual(remote._get_ring({'shm': new.describe()}).token, new.token)
+        self.addCleanup(remote._ring.close)
+        self.assertIsNone(remote._get_ring({'shm': None}))
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    """Per-lane limits, priority hand-off and clean rejections"""
+
+    def setUp(self):
+        from ml_predict.admission import AdmissionController
+        self.controller = AdmissionController(
+            max_concurrent=1, lanes=[('urgent', 1, 2), ('routine', 1, 1)], queue_timeout=5)
+
+    def _waiter(self, lane, order):
+        def run():
+            with self.controller.admit(lane):
+                order.append(lane)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def _wait_until_queued(self, lane, count):
+        deadline = time.monotonic() + 5
+        while self.controller.stats()['lanes'][lane]['queued'] < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+
+    def test_urgent_waiter_goes_first(self):
+        order = []
+        with self.controller.admit('routine'):
+            threads = [self._waiter('routine', order)]
+            self._wait_until_queued('routine', 1)
+            threads.append(self._waiter('urgent', order))
+            self._wait_until_queued('urgent', 1)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['urgent', 'routine'])
+
+        stats = self.controller.stats()['lanes']
+        self.assertEqual(stats['routine']['admitted'], 2)
+        self.assertGreater(stats['routine']['max_wait_ms'], 0)
+        self.assertIsNotNone(stats['routine']['service_ms_ewma'])
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        from ml_predict.admission import AdmissionRejected
+        order = []
+        with self.controller.admit('routine'):
+            thread = self._waiter('routine', order)
+            self._wait_until_queued('routine', 1)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                self.controller.acquire('routine')
+        thread.join(5)
+        self.assertEqual(rejected.exception.lane, 'routine')
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        self.assertEqual(self.controller.stats()['lanes']['routine']['rejected_full'], 1)
+
+    def test_queue_wait_times_out(self):
+        from ml_predict.admission import AdmissionRejected
+        self.controller.queue_timeout = 0.05
+        with self.controller.admit('urgent'):
+            with self.assertRaises(AdmissionRejected):
+                self.controller.acquire('routine')
+        self.assertEqual(self.controller.stats()['lanes']['routine']['rejected_timeout'], 1)
+        self.assertEqual(self.controller.stats()['running'], 0)
+
+
+class RequestLaneTests(TestCase):
+    """Emergency appointments put X-rays in the urgent lane"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        from accounts.models import User
+        from dashboard.models import Doctor, Patient
+        cache.clear()
+        self.addCleanup(cache.clear)
+        user = User.objects.create_user(email='doctor@example.com', password='x')
+        self.doctor, _ = Doctor.objects.get_or_create(user=user)
+        self.patient = Patient.objects.create(
+            first_name='A', last_name='B', date_of_birth='2000-01-01', gender='M',
+            phone='1', created_by=user)
+
+    def emergency(self):
+        from django.utils import timezone
+        from dashboard.models import Appointment
+        return Appointment.objects.create(
+            patient=self.patient, doctor=self.doctor, date=timezone.localdate(),
+            time='09:00', appointment_type='emergency')
+
+    def test_lane_is_looked_up_once_per_patient_and_day(self):
+        from django.core.cache import cache
+        from ml_predict.admission import request_lane
+        self.assertEqual(request_lane(self.patient), 'routine')
+        appointment = self.emergency()
+        with self.assertNumQueries(0):
+            self.assertEqual(request_lane(self.patient), 'routine')
+        # The appointment given with the upload is always checked
+        self.assertEqual(request_lane(self.patient, appointment.id), 'urgent')
+
+        cache.clear()  # As when the cached lane expires
+        self.assertEqual(request_lane(self.patient), 'urgent')
+
+
+class SingleFlightTests(TestCase):
+    """Concurrent identical work runs once; the other callers wait for it"""
+
+    def test_concurrent_claims_are_coalesced(self):
+        from ml_predict.single_flight import claim, single_flight_stats
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def leader():
+            with claim('gradcam:pneumonia:abc', timeout=5) as is_leader:
+                results.append(is_leader)
+                started.set()
+                release.wait(5)
+
+        def follower():
+            with claim('gradcam:pneumonia:abc', timeout=5) as is_leader:
+                results.append(is_leader)
+
+        before = single_flight_stats()
+        with self.settings(ML_SINGLE_FLIGHT_DB=False):
+            threads = [threading.Thread(target=leader)]
+            threads[0].start()
+            started.wait(5)
+            threads += [threading.Thread(target=follower) for _ in range(3)]
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(results, [True, False, False, False])
+        stats = single_flight_stats()
+        self.assertEqual(stats['local_followers'] - before['local_followers'], 3)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_waits_for_another_workers_lock(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from ml_predict.models import InferenceLock
+        from ml_predict.single_flight import SingleFlightTimeout, claim
+
+        InferenceLock.objects.create(
+            key='predict:v1:abc', owner='other-host:1:1',
+            expires_at=timezone.now() + timedelta(minutes=5))
+        with self.assertRaises(SingleFlightTimeout):
+            with claim('predict:v1:abc', timeout=0.2):
+                pass
+
+        # A lock past its TTL was left by a dead worker and is taken over
+        InferenceLock.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        with claim('predict:v1:abc', timeout=0.2) as is_leader:
+            self.assertTrue(is_leader)
+            self.assertEqual(InferenceLock.objects.count(), 1)
+        self.assertFalse(InferenceLock.objects.exists())
+
+    def test_lock_taken_after_waiting_is_released(self):
+        from ml_predict import single_flight
+        from ml_predict.models import InferenceLock
+
+        # Another worker holds the row for one poll, then this caller takes it
+        try_lock = single_flight._try_lock
+        polls = []
+
+        def busy_once(key, ttl):
+            polls.append(key)
+            return len(polls) > 1 and try_lock(key, ttl)
+
+        with mock.patch.object(single_flight, '_try_lock', side_effect=busy_once):
+            with single_flight.claim('predict:v1:abc', timeout=2) as is_leader:
+                self.assertFalse(is_leader)
+                self.assertEqual(InferenceLock.objects.count(), 1)
+        self.assertFalse(InferenceLock.objects.exists())
+        with single_flight.claim('predict:v1:abc', timeout=0.2) as is_leader:
+            self.assertTrue(is_leader)
+
+
+class MemoisationTests(TestCase):
+    """Byte-identical uploads reuse the stored prediction for the same model set"""
+
+    def setUp(self):
+        from accounts.models import User
+        from dashboard.models import Patient
+
+        self.media_root = tempfile.mkdtemp(prefix='chestcare-memo-')
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, ML_DEFER_GRADCAM=False)
+        self.settings_override.enable()
+        user = User.objects.create_user(email='doctor@example.com', password='x')
+        self.patient = Patient.objects.create(
+            first_name='A', last_name='B', date_of_birth='2000-01-01', gender='M',
+            phone='1', created_by=user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def prediction(self, content=b'xray', **fields):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from ml_predict.models import PredictionResult
+        return PredictionResult.objects.create(
+            patient=self.patient, xray_image=SimpleUploadedFile('xray.png', content), **fields)
+
+    def test_identical_upload_reuses_the_prediction(self):
+        from django.core.files.base import ContentFile
+        from ml_predict.pipeline import find_memoised_prediction, reuse_prediction
+
+        prior = self.prediction(
+            content_hash='abc', model_version='v1', predicted_disease='pneumonia',
+            confidence_score=0.9, all_predictions={'pneumonia': 0.9, 'tuberculosis': 0.4})
+        prior.save_gradcam('pneumonia', ContentFile(b'primary', name='gradcam_pneumonia.png'))
+        prior.save_gradcam('tuberculosis', ContentFile(b'second', name='gradcam_tuberculosis.png'))
+        # Not reusable: another model set, or never scored
+        self.prediction(content_hash='abc', model_version='v2', predicted_disease='tuberculosis',
+                        confidence_score=0.8)
+        self.prediction(content_hash='abc', model_version='v1')
+
+        self.assertEqual(find_memoised_prediction('abc', 'v1'), prior)
+        self.assertIsNone(find_memoised_prediction('abc', 'v3'))
+        self.assertIsNone(find_memoised_prediction('def', 'v1'))
+
+        upload = self.prediction(content_hash='abc', model_version='v1')
+        self.assertTrue(reuse_prediction(upload, prior))
+        upload.refresh_from_db()
+        self.assertEqual(
+            (upload.predicted_disease, upload.confidence_score, upload.all_predictions),
+            (prior.predicted_disease, prior.confidence_score, prior.all_predictions))
+        # The X-ray file is shared; the Grad-CAMs are copies
+        self.assertEqual(upload.xray_image.name, prior.xray_image.name)
+        self.assertNotEqual(upload.gradcam_image.name, prior.gradcam_image.name)
+        with upload.gradcam_image.open('rb') as f:
+            self.assertEqual(f.read(), b'primary')
+        with upload.get_gradcam_file('tuberculosis').open('rb') as f:
+            self.assertEqual(f.read(), b'second')
+
+    def test_backfill_hashes_existing_predictions(self):
+        import hashlib
+        from io import StringIO
+        from django.core.management import call_command
+
+        scored = self.prediction(content=b'first', model_version='v0')
+        unversioned = self.prediction(content=b'second')
+        missing = self.prediction(content=b'third')
+        os.remove(missing.xray_image.path)
+
+        out = StringIO()
+        call_command('backfill_content_hashes', '--model-version', 'v1',
+                     stdout=out, stderr=StringIO())
+        self.assertIn('Hashed 2 predictions (1 with missing files)', out.getvalue())
+
+        for prediction, content, version in ((scored, b'first', 'v0'),
+                                             (unversioned, b'second', 'v1')):
+            prediction.refresh_from_db()
+            self.assertEqual(prediction.content_hash, hashlib.sha256(content).hexdigest())
+            # Only rows without a version get the one given
+            self.assertEqual(prediction.model_version, version)
+        missing.refresh_from_db()
+        self.assertIsNone(missing.content_hash)
+
+
+class PredictionFixture:
+    """A saved prediction, and a stub predictor for the pipeline to run"""
+
+    class Predictor:
+        available_diseases = ['pneumonia', 'tuberculosis']
+        model_set_version = 'v1'
+        remote = False
+
+        def __init__(self, error=None):
+            self.error = error
+
+        def predict_and_explain(self, image_path, secondary_threshold=None):
+            return self.predict(image_path), {}
+
+        def predict(self, image_path):
+            if self.error:
+                raise self.error
+            return {
+                'predicted_disease': 'pneumonia',
+                'confidence_score': 0.9,
+                'all_predictions': {'pneumonia': 0.9, 'tuberculosis': 0.1},
+            }
+
+        def generate_gradcams(self, image_path, diseases, refresh_cache=False,
+                              fast_encoding=False):
+            from django.core.files.base import ContentFile
+            return {disease: ContentFile(b'png') for disease in diseases}
+
+    def setUp(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from accounts.models import User
+        from dashboard.models import Patient
+        from ml_predict.models import PredictionResult
+
+        self.media_root = tempfile.mkdtemp(prefix='chestcare-predictions-')
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, ML_PREDICTION_MEMOIZATION=False)
+        self.settings_override.enable()
+        user = User.objects.create_user(email='doctor@example.com', password='x')
+        patient = Patient.objects.create(
+            first_name='A', last_name='B', date_of_birth='2000-01-01', gender='M',
+            phone='1', created_by=user)
+        self.prediction = PredictionResult.objects.create(
+            patient=patient, content_hash='abc',
+            xray_image=SimpleUploadedFile('xray.png', b'not really a png'))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+
+class PredictionJobTests(PredictionFixture, TestCase):
+    """Queued predictions are claimed once and end up succeeded or failed;
+    deferred Grad-CAMs are built after the response"""
+
+    def test_job_is_claimed_once_and_succeeds(self):
+        from ml_predict.jobs import claim_next_job, enqueue_prediction, run_job
+        job = enqueue_prediction(self.prediction)
+        self.assertEqual(job.status, 'queued')
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, 'running')
+        self.assertIsNone(claim_next_job())
+
+        run_job(claimed, self.Predictor())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), ('succeeded', 100))
+        self.assertEqual(job.prediction.predicted_disease, 'pneumonia')
+
+    def test_failed_job_keeps_the_error_and_drops_the_prediction(self):
+        from ml_predict.batching import SchedulerBusy
+        from ml_predict.jobs import claim_next_job, enqueue_prediction, run_job
+        job = enqueue_prediction(self.prediction)
+
+        # A busy scheduler is retried, anything else fails the job
+        run_job(claim_next_job(), self.Predictor(SchedulerBusy('queue full')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+
+        run_job(claim_next_job(), self.Predictor(ValueError('bad image')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('failed', 'bad image'))
+        self.assertIsNone(job.prediction)
+
+    def test_orphaned_job_is_retried_until_max_attempts(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from ml_predict.jobs import claim_next_job, enqueue_prediction, requeue_stale_jobs
+        from ml_predict.models import PredictionJob
+        job = enqueue_prediction(self.prediction)
+
+        with self.settings(ML_PREDICTION_JOB_TIMEOUT_SECONDS=60,
+                           ML_PREDICTION_JOB_MAX_ATTEMPTS=2):
+            for attempt in (1, 2):
+                # The worker running it dies
+                claim_next_job()
+                PredictionJob.objects.filter(id=job.id).update(
+                    started_at=timezone.now() - timedelta(minutes=5))
+                requeued = requeue_stale_jobs()
+                job.refresh_from_db()
+                self.assertEqual(job.attempts, attempt)
+                if attempt == 1:
+                    self.assertEqual((requeued, job.status), (1, 'queued'))
+
+        self.assertEqual((requeued, job.status), (0, 'failed'))
+        self.assertIn('on 2 attempts', job.error)
+        self.assertIsNone(job.prediction)
+        self.assertIsNone(claim_next_job())
+
+    def test_deferred_gradcam_is_built_after_commit(self):
+        from rest_framework.test import APIClient
+        from ml_predict import deferred_gradcam
+        from ml_predict.pipeline import run_prediction
+
+        predictor = self.Predictor()
+        with self.settings(ML_DEFER_GRADCAM=True), \
+                self.captureOnCommitCallbacks() as callbacks, \
+                mock.patch.object(deferred_gradcam, '_submit'):
+            self.assertFalse(run_prediction(self.prediction, predictor))
+        self.assertEqual(len(callbacks), 1)
+        self.prediction.refresh_from_db()
+        self.assertEqual(self.prediction.gradcam_status, 'pending')
+        self.assertFalse(self.prediction.gradcam_image)
+
+        client = APIClient()
+        client.force_authenticate(self.prediction.patient.created_by)
+        with mock.patch('ml_predict.views.ensure_scheduled'):
+            response = client.get(f'/api/ml/predictions/{self.prediction.id}/gradcam/')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Retry-After', response)
+
+        with mock.patch('ml_predict.inference.get_predictor', return_value=predictor):
+            deferred_gradcam._generate(self.prediction.id)
+        self.prediction.refresh_from_db()
+        self.assertEqual(self.prediction.gradcam_status, 'ready')
+        self.assertTrue(self.prediction.gradcam_image)
+
+
+class OverlayTests(PredictionFixture, TestCase):
+    """Overlays come from the stored heatmap, in the format Accept prefers"""
+
+    def test_overlay_is_rendered_from_the_stored_heatmap(self):
+        from io import BytesIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from rest_framework.test import APIClient
+
+        xray = BytesIO()
+        Image.new('RGB', (256, 128), (90, 90, 90)).save(xray, format='PNG')
+        self.prediction.xray_image = SimpleUploadedFile('xray.png', xray.getvalue())
+        self.prediction.predicted_disease = 'pneumonia'
+        self.prediction.all_predictions = {'pneumonia': 0.9, 'tuberculosis': 0.1}
+        self.prediction.save()
+        self.prediction.save_heatmaps({'pneumonia': np.ones((7, 7), dtype=np.float32)})
+        self.assertLess(len(self.prediction.gradcam_heatmaps), 512)
+
+        client = APIClient()
+        client.force_authenticate(self.prediction.patient.created_by)
+        url = f'/api/ml/predictions/{self.prediction.id}/overlay/'
+        with self.settings(ML_GRADCAM_CACHE_ENABLED=False):
+            response = client.get(url, {'image_format': 'webp', 'size': 64, 'alpha': 0.5})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertEqual(Image.open(BytesIO(response.content)).size, (64, 32))
+
+            response = client.get(
+                url, {'image_format': 'webp', 'size': 64, 'alpha': 0.5},
+                HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(client.get(url, {'colormap': 'nope'}).status_code, 400)
+
+            # Diseases without a heatmap get theirs computed on first use
+            predictor = mock.Mock()
+            predictor.generate_heatmaps.return_value = {
+                'tuberculosis': np.zeros((7, 7), dtype=np.float16)}
+            with mock.patch('ml_predict.views.get_predictor', return_value=predictor):
+                response = client.get(url, {'disease': 'tuberculosis'})
+            self.assertEqual(response.status_code, 200)
+            predictor.generate_heatmaps.assert_called_once_with(
+                self.prediction.xray_image.path, ['tuberculosis'])
+        self.prediction.refresh_from_db()
+        self.assertEqual(set(self.prediction.get_heatmaps()), {'pneumonia', 'tuberculosis'})
+
+    def test_saving_a_gradcam_keeps_heatmaps_stored_meanwhile(self):
+        from django.core.files.base import ContentFile
+        from ml_predict.models import PredictionResult
+
+        self.prediction.predicted_disease = 'pneumonia'
+        self.prediction.save()
+        # Another worker stores a heatmap after this instance was loaded
+        PredictionResult.objects.get(id=self.prediction.id).save_heatmaps(
+            {'tuberculosis': np.ones((7, 7), dtype=np.float32)})
+        self.prediction.save_gradcam('pneumonia', ContentFile(b'png', name='gradcam_pneumonia.png'))
+        self.prediction.refresh_from_db()
+        self.assertEqual(self.prediction.gradcam_status, 'ready')
+        self.assertTrue(self.prediction.gradcam_image)
+        self.assertEqual(set(self.prediction.get_heatmaps()), {'tuberculosis'})
+
+    def test_gradcam_is_served_in_the_format_accept_prefers(self):
+        from io import BytesIO
+        from PIL import Image
+        from django.core.files.base import ContentFile
+        from rest_framework.test import APIClient
+
+        xray = BytesIO()
+        Image.new('RGB', (64, 64), (90, 90, 90)).save(xray, format='PNG')
+        self.prediction.xray_image.save('xray.png', ContentFile(xray.getvalue()), save=False)
+        self.prediction.predicted_disease = 'pneumonia'
+        self.prediction.gradcam_image.save('gradcam.png', ContentFile(b'stored png'), save=False)
+        self.prediction.save()
+
+        client = APIClient()
+        client.force_authenticate(self.prediction.patient.created_by)
+        url = f'/api/ml/predictions/{self.prediction.id}/gradcam/'
+        with self.settings(ML_GRADCAM_CACHE_ENABLED=False):
+            response = client.get(url, HTTP_ACCEPT='image/webp,*/*;q=0.8')
+            # Without a heatmap there's nothing to re-encode from
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertEqual(b''.join(response), b'stored png')
+
+            self.prediction.save_heatmaps({'pneumonia': np.ones((7, 7), dtype=np.float32)})
+            response = client.get(url, HTTP_ACCEPT='image/webp,*/*;q=0.8')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertIn('Accept', response['Vary'])
+            self.assertEqual(Image.open(BytesIO(response.content)).format, 'WEBP')
+
+            # An image-only Accept doesn't turn the JSON 202 into a 406
+            self.prediction.gradcam_status = 'pending'
+            self.prediction.gradcam_image = None
+            self.prediction.save()
+            with mock.patch('ml_predict.views.ensure_scheduled'):
+                response = client.get(url, HTTP_ACCEPT='image/webp')
+            self.assertEqual(response.status_code, 202)
+
+
+class PredictionListTests(PredictionFixture, TestCase):
+    """The prediction lists cost a fixed number of queries and skip the heatmaps"""
+
+    def test_lists_prefetch_gradcams_and_defer_heatmaps(self):
+        from django.core.files.base import ContentFile
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from rest_framework.test import APIClient
+        from ml_predict.models import PredictionResult
+
+        for _ in range(3):
+            prediction = PredictionResult.objects.create(
+                patient=self.prediction.patient, predicted_disease='pneumonia')
+            prediction.save_gradcam('tuberculosis', ContentFile(b'png', name='gradcam.png'))
+            prediction.save_heatmaps({'tuberculosis': np.ones((7, 7), dtype=np.float32)})
+
+        client = APIClient()
+        client.force_authenticate(self.prediction.patient.created_by)
+        for url in ('/api/ml/predictions/',
+                    f'/api/ml/predictions/patient/{self.prediction.patient.id}/'):
+            with self.subTest(url=url), \
+                    mock.patch.object(PredictionResult, 'get_heatmaps') as get_heatmaps, \
+                    CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            rows = [row for row in response.data['data'] if row['heatmap_diseases']]
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[0]['heatmap_diseases'], ['tuberculosis'])
+            self.assertEqual(rows[0]['gradcam_diseases'], ['tuberculosis'])
+            get_heatmaps.assert_not_called()
+            self.assertLessEqual(len(queries), 3)
+            self.assertFalse(any('gradcam_heatmaps' in query['sql'] for query in queries))
+
+
+class LatencyBudgetTests(PredictionFixture, TestCase):
+    """The pipeline drops or defers the Grad-CAMs that don't fit in the budget"""
+
+    def test_latency_budget_drops_the_gradcams_that_do_not_fit(self):
+        from ml_predict import deferred_gradcam
+        from ml_predict.latency_budget import LatencyBudget
+        from ml_predict.pipeline import run_prediction
+
+        # The secondary Grad-CAMs would take longer than the time left
+        estimates = {'secondary_gradcams': 10000}
+        budget = LatencyBudget(budget_ms=5000)
+        with self.settings(ML_GRADCAM_CONFIDENCE_THRESHOLD=0.05), \
+                mock.patch('ml_predict.latency_budget.estimate_ms',
+                           side_effect=lambda stage: estimates.get(stage, 0)):
+            self.assertTrue(run_prediction(self.prediction, self.Predictor(), budget=budget))
+        self.assertEqual(budget.dropped, [
+            {'stage': 'png_encoding', 'action': 'degraded'},
+            {'stage': 'secondary_gradcams', 'action': 'skipped'},
+        ])
+        self.assertTrue(self.prediction.gradcam_image)
+        self.assertFalse(self.prediction.gradcams.exists())
+
+        # Not even the primary one fits: it's deferred to the background
+        estimates['gradcam'] = 10000
+        budget = LatencyBudget(budget_ms=5000)
+        with mock.patch('ml_predict.latency_budget.estimate_ms',
+                        side_effect=lambda stage: estimates.get(stage, 0)), \
+                self.captureOnCommitCallbacks() as callbacks, \
+                mock.patch.object(deferred_gradcam, '_submit'):
+            self.assertFalse(run_prediction(self.prediction, self.Predictor(), budget=budget))
+        self.assertIn({'stage': 'gradcam', 'action': 'deferred'}, budget.dropped)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.prediction.gradcam_status, 'pending')
+
+    def test_batched_gradcams_are_timed_apart_from_the_primary(self):
+        from ml_predict.latency_budget import LatencyBudget
+        from ml_predict.pipeline import run_prediction
+
+        # The batched path builds every Grad-CAM at once, which mustn't feed
+        # the primary Grad-CAM's estimate
+        budget = LatencyBudget()
+        predictor = self.Predictor()
+        with self.settings(ML_BATCHING_ENABLED=True, ML_GRADCAM_CONFIDENCE_THRESHOLD=0.05), \
+                mock.patch('ml_predict.pipeline.get_scheduler') as get_scheduler:
+            get_scheduler.return_value.predict.return_value = predictor.predict(None)
+            self.assertTrue(run_prediction(self.prediction, predictor, budget=budget))
+        self.assertIn('batched_gradcams', budget.timings)
+        self.assertNotIn('gradcam', budget.timings)
@@ -0,0 +1,77 @@
+# ml_predict/tflite.py
+"""
+TFLite conversion of the disease classifiers and an interpreter wrapper
+that ChestXrayPredictor can serve in place of a Keras model.
+
+Variants:
+    float32  plain conversion
+    float16  weights stored as float16
+    int8     dynamic-range quantisation (int8 weights, float activations)
+"""
+import os
+import io
+import threading
+import contextlib
+
+import numpy as np
+import tensorflow as tf
+from django.conf import settings
+
+VARIANTS = ('float32', 'float16', 'int8')
+
+
+def tflite_path(model_file, variant):
+    """Where the export_tflite command writes a variant of a .keras model file"""
+    stem = os.path.splitext(model_file)[0]
+    return os.path.join(str(settings.ML_PREDICT_PATH), f"{stem}.{variant}.tflite")
+
+
+def convert(model, variant):
+    """Convert a Keras model to a TFLite flatbuffer"""
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown TFLite variant {variant!r}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant in ('float16', 'int8'):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    # The converter prints the traced signature to stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        return converter.convert()
+
+
+class TFLiteModel:
+    """TFLite interpreter with the parts of the Keras model API the predictor uses"""
+
+    def __init__(self, model_path=None, model_content=None, num_threads=None):
+        self.model_path = model_path
+        self._interpreter = tf.lite.Interpreter(
+            model_path=model_path, model_content=model_content,
+            num_threads=num_threads or None)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        # An interpreter can't be invoked from two threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def input_shape(self):
+        return (None,) + tuple(int(size) for size in self._input['shape'][1:])
+
+    @property
+    def size_bytes(self):
+        return os.path.getsize(self.model_path) if self.model_path else None
+
+    def predict(self, batch, verbose=0):
+        """Run a float32 batch and return the output as a NumPy array"""
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            if batch.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(
+                    self._input['index'], list(batch.shape))
+                self._interpreter.allocate_tensors()
+                self._batch_size = batch.shape[0]
+            self._interpreter.set_tensor(self._input['index'], batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output['index']).copy()
@@ -11,9 +11,14 @@ urlpatterns = [
     # New Grad-CAM endpoints
     path('predictions/<int:prediction_id>/gradcam/',
          views.get_gradcam_image, name='get_gradcam_image'),
+    path('predictions/<int:prediction_id>/overlay/',
+         views.get_gradcam_overlay, name='get_gradcam_overlay'),
     path('predictions/<int:prediction_id>/regenerate-gradcam/',
          views.regenerate_gradcam, name='regenerate_gradcam'),
+    path('jobs/<int:job_id>/', views.get_prediction_job, name='get_prediction_job'),
     path('diseases/', views.get_available_diseases,
          name='get_available_diseases'),
+    path('stats/', views.get_inference_stats, name='get_inference_stats'),
+    path('health/', views.ml_health, name='ml_health'),
 
 ]
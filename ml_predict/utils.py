@@ -1,25 +1,59 @@
 import os
 import numpy as np
 import tensorflow as tf
-from PIL import Image
 from django.conf import settings
-from django.core.files.base import ContentFile
+import gc
 import json
+import hashlib
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cv2
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from io import BytesIO
+from . import preprocessing, rendering
+from .hashing import sha256_file
+from .backends import BackendUnavailable, backend_spec_for, create_backend
+from .backbone_sharing import find_shared_backbones
+from .model_manager import ModelManager
+from .gradcam_cache import get_gradcam_cache, GradCAMCacheKey
 
 logger = logging.getLogger(__name__)
 
 
+def extract_confidence(disease, prediction):
+    """Turn a raw model output batch into a clamped confidence score"""
+    # Better prediction handling
+    if prediction is None or len(prediction) == 0:
+        logger.warning(
+            f"Model {disease} returned empty prediction")
+        return 0.0
+
+    # Handle different prediction output formats
+    pred_array = np.asarray(prediction[0])
+    if pred_array.shape[0] == 1:
+        confidence = float(pred_array[0])
+    else:
+        confidence = float(np.max(pred_array))
+
+    # Ensure confidence is a valid number
+    if np.isnan(confidence) or np.isinf(confidence):
+        logger.warning(
+            f"Invalid confidence score for {disease}: {confidence}")
+        return 0.0
+
+    # Clamp confidence between 0 and 1
+    return max(0.0, min(1.0, confidence))
+
+
 class GradCAMGenerator:
     """Class to generate Grad-CAM visualizations"""
 
     def __init__(self, model, layer_name=None):
         self.model = model
         self.layer_name = layer_name or self._find_last_conv_layer()
+        self._grad_models = {}  # layer name -> gradient sub-model
+        self._gradcam_fns = {}  # layer name -> compiled Grad-CAM step
+        self._build_lock = threading.Lock()
         # Initialize the model by running a dummy prediction
         self._initialize_model()
 
@@ -38,12 +72,91 @@ class GradCAMGenerator:
 
             # Run a dummy prediction to build all layers
             _ = self.model(dummy_input, training=False)
+
+            # Trace the compiled Grad-CAM step now so requests run at steady state
+            if self.layer_name is not None:
+                self.generate_gradcam(dummy_input.numpy())
             logger.info(f"Model initialized successfully for Grad-CAM")
 
         except Exception as e:
             logger.warning(
                 f"Could not initialize model for Grad-CAM: {str(e)}")
 
+    def _get_grad_model(self, layer_name):
+        """Build (once) a model mapping the input to the layer activations and predictions"""
+        if layer_name not in self._grad_models:
+            target_layer = self.model.get_layer(layer_name)
+            if isinstance(self.model, tf.keras.Sequential):
+                # Loaded Sequential models have no symbolic input, so
+                # replay the layers on a fresh one
+                model_input = tf.keras.Input(
+                    shape=tuple(self.model.input_shape[1:]))
+                outputs = model_input
+                for layer in self.model.layers:
+                    outputs = layer(outputs)
+                    if layer is target_layer:
+                        conv_outputs = outputs
+                self._grad_models[layer_name] = tf.keras.models.Model(
+                    model_input, [conv_outputs, outputs])
+            else:
+                self._grad_models[layer_name] = tf.keras.models.Model(
+                    self.model.input,
+                    [target_layer.output, self.model.output]
+                )
+        return self._grad_models[layer_name]
+
+    def _get_gradcam_fn(self, layer_name):
+        """Build (once) the compiled forward + gradient + pooling step for a layer"""
+        gradcam_fn = self._gradcam_fns.get(layer_name)
+        if gradcam_fn is not None:
+            return gradcam_fn
+
+        with self._build_lock:
+            if layer_name in self._gradcam_fns:
+                return self._gradcam_fns[layer_name]
+
+            grad_model = self._get_grad_model(layer_name)
+            input_signature = [
+                tf.TensorSpec(
+                    shape=(None,) + tuple(self.model.input_shape[1:]), dtype=tf.float32),
+                tf.TensorSpec(shape=(), dtype=tf.int32),
+            ]
+
+            @tf.function(input_signature=input_signature)
+            def gradcam_fn(img_tensor, class_index):
+                # Compute the gradient of the target class with respect to
+                # the activations of the target conv layer
+                with tf.GradientTape() as tape:
+                    conv_outputs, predictions = grad_model(
+                        img_tensor, training=False)
+                    if predictions.shape[-1] > 1:
+                        # Multi-class output
+                        class_output = tf.gather(
+                            predictions, class_index, axis=1)
+                    else:
+                        # Binary classification
+                        class_output = predictions
+
+                grads = tape.gradient(class_output, conv_outputs)
+
+                # Pool the gradients over all the axes leaving out the channel dimension
+                pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
+
+                # Weight the channels by corresponding gradients
+                heatmap = conv_outputs[0] @ pooled_grads[..., tf.newaxis]
+                heatmap = tf.squeeze(heatmap)
+
+                # Normalize the heatmap between 0 & 1 for visualization
+                heatmap_max = tf.math.reduce_max(heatmap)
+                heatmap = tf.where(
+                    heatmap_max > 0,
+                    tf.math.divide_no_nan(tf.maximum(heatmap, 0), heatmap_max),
+                    tf.zeros_like(heatmap))
+                return heatmap, predictions
+
+            self._gradcam_fns[layer_name] = gradcam_fn
+            return gradcam_fn
+
     def _find_last_conv_layer(self):
         """Find the last convolutional layer in the model"""
         conv_layers = []
@@ -78,73 +191,21 @@ class GradCAMGenerator:
             if len(img_array.shape) == 3:
                 img_array = np.expand_dims(img_array, axis=0)
 
-            # Verify the target layer exists and is accessible
+            # Gradient model and compiled step are built once per layer
             try:
-                target_layer = self.model.get_layer(self.layer_name)
+                gradcam_fn = self._get_gradcam_fn(self.layer_name)
             except ValueError as e:
                 logger.error(
                     f"Could not find layer {self.layer_name}: {str(e)}")
                 return None
-
-            # Create a model that maps the input image to the activations of the target conv layer
-            # as well as the output predictions
-            try:
-                grad_model = tf.keras.models.Model(
-                    self.model.input,
-                    [target_layer.output, self.model.output]
-                )
             except Exception as e:
                 logger.error(f"Could not create gradient model: {str(e)}")
                 return None
 
             # Convert to tensor with correct dtype
             img_tensor = tf.convert_to_tensor(img_array, dtype=tf.float32)
-
-            # Compute the gradient of the top predicted class for our input image
-            # with respect to the activations of the target conv layer
-            with tf.GradientTape() as tape:
-                try:
-                    conv_outputs, predictions = grad_model(
-                        img_tensor, training=False)
-
-                    if len(predictions.shape) > 1 and predictions.shape[1] > 1:
-                        # Multi-class output
-                        class_output = predictions[:, class_index]
-                    else:
-                        # Binary classification
-                        class_output = predictions
-
-                except Exception as e:
-                    logger.error(f"Error in forward pass: {str(e)}")
-                    return None
-
-            # Extract the gradients of the top predicted class
-            try:
-                grads = tape.gradient(class_output, conv_outputs)
-
-                if grads is None:
-                    logger.error(
-                        "Gradients are None - this might indicate a disconnected graph")
-                    return None
-
-            except Exception as e:
-                logger.error(f"Error computing gradients: {str(e)}")
-                return None
-
-            # Pool the gradients over all the axes leaving out the channel dimension
-            pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-            # Weight the channels by corresponding gradients
-            conv_outputs = conv_outputs[0]
-            heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-            heatmap = tf.squeeze(heatmap)
-
-            # Normalize the heatmap between 0 & 1 for visualization
-            heatmap_max = tf.math.reduce_max(heatmap)
-            if heatmap_max > 0:
-                heatmap = tf.maximum(heatmap, 0) / heatmap_max
-            else:
-                heatmap = tf.zeros_like(heatmap)
+            heatmap, _ = gradcam_fn(
+                img_tensor, tf.constant(class_index, dtype=tf.int32))
 
             return heatmap.numpy()
 
@@ -152,72 +213,137 @@ class GradCAMGenerator:
             logger.error(f"Error generating Grad-CAM: {str(e)}")
             return None
 
-    def create_overlay_image(self, original_image_path, heatmap):
-        """Create overlay of original image and heatmap"""
+    def explain(self, img_array, class_index=0):
+        """Return (predictions, heatmap) from a single forward pass"""
         try:
-            # Load original image
-            original_img = cv2.imread(original_image_path)
-            if original_img is None:
-                logger.error(f"Could not load image: {original_image_path}")
+            if self.layer_name is None:
                 return None
 
-            original_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB)
+            if len(img_array.shape) == 3:
+                img_array = np.expand_dims(img_array, axis=0)
 
-            # Resize heatmap to match original image size
-            img_height, img_width = original_img.shape[:2]
-            heatmap_resized = cv2.resize(heatmap, (img_width, img_height))
+            gradcam_fn = self._get_gradcam_fn(self.layer_name)
+            heatmap, predictions = gradcam_fn(
+                tf.convert_to_tensor(img_array, dtype=tf.float32),
+                tf.constant(class_index, dtype=tf.int32))
+            return predictions.numpy(), heatmap.numpy()
 
-            # Apply colormap to heatmap
-            heatmap_colored = cm.jet(heatmap_resized)[
-                :, :, :3]  # Remove alpha channel
-            heatmap_colored = (heatmap_colored * 255).astype(np.uint8)
+        except Exception as e:
+            logger.error(f"Error in single-pass Grad-CAM: {str(e)}")
+            return None
 
-            # Create overlay
-            overlay = cv2.addWeighted(
-                original_img, 0.6, heatmap_colored, 0.4, 0)
+    def create_overlay_image(self, original_image, heatmap):
+        """Create overlay of original image (a path, decoded RGB image or
+        rendering.prepare_base() array) and heatmap"""
+        try:
+            if isinstance(original_image, str):
+                # Load original image
+                original_img = cv2.imread(original_image)
+                if original_img is None:
+                    logger.error(f"Could not load image: {original_image}")
+                    return None
+
+                original_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB)
+            else:
+                # Already decoded (e.g. by ChestXrayPredictor.load_image)
+                original_img = original_image
 
-            return overlay
+            return rendering.render_overlay(
+                rendering.prepare_base(original_img), heatmap,
+                colormap=getattr(settings, 'ML_GRADCAM_COLORMAP', 'jet'))
 
         except Exception as e:
             logger.error(f"Error creating overlay image: {str(e)}")
             return None
 
 class ChestXrayPredictor:
-    def __init__(self):
-        self.models = {}
+    remote = False  # See inference_server.RemotePredictor
+
+    # Disease -> model file in ML_PREDICT_PATH
+    MODEL_FILES = {
+        'cardiomegaly': 'cardiomegaly_model.keras',
+        'pneumonia': 'pneumonia_model.keras',
+        'tuberculosis': 'tuberculosis_model.keras',
+        'pulmonary_hypertension': 'pulmonary_hypertension_model.keras'
+    }
+
+    def __init__(self, wait=True):
+        self.models = {}  # disease -> Keras model (Grad-CAM, fused graph)
+        self.backends = {}  # disease -> InferenceBackend serving predictions
         self.gradcam_generators = {}  # New: Store Grad-CAM generators
-        self.model_paths = {
-            'cardiomegaly': 'cardiomegaly_model.keras',
-            'pneumonia': 'pneumonia_model.keras',
-            'tuberculosis': 'tuberculosis_model.keras',
-            'pulmonary_hypertension': 'pulmonary_hypertension_model.keras'
+        self.shape_groups = {}  # input shape -> diseases sharing that shape
+        # Kept when a model is unloaded, so requests still prepare its input
+        self.input_shapes = {}  # disease -> (height, width, channels)
+        self.model_versions = {}  # disease -> content hash of the model file
+        self.model_status = {}  # disease -> load state and timings
+        self.backbone_groups = {}  # disease -> SharedBackboneGroup it belongs to
+        self.fused_fn = None  # Compiled multi-output graph (optional)
+        self.fused_shapes = []
+        self.fused_diseases = []
+        # Signalled whenever a model finishes loading (or fails to)
+        self._load_condition = threading.Condition()
+        self._loading_done = False
+        # Shared pool for running independent Grad-CAMs concurrently
+        self.gradcam_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ML_GRADCAM_WORKERS', 4),
+            thread_name_prefix='gradcam')
+        self.model_paths = dict(self.MODEL_FILES)
+        # Unloads idle models and reloads them on demand (see model_manager)
+        self.model_manager = ModelManager(
+            load=self._reload_model, unload=self.unload_model,
+            budget_bytes=getattr(settings, 'ML_MODEL_MEMORY_BUDGET_MB', 0) * 1024 * 1024,
+            idle_seconds=getattr(settings, 'ML_MODEL_IDLE_SECONDS', 0),
+            pinned=getattr(settings, 'ML_PINNED_MODELS', ()),
+            load_timeout=getattr(settings, 'ML_LOAD_TIMEOUT_SECONDS', 300))
+        self.load_models(wait=wait)
+
+    def load_models(self, wait=True):
+        """Load and warm up all ML models concurrently
+
+        With wait=False loading continues in a background thread and each
+        model becomes usable as soon as it is ready.
+        """
+        self.model_status = {
+            disease: {'state': 'pending', 'backend': None, 'load_ms': None,
+                      'warmup_ms': None, 'memory': None, 'error': None}
+            for disease in self.model_paths
         }
-        self.load_models()
-
-    def load_models(self):
-        """Load all ML models on initialization"""
-        failed_models = []
-        error_models = []
-        for disease, model_file in self.model_paths.items():
-            model_path = os.path.join(
-                str(settings.ML_PREDICT_PATH), model_file)
-            if os.path.exists(model_path):
-                try:
-                    model = tf.keras.models.load_model(model_path)
-                    self.models[disease] = model
-                    # Initialize Grad-CAM generator for each model
-                    self.gradcam_generators[disease] = GradCAMGenerator(model)
-                    logger.info(
-                        f"Loaded {disease} model successfully with Grad-CAM")
-                except Exception as e:
-                    logger.error(f"Error loading {disease} model: {str(e)}")
-                    error_models.append(disease)
-            else:
-                logger.warning(f"Model file not found: {model_path}")
-                failed_models.append(disease)
-
+        if wait:
+            self._load_all()
+        else:
+            # Not a daemon thread: TensorFlow aborts the process if the
+            # interpreter exits while a thread is still building a graph
+            threading.Thread(
+                target=self._load_all, name='ml-model-loader').start()
+
+    def _load_all(self):
+        started = time.perf_counter()
+        workers = max(1, min(
+            getattr(settings, 'ML_LOAD_WORKERS', 4), len(self.model_paths)))
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='model-load') as executor:
+            for _ in as_completed([
+                    executor.submit(self._load_model, disease, model_file)
+                    for disease, model_file in self.model_paths.items()]):
+                pass
+
+        for input_shape, diseases in self.shape_groups.items():
+            logger.info(
+                f"Input shape {input_shape} shared by: {', '.join(diseases)}")
+
+        # Trim to the memory budget before building graphs over the models
+        self.model_manager.enforce_budget()
+        self._build_combined_graphs()
+
+        failed_models = [
+            disease for disease, status in self.model_status.items()
+            if status['state'] == 'missing']
+        error_models = [
+            disease for disease, status in self.model_status.items()
+            if status['state'] == 'failed']
         if not failed_models and not error_models:
-            logger.info("ML models loaded successfully")
+            logger.info(
+                f"ML models loaded successfully in {time.perf_counter() - started:.2f}s")
         else:
             if failed_models:
                 logger.error(
@@ -226,143 +352,686 @@ class ChestXrayPredictor:
                 logger.error(
                     f"The following models failed to load: {', '.join(error_models)}")
 
-    def preprocess_image(self, image_path, model):
-        """Preprocess image to match specific model's requirements"""
-        # Get the size the model actually expects
-        target_size = (model.input_shape[1], model.input_shape[2])
+        with self._load_condition:
+            self._loading_done = True
+            self._load_condition.notify_all()
 
-        image = Image.open(image_path)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+    def _load_model(self, disease, model_file):
+        """Deserialise, fingerprint and warm up one model, then make it servable"""
+        status = self.model_status[disease]
+        model_path = os.path.join(str(settings.ML_PREDICT_PATH), model_file)
+        if not os.path.exists(model_path):
+            logger.warning(f"Model file not found: {model_path}")
+            status['state'] = 'missing'
+            self._notify_loaded()
+            return
 
-        image = image.resize(target_size)
-        image_array = np.array(image) / 255.0
-        return np.expand_dims(image_array, axis=0)
+        try:
+            status['state'] = 'loading'
+            started = time.perf_counter()
+            model = tf.keras.models.load_model(model_path)
+            model_version = sha256_file(model_path)[:16]
+            status['load_ms'] = (time.perf_counter() - started) * 1000
+
+            # Initialize Grad-CAM generator for each model (runs the dummy
+            # forward pass and traces the Grad-CAM step)
+            status['state'] = 'warming_up'
+            started = time.perf_counter()
+            gradcam_generator = GradCAMGenerator(model)
+
+            # The engine serving predictions for this disease
+            spec = backend_spec_for(disease)
+            try:
+                backend = create_backend(spec, model, model_path)
+            except BackendUnavailable as e:
+                logger.warning(f"{disease}: {str(e)}, serving with Keras")
+                backend = create_backend('keras', model, model_path)
+            model_version = backend.version(model_version)
+            status['backend'] = backend.spec
+            status['memory'] = backend.memory_report()
+            status['warmup_ms'] = (time.perf_counter() - started) * 1000
+
+            # Cached Grad-CAMs from a previous version of the model file are stale
+            gradcam_cache = get_gradcam_cache()
+            if gradcam_cache is not None:
+                gradcam_cache.invalidate(disease, current_version=model_version)
+
+            self._register_model(disease, model, backend, gradcam_generator, model_version)
+            status['state'] = 'ready'
+            self.model_manager.loaded(
+                disease, status['memory']['weight_bytes']
+                + status['memory'].get('flatbuffer_bytes', 0))
+            logger.info(
+                f"Loaded {disease} model successfully with Grad-CAM on {status['backend']} "
+                f"(load {status['load_ms']:.0f} ms, warm-up {status['warmup_ms']:.0f} ms)")
+        except Exception as e:
+            logger.error(f"Error loading {disease} model: {str(e)}")
+            status['state'] = 'failed'
+            status['error'] = str(e)
+        self._notify_loaded()
+
+    def _register_model(self, disease, model, backend, gradcam_generator, model_version):
+        """Publish a loaded model to request threads"""
+        with self._load_condition:
+            # Swap in new dicts rather than mutating, so requests iterating
+            # the old ones are unaffected. Models keep the configured order.
+            models = {**self.models, disease: model}
+            models = {name: models[name] for name in self.model_paths if name in models}
+            self.backends = {**self.backends, disease: backend}
+            self.gradcam_generators = {**self.gradcam_generators, disease: gradcam_generator}
+            self.model_versions = {**self.model_versions, disease: model_version}
+            self.input_shapes = {**self.input_shapes, disease: self._input_shape(model)}
+            self.shape_groups = self._group_models_by_shape()
+            self.models = models
+
+    def _reload_model(self, disease):
+        """Load a model the model manager unloaded; returns whether it worked"""
+        self._load_model(disease, self.model_paths[disease])
+        if self.model_status[disease]['state'] != 'ready':
+            return False
+        # Bring the model back into the graphs over the resident ones
+        self._build_combined_graphs()
+        return True
+
+    def unload_model(self, disease):
+        """Drop a model so its memory can be reclaimed; it reloads on next use"""
+        with self._load_condition:
+            self.models = {name: model for name, model in self.models.items() if name != disease}
+            self.backends = {
+                name: backend for name, backend in self.backends.items() if name != disease}
+            self.gradcam_generators = {
+                name: generator for name, generator in self.gradcam_generators.items()
+                if name != disease}
+            # Graphs built over several models hold on to this one too
+            group = self.backbone_groups.get(disease)
+            if group is not None:
+                self.backbone_groups = {
+                    name: other for name, other in self.backbone_groups.items()
+                    if other is not group}
+            in_graphs = group is not None or (
+                self.fused_fn is not None and disease in self.fused_diseases)
+            if in_graphs:
+                self.fused_fn = None
+        self.model_status[disease]['state'] = 'unloaded'
+        if in_graphs:
+            # Rebuilt over the models still resident
+            self._build_combined_graphs()
+        gc.collect()
+
+    def _build_combined_graphs(self):
+        """Shared-backbone groups and the fused graph, over the resident models"""
+        if getattr(settings, 'ML_SHARE_BACKBONES', True) and self.models:
+            self.build_backbone_groups()
+
+        if getattr(settings, 'ML_FUSED_INFERENCE', False) and self.models:
+            self.build_fused_model()
+
+    @property
+    def available_diseases(self):
+        """Diseases that can be served, whether resident or unloaded for now"""
+        return [
+            disease for disease in self.model_paths
+            if disease in self.input_shapes
+            and self.model_status.get(disease, {}).get('state') != 'failed'
+        ]
+
+    def _notify_loaded(self):
+        with self._load_condition:
+            self._load_condition.notify_all()
+
+    @property
+    def readiness(self):
+        """'ready', 'partial' (some models servable), 'loading' or 'failed'"""
+        available = self.available_diseases
+        if available and len(available) == len(self.model_status):
+            return 'ready'
+        if available:
+            return 'partial'
+        return 'failed' if self._loading_done else 'loading'
+
+    def wait_until_ready(self, timeout=None, partial=True):
+        """Block until the models are servable; returns the readiness
+
+        With partial=True this returns as soon as any model is ready,
+        otherwise once every model has finished loading.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._load_condition:
+            while not self._loading_done and not (partial and self.models):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._load_condition.wait(remaining)
+        return self.readiness
+
+    def load_report(self):
+        """Readiness plus per-model load state and timings"""
+        return {
+            'status': self.readiness,
+            'loading_complete': self._loading_done,
+            'models': {
+                disease: self._model_report(disease, status)
+                for disease, status in self.model_status.items()
+            },
+            'shared_backbones': [
+                group.report() for group in self._unique_backbone_groups()],
+            'model_manager': self.model_manager.stats(),
+        }
 
-    def generate_gradcam_for_prediction(self, image_path, disease, confidence_threshold=0.1):
-        """Generate Grad-CAM visualization for the predicted disease"""
+    def _model_report(self, disease, status):
+        report = dict(status)
+        backend = self.backends.get(disease)
+        engine_stats = backend.stats() if backend is not None else {}
+        if engine_stats:
+            report['engine'] = engine_stats
+        return report
+
+    @property
+    def model_set_version(self):
+        """Fingerprint of the loaded model files, for reusing stored predictions"""
+        fingerprint = ','.join(
+            f"{disease}:{self.model_versions.get(disease, '')}"
+            for disease in sorted(self.available_diseases))
+        return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+    def _unique_backbone_groups(self):
+        return list({id(group): group for group in self.backbone_groups.values()}.values())
+
+    def build_backbone_groups(self):
+        """Find models whose frozen backbones match so it runs once per image"""
         try:
-            if disease not in self.models or disease not in self.gradcam_generators:
-                logger.warning(
-                    f"Model or Grad-CAM generator not available for {disease}")
+            # Models on other engines keep running there
+            groups = find_shared_backbones({
+                disease: model for disease, model in self.models.items()
+                if self.backends[disease].fusable})
+        except Exception as e:
+            logger.error(f"Could not analyse model backbones: {str(e)}")
+            groups = []
+
+        for group in groups:
+            if group.separate_flops:
+                savings = (f"saving {group.flops_saved / 1e6:.1f} MFLOPs per image "
+                           f"({group.flops_saved / group.separate_flops:.0%} of their total)")
+            else:
+                savings = "FLOP savings unknown"
+            logger.info(
+                f"Shared backbone {group.backbone.name} for {', '.join(group.diseases)}: "
+                f"runs once instead of {len(group.diseases)} times, {savings}")
+
+        self.backbone_groups = {
+            disease: group for group in groups for disease in group.diseases}
+        return groups
+
+    def build_fused_model(self):
+        """Combine the loaded models into one multi-output graph behind a tf.function"""
+        try:
+            # Only resident models served by eager Keras join the graph; the
+            # others keep running on their configured engine or reload on use
+            models, backends, backbone_groups = self.models, self.backends, self.backbone_groups
+            keras_groups = {}
+            for input_shape, diseases in self.shape_groups.items():
+                keras_diseases = [
+                    disease for disease in diseases
+                    if disease in models and disease in backends
+                    and backends[disease].fusable]
+                if keras_diseases:
+                    keras_groups[input_shape] = keras_diseases
+            if not keras_groups:
+                self.fused_fn = None
                 return None
 
-            model = self.models[disease]
-            gradcam_gen = self.gradcam_generators[disease]
+            # One input per distinct shape; same-shape models share it
+            fused_shapes = list(keras_groups)
+            fused_diseases = []
+            inputs = []
+            outputs = []
+            for index, input_shape in enumerate(fused_shapes):
+                model_input = tf.keras.Input(
+                    shape=input_shape, name=f'xray_input_{index}')
+                inputs.append(model_input)
+                # Shared backbones appear once in the graph
+                features = {}
+                for disease in keras_groups[input_shape]:
+                    group = backbone_groups.get(disease)
+                    if group is not None:
+                        if id(group) not in features:
+                            features[id(group)] = group.features(model_input)
+                        output = group.heads[disease](features[id(group)], training=False)
+                    else:
+                        output = models[disease](model_input, training=False)
+                    outputs.append(output)
+                    fused_diseases.append(disease)
+
+            fused_model = tf.keras.Model(
+                inputs, outputs, name='fused_chest_models')
+
+            # Fixed signature so the graph is traced exactly once
+            input_signature = [
+                tf.TensorSpec(shape=(None,) + input_shape, dtype=tf.float32)
+                for input_shape in fused_shapes
+            ]
+
+            @tf.function(input_signature=input_signature)
+            def fused_fn(*batches):
+                return fused_model(list(batches), training=False)
+
+            # Warm up so the first request doesn't pay for tracing
+            fused_fn(*[tf.zeros((1,) + input_shape, dtype=tf.float32)
+                       for input_shape in fused_shapes])
+
+            # Published together: run_models reads all three
+            with self._load_condition:
+                self.fused_shapes = fused_shapes
+                self.fused_diseases = fused_diseases
+                self.fused_fn = fused_fn
+            logger.info(
+                f"Fused inference graph built for: {', '.join(self.fused_diseases)}")
 
-            # Preprocess image
-            processed_image = self.preprocess_image(image_path, model)
+        except Exception as e:
+            logger.error(f"Could not build fused inference graph: {str(e)}")
+            self.fused_fn = None
 
-            # Generate Grad-CAM heatmap
-            heatmap = gradcam_gen.generate_gradcam(processed_image)
+        return self.fused_fn
 
-            if heatmap is None:
-                logger.warning(f"Failed to generate Grad-CAM for {disease}")
-                return None
+    def _input_shape(self, model):
+        """Return the (height, width, channels) shape a model expects"""
+        return tuple(model.input_shape[1:])
 
-            # Create overlay image
-            overlay_image = gradcam_gen.create_overlay_image(
-                image_path, heatmap)
+    def _group_models_by_shape(self):
+        """Group the servable models by input shape so they can share one tensor"""
+        shape_groups = {}
+        for disease in self.model_paths:
+            if disease in self.input_shapes:
+                shape_groups.setdefault(self.input_shapes[disease], []).append(disease)
+        return shape_groups
 
-            if overlay_image is None:
-                logger.warning(f"Failed to create overlay image for {disease}")
-                return None
+    def load_image(self, image_path):
+        """Open and decode an X-ray image once, as RGB"""
+        return preprocessing.load_image(image_path)
 
-            # Convert to PIL Image and save to BytesIO
-            overlay_pil = Image.fromarray(overlay_image)
-            buffer = BytesIO()
-            overlay_pil.save(buffer, format='PNG')
-            buffer.seek(0)
+    def resize_for_shape(self, image, input_shape):
+        """Resize a decoded image to an input shape and normalise it to float32"""
+        return preprocessing.resize_for_shape(image, input_shape)
 
-            return ContentFile(buffer.getvalue(), name=f'gradcam_{disease}.png')
+    def preprocess_for_models(self, image):
+        """Produce one preprocessed tensor per distinct model input shape"""
+        return preprocessing.preprocess_for_shapes(image, self.shape_groups)
+
+    def preprocess_image(self, image_path, model):
+        """Preprocess image to match specific model's requirements"""
+        return self.resize_for_shape(
+            self.load_image(image_path), self._input_shape(model))
+
+    def generate_gradcam_for_prediction(self, image_path, disease, confidence_threshold=0.1,
+                                        refresh_cache=False):
+        """Generate Grad-CAM visualization for the predicted disease"""
+        return self.generate_gradcams(
+            image_path, [disease], refresh_cache=refresh_cache).get(disease)
+
+    def generate_gradcams(self, image_path, diseases, image=None, refresh_cache=False,
+                          fast_encoding=False):
+        """Generate Grad-CAM visualizations for several diseases in one go
+
+        The image is decoded once, models with the same input shape share
+        one tensor and independent models run concurrently. Overlays are
+        served from the Grad-CAM cache when possible; refresh_cache skips
+        the lookup and overwrites the entries. Overlays are encoded in
+        ML_GRADCAM_FORMAT; fast_encoding trades size for encoding time.
+        Returns a dict of disease -> GradCAMFile, carrying its heatmap, for
+        the diseases that succeeded.
+        """
+        try:
+            with self.model_manager.use(
+                    [disease for disease in diseases if disease in self.available_diseases]):
+                available = []
+                for disease in diseases:
+                    if disease not in self.models or disease not in self.gradcam_generators:
+                        logger.warning(
+                            f"Model or Grad-CAM generator not available for {disease}")
+                    else:
+                        available.append(disease)
+
+                if not available:
+                    return {}
+
+                # Look up cached overlays by (image content, disease, model, layer)
+                gradcam_files = {}
+                cache_keys = {}
+                gradcam_cache = get_gradcam_cache()
+                if gradcam_cache is not None:
+                    image_hash = sha256_file(image_path)
+                    for disease in available:
+                        cache_keys[disease] = GradCAMCacheKey(
+                            image_hash, disease, self.model_versions.get(disease, ''),
+                            self.gradcam_generators[disease].layer_name,
+                            rendering.render_signature(), rendering.stored_format())
+                        cached = None if refresh_cache else gradcam_cache.get(
+                            cache_keys[disease])
+                        # Predictions store the heatmap along with the
+                        # overlay, so an overlay is only a hit with its heatmap
+                        heatmap = None if cached is None else gradcam_cache.get(
+                            cache_keys[disease].heatmap_key)
+                        if heatmap is not None:
+                            gradcam_files[disease] = rendering.GradCAMFile(
+                                cached,
+                                name=f'gradcam_{disease}.{cache_keys[disease].image_format}',
+                                heatmap=rendering.unpack_heatmaps(heatmap).get(disease))
+                    available = [
+                        disease for disease in available if disease not in gradcam_files]
+                    if not available:
+                        return gradcam_files
+
+                if image is None:
+                    image = self.load_image(image_path)
+                heatmaps = self._compute_heatmaps(image, available)
+                rendered = self._render_gradcams(image, heatmaps, fast_encoding)
+
+                if gradcam_cache is not None:
+                    for disease, gradcam_file in rendered.items():
+                        gradcam_cache.put(cache_keys[disease], gradcam_file.read())
+                        gradcam_file.seek(0)
+                        gradcam_cache.put(
+                            cache_keys[disease].heatmap_key,
+                            rendering.pack_heatmaps({disease: gradcam_file.heatmap}))
+
+                gradcam_files.update(rendered)
+                return gradcam_files
 
         except Exception as e:
-            logger.error(f"Error generating Grad-CAM for {disease}: {str(e)}")
-            return None
+            logger.error(
+                f"Error generating Grad-CAM for {', '.join(diseases)}: {str(e)}")
+            return {}
 
-    def predict(self, image_path):
-        """Make predictions using all loaded models"""
+    def generate_heatmaps(self, image_path, diseases):
+        """Raw Grad-CAM heatmaps for several diseases, without rendering them
+
+        Returns a dict of disease -> float16 heatmap at conv resolution for
+        the diseases that succeeded.
+        """
         try:
-            # Check if any models are loaded
-            if not self.models:
-                raise Exception("No ML models are loaded")
+            with self.model_manager.use(
+                    [disease for disease in diseases if disease in self.available_diseases]):
+                available = [
+                    disease for disease in diseases
+                    if disease in self.models and disease in self.gradcam_generators
+                ]
+                if not available:
+                    return {}
+                heatmaps = self._compute_heatmaps(self.load_image(image_path), available)
+                return {
+                    disease: rendering.compact_heatmap(heatmap)
+                    for disease, heatmap in heatmaps.items() if heatmap is not None
+                }
 
-            predictions = {}
+        except Exception as e:
+            logger.error(
+                f"Error generating heatmaps for {', '.join(diseases)}: {str(e)}")
+            return {}
+
+    def _compute_heatmaps(self, image, diseases):
+        """Heatmaps (None where generation failed) for a decoded image,
+        preprocessing once per distinct input shape"""
+        inputs = {}
+        for disease in diseases:
+            input_shape = self._input_shape(self.models[disease])
+            if input_shape not in inputs:
+                inputs[input_shape] = self.resize_for_shape(image, input_shape)
+
+        def heatmap_for(disease):
+            processed_image = inputs[self._input_shape(self.models[disease])]
+            return self.gradcam_generators[disease].generate_gradcam(processed_image)
+
+        return dict(zip(diseases, self.gradcam_executor.map(heatmap_for, diseases)))
+
+    def _render_gradcams(self, image, heatmaps, fast_encoding=False):
+        """Overlay and encode several heatmaps on one decoded image concurrently"""
+        # Convert and downscale the X-ray once for every disease
+        image = rendering.prepare_base(image)
+
+        def render(item):
+            disease, heatmap = item
+            if heatmap is None:
+                logger.warning(f"Failed to generate Grad-CAM for {disease}")
+                return disease, None
 
-            # Make predictions with each model
-            for disease, model in self.models.items():
-                try:
-                    processed_image = self.preprocess_image(image_path, model)
-                    prediction = model.predict(processed_image, verbose=0)
+            overlay_image = self.gradcam_generators[disease].create_overlay_image(
+                image, heatmap)
+            if overlay_image is None:
+                logger.warning(f"Failed to create overlay image for {disease}")
+                return disease, None
 
-                    # Better prediction handling
-                    if prediction is None or len(prediction) == 0:
-                        logger.warning(
-                            f"Model {disease} returned empty prediction")
-                        confidence = 0.0
-                    else:
-                        # Handle different prediction output formats
-                        pred_array = prediction[0]
-                        if pred_array.shape[0] == 1:
-                            confidence = float(pred_array[0])
-                        else:
-                            confidence = float(np.max(pred_array))
+            return disease, rendering.encode_gradcam(
+                overlay_image, f'gradcam_{disease}', fast=fast_encoding,
+                heatmap=rendering.compact_heatmap(heatmap))
 
-                        # Ensure confidence is a valid number
-                        if np.isnan(confidence) or np.isinf(confidence):
-                            logger.warning(
-                                f"Invalid confidence score for {disease}: {confidence}")
-                            confidence = 0.0
+        return {
+            disease: gradcam_file
+            for disease, gradcam_file in self.gradcam_executor.map(render, heatmaps.items())
+            if gradcam_file is not None
+        }
 
-                        # Clamp confidence between 0 and 1
-                        confidence = max(0.0, min(1.0, confidence))
+    def _extract_confidence(self, disease, prediction):
+        """Turn a raw model output batch into a clamped confidence score"""
+        return extract_confidence(disease, prediction)
+
+    def run_models(self, inputs, use_fused=True):
+        """Run every loaded model on preprocessed inputs, keyed by input shape"""
+        with self.model_manager.use(self.available_diseases):
+            by_disease = {}
+            # Rebuilt when models unload or reload, so read it as one
+            with self._load_condition:
+                fused_fn, fused_shapes, fused_diseases = (
+                    self.fused_fn, self.fused_shapes, self.fused_diseases)
+            if use_fused and fused_fn is not None:
+                try:
+                    fused_outputs = fused_fn(
+                        *[inputs[input_shape] for input_shape in fused_shapes])
+                    by_disease = {
+                        disease: output.numpy()
+                        for disease, output in zip(fused_diseases, fused_outputs)
+                    }
+                except Exception as e:
+                    logger.error(
+                        f"Fused inference failed, falling back to per-model loop: {str(e)}")
 
-                    predictions[disease] = confidence
-                    logger.info(f"Prediction for {disease}: {confidence:.4f}")
+            # Models sharing a backbone run it once
+            if not by_disease:
+                by_disease = self._run_backbone_groups(inputs)
 
+            # Keep the configured disease order; models outside the fused graph
+            # run one by one
+            outputs = {}
+            for disease, model in self.models.items():
+                if disease in by_disease:
+                    outputs[disease] = by_disease[disease]
+                    continue
+                if self._input_shape(model) not in inputs:
+                    # Finished loading after these inputs were prepared
+                    continue
+                try:
+                    outputs[disease] = self.backends[disease].predict_batch(
+                        inputs[self._input_shape(model)])
                 except Exception as e:
                     logger.error(f"Error predicting {disease}: {str(e)}")
-                    predictions[disease] = 0.0
-
-            # Validate predictions
-            if not predictions:
-                raise Exception("No predictions were generated")
+                    outputs[disease] = None
+            return outputs
+
+    def _run_backbone_groups(self, inputs):
+        """Outputs of every model in a shared-backbone group, keyed by disease"""
+        outputs = {}
+        for group in self._unique_backbone_groups():
+            if group.input_shape not in inputs:
+                continue
+            try:
+                outputs.update(group.predict(inputs[group.input_shape]))
+            except Exception as e:
+                logger.error(
+                    f"Shared backbone inference failed for {', '.join(group.diseases)}, "
+                    f"running the models separately: {str(e)}")
+        return outputs
+
+    def summarise_outputs(self, outputs):
+        """Turn raw per-disease model outputs into the prediction result dict"""
+        predictions = {}
+        for disease, prediction in outputs.items():
+            confidence = self._extract_confidence(disease, prediction)
+            predictions[disease] = confidence
+            logger.info(f"Prediction for {disease}: {confidence:.4f}")
+
+        # Validate predictions
+        if not predictions:
+            raise Exception("No predictions were generated")
+
+        # Find the disease with highest confidence
+        valid_predictions = {
+            k: v for k, v in predictions.items() if v is not None and not np.isnan(v)}
+
+        if not valid_predictions:
+            raise Exception("All predictions returned invalid values")
+
+        best_prediction = max(
+            valid_predictions.items(), key=lambda x: x[1])
+
+        # Ensure we have valid results
+        predicted_disease = best_prediction[0]
+        confidence_score = best_prediction[1]
+
+        # Final validation
+        if predicted_disease is None or confidence_score is None:
+            raise Exception("Best prediction contains null values")
+
+        if np.isnan(confidence_score) or np.isinf(confidence_score):
+            raise Exception(
+                f"Best prediction confidence is invalid: {confidence_score}")
+
+        result = {
+            'predicted_disease': predicted_disease,
+            'confidence_score': confidence_score,
+            'all_predictions': valid_predictions
+        }
 
-            # Find the disease with highest confidence
-            valid_predictions = {
-                k: v for k, v in predictions.items() if v is not None and not np.isnan(v)}
+        logger.info(f"Final prediction result: {result}")
+        return result
 
-            if not valid_predictions:
-                raise Exception("All predictions returned invalid values")
+    def predict(self, image_path, inputs=None):
+        """Make predictions using all loaded models
 
-            best_prediction = max(
-                valid_predictions.items(), key=lambda x: x[1])
+        inputs are already preprocessed tensors keyed by input shape, if the
+        caller has them.
+        """
+        try:
+            with self.model_manager.use(self.available_diseases):
+                # Check if any models are loaded
+                if not self.models:
+                    raise Exception("No ML models are loaded")
 
-            # Ensure we have valid results
-            predicted_disease = best_prediction[0]
-            confidence_score = best_prediction[1]
+                if inputs is None:
+                    # Decode once and build one tensor per distinct input shape
+                    image = self.load_image(image_path)
+                    inputs = self.preprocess_for_models(image)
 
-            # Final validation
-            if predicted_disease is None or confidence_score is None:
-                raise Exception("Best prediction contains null values")
+                # Make predictions with each model (one call when fused)
+                return self.summarise_outputs(self.run_models(inputs))
 
-            if np.isnan(confidence_score) or np.isinf(confidence_score):
-                raise Exception(
-                    f"Best prediction confidence is invalid: {confidence_score}")
+        except Exception as e:
+            logger.error(f"Prediction error: {str(e)}")
+            raise
 
-            result = {
-                'predicted_disease': predicted_disease,
-                'confidence_score': confidence_score,
-                'all_predictions': valid_predictions
-            }
+    def predict_and_explain(self, image_path, secondary_threshold=None, inputs=None):
+        """Predict all diseases and build Grad-CAMs from the same forward pass
 
-            logger.info(f"Final prediction result: {result}")
-            return result
+        Returns (result, gradcam_files), a dict of disease -> ContentFile
+        holding the predicted disease and, when secondary_threshold is
+        given, every other disease whose confidence exceeds it. inputs are
+        already preprocessed tensors keyed by input shape, if the caller
+        has them.
+        """
+        try:
+            with self.model_manager.use(self.available_diseases):
+                # Check if any models are loaded
+                if not self.models:
+                    raise Exception("No ML models are loaded")
+
+                image = None
+                if inputs is None:
+                    image = self.load_image(image_path)
+                    inputs = self.preprocess_for_models(image)
+
+                # Each compiled Grad-CAM step returns the model outputs along with
+                # the heatmap. Its backward pass only runs through the layers above
+                # the target conv layer, so it is cheap next to the forward pass.
+                # Models sharing a backbone are cheaper to run together, with
+                # Grad-CAMs afterwards for only the diseases that need one
+                shared_outputs = self._run_backbone_groups(inputs)
+                outputs = {}
+                heatmaps = {}
+                for disease, model in self.models.items():
+                    processed_image = inputs.get(self._input_shape(model))
+                    if processed_image is None:
+                        # Finished loading after these inputs were prepared
+                        continue
+                    if disease in shared_outputs:
+                        outputs[disease] = shared_outputs[disease]
+                        continue
+                    gradcam_gen = self.gradcam_generators.get(disease)
+                    backend = self.backends[disease]
+                    # Use the Grad-CAM step's outputs only where they match the
+                    # backend's exactly
+                    explained = gradcam_gen.explain(
+                        processed_image) if gradcam_gen and backend.shares_gradcam_pass else None
+
+                    if explained is None:
+                        try:
+                            outputs[disease] = backend.predict_batch(processed_image)
+                        except Exception as e:
+                            logger.error(f"Error predicting {disease}: {str(e)}")
+                            outputs[disease] = None
+                    else:
+                        outputs[disease], heatmaps[disease] = explained
+
+                result = self.summarise_outputs(outputs)
+
+                predicted_disease = result['predicted_disease']
+                explain_diseases = [predicted_disease]
+                if secondary_threshold is not None:
+                    explain_diseases += [
+                        disease for disease, confidence in result['all_predictions'].items()
+                        if disease != predicted_disease and confidence > secondary_threshold
+                    ]
+
+                # Models served by other engines (XLA, TFLite) or a shared
+                # backbone get their heatmaps from the Keras model now that we
+                # know which are needed
+                missing = [
+                    disease for disease in explain_diseases
+                    if disease not in heatmaps and disease in self.gradcam_generators
+                    and self._input_shape(self.models[disease]) in inputs
+                ]
+                heatmaps.update(zip(missing, self.gradcam_executor.map(
+                    lambda disease: self.gradcam_generators[disease].generate_gradcam(
+                        inputs[self._input_shape(self.models[disease])]),
+                    missing)))
+
+                explain_heatmaps = {
+                    disease: heatmaps[disease]
+                    for disease in explain_diseases if disease in heatmaps
+                }
+                if explain_heatmaps and image is None:
+                    # The overlays are drawn on the full-resolution image
+                    image = self.load_image(image_path)
+                gradcam_files = self._render_gradcams(image, explain_heatmaps)
+
+                return result, gradcam_files
 
         except Exception as e:
             logger.error(f"Prediction error: {str(e)}")
             raise
 
 
-# Global predictor instance
-predictor = ChestXrayPredictor()
+def __getattr__(name):
+    # Backwards compatible ``from ml_predict.utils import predictor``; the
+    # shared instance now lives in ml_predict.inference and loads lazily
+    if name == 'predictor':
+        from .inference import get_local_predictor
+        return get_local_predictor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
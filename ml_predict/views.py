@@ -1,21 +1,70 @@
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, Http404
-from .models import PredictionResult
-from .serializers import XrayPredictionSerializer, PredictionResultSerializer
-from .utils import predictor
+from django.urls import reverse
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.cache import patch_vary_headers
+from .models import PredictionJob, PredictionResult
+from .serializers import (
+    XrayPredictionSerializer, PredictionResultSerializer, PredictionJobSerializer)
+from .inference import (
+    get_predictor, get_remote_predictor, predictor_loaded, predictor_readiness, warm_up)
+from .batching import scheduler_stats, SchedulerBusy
+from .gradcam_cache import GradCAMCacheKey, get_gradcam_cache, gradcam_cache_stats
+from .jobs import enqueue_prediction, job_stats
+from .admission import AdmissionRejected, admission_stats, get_admission_controller, request_lane
+from .deferred_gradcam import deferred_gradcam_stats, ensure_scheduled, is_overdue
+from .latency_budget import LatencyBudget, stage_timing_stats
+from .negotiation import image_aware_negotiation
+from .pipeline import find_memoised_prediction, reuse_prediction, run_prediction
+from .hashing import ContentHashUploadHandler, sha256_chunks, sha256_file
+from .preprocessing import load_image
+from . import rendering
+from .single_flight import SingleFlightTimeout, claim, flight_key, single_flight_stats
 from dashboard.models import Patient
+import hashlib
 import logging
-import numpy as np
 import os
+from contextlib import ExitStack
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 
+def _image_hash(prediction):
+    """Content hash of a prediction's X-ray (older rows predate content_hash)"""
+    return prediction.content_hash or sha256_file(prediction.xray_image.path)
+
+
+def _single_flight_timeout_response(e):
+    logger.warning(str(e))
+    response = Response({
+        'success': False,
+        'message': 'The same request is still being processed, please retry shortly'
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(
+        max(1, getattr(settings, 'ML_SINGLE_FLIGHT_TIMEOUT_SECONDS', 60) // 4))
+    return response
+
+
+def _reuse_prediction(prediction_result, prior):
+    """Respond with a new prediction filled from a prior one for the same image"""
+    gradcam_available = reuse_prediction(prediction_result, prior)
+
+    result_serializer = PredictionResultSerializer(prediction_result)
+    return Response({
+        'success': True,
+        'message': 'Prediction completed successfully',
+        'data': result_serializer.data,
+        'gradcam_available': gradcam_available,
+        'gradcam_status': prediction_result.gradcam_status,
+        'available_diseases': list(prediction_result.all_predictions.keys()),
+        'reused_prediction_id': prior.id
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def predict_chest_disease(request):
@@ -23,6 +72,16 @@ def predict_chest_disease(request):
     Predict chest disease from X-ray image with Grad-CAM visualization
     """
     prediction_result = None
+    # Holds the single-flight claim on this X-ray and the inference slot
+    # until the response is built
+    held = ExitStack()
+    # Starts now, so time spent waiting for a slot counts against it
+    budget = LatencyBudget(
+        getattr(settings, 'ML_PREDICTION_BUDGET_MS', 0),
+        getattr(settings, 'ML_PREDICTION_BUDGET_RESERVE_MS', 200))
+
+    # Hash the upload while it streams in (before request.data is parsed)
+    request.upload_handlers.insert(0, ContentHashUploadHandler(request._request))
 
     try:
         serializer = XrayPredictionSerializer(data=request.data)
@@ -33,106 +92,60 @@ def predict_chest_disease(request):
             # Get patient
             patient = get_object_or_404(Patient, id=patient_id)
 
+            content_hash = getattr(request, 'upload_content_hashes', {}).get(
+                'xray_image') or sha256_chunks(xray_image)
+            predictor = get_predictor()
+            model_version = predictor.model_set_version
+
             # Create prediction result instance but don't save yet
             prediction_result = PredictionResult(
                 patient=patient,
-                xray_image=xray_image
+                xray_image=xray_image,
+                content_hash=content_hash,
+                model_version=model_version
             )
 
+            async_mode = getattr(settings, 'ML_ASYNC_PREDICTIONS', False)
+
+            # Byte-identical X-ray already scored by the same models: reuse it
+            if getattr(settings, 'ML_PREDICTION_MEMOIZATION', True) and predictor.available_diseases:
+                # Concurrent uploads of the same X-ray wait for the first one
+                # to be scored, then reuse its result (job workers do the
+                # same for queued ones)
+                if not async_mode:
+                    held.enter_context(
+                        claim(flight_key('predict', content_hash, model_version)))
+                prior = find_memoised_prediction(content_hash, model_version)
+                if prior is not None:
+                    return _reuse_prediction(prediction_result, prior)
+
+            # Wait for an inference slot in the request's lane before
+            # storing anything
+            controller = get_admission_controller()
+            if controller is not None and not async_mode:
+                held.enter_context(controller.admit(request_lane(
+                    patient, serializer.validated_data.get('appointment_id'))))
+
             # Save to get the file path (needed for prediction)
             prediction_result.save()
 
+            if async_mode:
+                # Score it in a job worker; the client polls the job
+                job = enqueue_prediction(prediction_result, request.user)
+                job.refresh_from_db()
+                response = Response({
+                    'success': True,
+                    'message': 'Prediction queued',
+                    'data': PredictionJobSerializer(job).data,
+                }, status=status.HTTP_202_ACCEPTED)
+                response['Location'] = request.build_absolute_uri(
+                    reverse('get_prediction_job', args=[job.id]))
+                return response
+
             # Make prediction
             try:
-                logger.info(
-                    f"Starting prediction for image: {prediction_result.xray_image.path}")
-
-                # Check if predictor has loaded models
-                if not predictor.models:
-                    raise Exception(
-                        "No ML models loaded. Please check model files and logs.")
-
-                # Make the prediction
-                prediction = predictor.predict(
-                    prediction_result.xray_image.path)
-
-                # Validation code (same as before)...
-                if not prediction:
-                    raise Exception("Prediction returned None or empty result")
-
-                required_keys = ['predicted_disease',
-                                 'confidence_score', 'all_predictions']
-                missing_keys = [
-                    key for key in required_keys if key not in prediction]
-                if missing_keys:
-                    raise Exception(
-                        f"Prediction missing required keys: {missing_keys}")
-
-                predicted_disease = prediction['predicted_disease']
-                if predicted_disease is None or predicted_disease == '':
-                    raise Exception("Predicted disease is null or empty")
-
-                confidence_score = prediction['confidence_score']
-                if confidence_score is None or np.isnan(confidence_score) or np.isinf(confidence_score):
-                    raise Exception(
-                        f"Invalid confidence score: {confidence_score}")
-
-                all_predictions = prediction['all_predictions']
-                if all_predictions is None:
-                    raise Exception("All predictions is null")
-
-                # Update prediction result with validated data
-                prediction_result.predicted_disease = predicted_disease
-                prediction_result.confidence_score = float(confidence_score)
-                prediction_result.all_predictions = all_predictions
-                prediction_result.save()
-
-                # Generate Grad-CAM visualization for the predicted disease (primary)
-                logger.info(
-                    f"Generating Grad-CAM for primary prediction: {predicted_disease}")
-                gradcam_available = False
-
-                try:
-                    gradcam_file = predictor.generate_gradcam_for_prediction(
-                        prediction_result.xray_image.path,
-                        predicted_disease
-                    )
-
-                    if gradcam_file:
-                        prediction_result.gradcam_image.save(
-                            f'gradcam_{prediction_result.id}_{predicted_disease}.png',
-                            gradcam_file,
-                            save=True
-                        )
-                        logger.info(
-                            "Primary Grad-CAM image generated and saved successfully")
-                        gradcam_available = True
-                    else:
-                        logger.warning("Primary Grad-CAM generation failed")
-
-                except Exception as gradcam_error:
-                    logger.error(
-                        f"Primary Grad-CAM generation error: {str(gradcam_error)}")
-
-                # OPTIONAL: Generate Grad-CAM for other diseases with high confidence
-                # Uncomment this section if you want to pre-generate Grad-CAM for all diseases
-                """
-                CONFIDENCE_THRESHOLD = 0.3  # Adjust as needed
-                for disease, confidence in all_predictions.items():
-                    if disease != predicted_disease and confidence > CONFIDENCE_THRESHOLD:
-                        try:
-                            logger.info(f"Generating additional Grad-CAM for {disease} (confidence: {confidence:.3f})")
-                            additional_gradcam = predictor.generate_gradcam_for_prediction(
-                                prediction_result.xray_image.path,
-                                disease
-                            )
-                            if additional_gradcam:
-                                # You could save these to a separate field or file system
-                                # For now, we'll just log success
-                                logger.info(f"Additional Grad-CAM for {disease} generated successfully")
-                        except Exception as e:
-                            logger.warning(f"Failed to generate additional Grad-CAM for {disease}: {str(e)}")
-                """
+                gradcam_available = run_prediction(
+                    prediction_result, predictor, budget=budget)
 
                 # Serialize and return result
                 result_serializer = PredictionResultSerializer(
@@ -143,10 +156,25 @@ def predict_chest_disease(request):
                     'message': 'Prediction completed successfully',
                     'data': result_serializer.data,
                     'gradcam_available': gradcam_available,
+                    'gradcam_status': prediction_result.gradcam_status,
                     # Let frontend know which diseases are available
-                    'available_diseases': list(all_predictions.keys())
+                    'available_diseases': list(prediction_result.all_predictions.keys()),
+                    # Stages dropped to stay within the latency budget
+                    'skipped_stages': budget.dropped,
+                    'latency': budget.report()
                 }, status=status.HTTP_200_OK)
 
+            except SchedulerBusy as e:
+                # The batching queue (in-process or in the daemon) is full
+                logger.warning(f"Prediction rejected: {str(e)}")
+                prediction_result.delete()
+                response = Response({
+                    'success': False,
+                    'message': 'Prediction service is busy, please retry shortly'
+                }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                response['Retry-After'] = '1'
+                return response
+
             except Exception as e:
                 logger.error(f"Prediction error: {str(e)}")
                 if prediction_result and prediction_result.id:
@@ -161,7 +189,7 @@ def predict_chest_disease(request):
                     'message': f'Prediction failed: {str(e)}',
                     'debug_info': {
                         'models_loaded': len(predictor.models) if predictor.models else 0,
-                        'available_models': list(predictor.models.keys()) if predictor.models else []
+                        'available_models': predictor.available_diseases
                     }
                 }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -172,6 +200,19 @@ def predict_chest_disease(request):
                 'errors': serializer.errors
             }, status=status.HTTP_400_BAD_REQUEST)
 
+    except SingleFlightTimeout as e:
+        return _single_flight_timeout_response(e)
+
+    except AdmissionRejected as e:
+        logger.warning(f"Prediction rejected: {str(e)}")
+        response = Response({
+            'success': False,
+            'message': 'Too many predictions in progress, please retry shortly',
+            'lane': e.lane
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
         if prediction_result and prediction_result.id:
@@ -186,7 +227,63 @@ def predict_chest_disease(request):
             'message': f'Server error: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    finally:
+        held.close()
+
+
+def _gradcam_file_response(request, gradcam_image, filename):
+    """Return a stored Grad-CAM image file as an inline image response
 
+    The ETag changes whenever the file is regenerated, so clients can
+    revalidate cheaply instead of re-downloading the image.
+    """
+    # Check if file exists
+    try:
+        stat = os.stat(gradcam_image.path)
+    except OSError:
+        logger.error(
+            f"Grad-CAM file does not exist: {gradcam_image.path}")
+        raise Http404("Grad-CAM file not found on disk")
+
+    etag = '"{}"'.format(hashlib.sha256(
+        f"{gradcam_image.name}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:32])
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        # Open and return the image file
+        try:
+            with open(gradcam_image.path, 'rb') as f:
+                response = HttpResponse(f.read(), content_type=rendering.IMAGE_FORMATS[
+                    rendering.format_for_name(gradcam_image.name)][1])
+        except IOError as e:
+            logger.error(f"Error reading Grad-CAM file: {str(e)}")
+            raise Http404("Could not read Grad-CAM image file")
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _negotiated_gradcam_response(request, prediction, disease, gradcam_image, name):
+    """Serve a stored Grad-CAM in the format the Accept header prefers,
+    re-encoding it from the stored heatmap when that isn't the stored one"""
+    stored_format = rendering.format_for_name(gradcam_image.name)
+    image_format = rendering.negotiate_format(
+        request.headers.get('Accept'), preferred=stored_format)
+    heatmap = prediction.get_heatmaps().get(disease) if image_format != stored_format else None
+    if heatmap is not None:
+        response = _overlay_response(
+            request, prediction, disease, heatmap, image_format, rendering.max_resolution(),
+            rendering.DEFAULT_ALPHA, getattr(settings, 'ML_GRADCAM_COLORMAP', 'jet'))
+    else:
+        response = _gradcam_file_response(
+            request, gradcam_image, f'{name}.{stored_format}')
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+@image_aware_negotiation
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_gradcam_image(request, prediction_id):
@@ -207,89 +304,234 @@ def get_gradcam_image(request, prediction_id):
         # Get disease parameter if provided (for multiple disease support)
         disease = request.GET.get('disease')
 
+        # Grad-CAMs still being built after the response: ask to come back
+        if prediction.gradcam_status in ('pending', 'running') and not is_overdue(prediction) \
+                and not prediction.get_gradcam_file(disease or prediction.predicted_disease):
+            ensure_scheduled(prediction)
+            response = Response({
+                'success': True,
+                'message': 'Grad-CAM is being generated',
+                'gradcam_status': prediction.gradcam_status
+            }, status=status.HTTP_202_ACCEPTED)
+            response['Retry-After'] = '2'
+            return response
+
+        predictor = get_predictor()
+
         if disease and disease != prediction.predicted_disease:
-            # Generate Grad-CAM for different disease if requested
-            logger.info(
-                f"Generating Grad-CAM for different disease: {disease}")
-            try:
-                gradcam_file = predictor.generate_gradcam_for_prediction(
-                    prediction.xray_image.path,
-                    disease
-                )
+            # Serve the stored Grad-CAM for a different disease, generating
+            # and storing it on first request
+            gradcam_image = prediction.get_gradcam_file(disease)
+            if not gradcam_image:
+                with claim(flight_key('gradcam', _image_hash(prediction), disease)) as leader:
+                    if not leader:
+                        # Another request was generating it; use what it stored
+                        gradcam_image = prediction.get_gradcam_file(disease)
+                    if not gradcam_image:
+                        logger.info(
+                            f"Generating Grad-CAM for different disease: {disease}")
+                        try:
+                            gradcam_file = predictor.generate_gradcam_for_prediction(
+                                prediction.xray_image.path,
+                                disease
+                            )
+                        except Exception as e:
+                            logger.error(
+                                f"Error generating Grad-CAM for {disease}: {str(e)}")
+                            raise Http404(f"Grad-CAM generation failed for {disease}")
 
-                if gradcam_file:
-                    # Read the content from ContentFile properly
-                    gradcam_file.seek(0)  # Make sure we're at the beginning
-                    image_data = gradcam_file.read()
-
-                    response = HttpResponse(
-                        image_data, content_type='image/png')
-                    response['Content-Disposition'] = f'inline; filename="gradcam_{prediction_id}_{disease}.png"'
-                    response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                    response['Pragma'] = 'no-cache'
-                    response['Expires'] = '0'
-                    return response
-                else:
-                    raise Http404(
-                        f"Could not generate Grad-CAM for disease: {disease}")
+                        if not gradcam_file:
+                            raise Http404(
+                                f"Could not generate Grad-CAM for disease: {disease}")
+                        gradcam_image = prediction.save_gradcam(disease, gradcam_file)
 
-            except Exception as e:
-                logger.error(
-                    f"Error generating Grad-CAM for {disease}: {str(e)}")
-                raise Http404(f"Grad-CAM generation failed for {disease}")
+            return _negotiated_gradcam_response(
+                request, prediction, disease, gradcam_image, f'gradcam_{prediction_id}_{disease}')
 
         # Default behavior - serve the saved Grad-CAM image
         if not prediction.gradcam_image:
-            # Try to generate it if it doesn't exist
-            logger.info(
-                f"Grad-CAM not found, attempting to generate for {prediction.predicted_disease}")
-            try:
-                gradcam_file = predictor.generate_gradcam_for_prediction(
-                    prediction.xray_image.path,
-                    prediction.predicted_disease
-                )
+            with claim(flight_key(
+                    'gradcam', _image_hash(prediction), prediction.predicted_disease)) as leader:
+                if not leader:
+                    # Another request was generating it; use what it stored
+                    prediction.refresh_from_db()
+                if not prediction.gradcam_image:
+                    # Try to generate it if it doesn't exist
+                    logger.info(
+                        f"Grad-CAM not found, attempting to generate for {prediction.predicted_disease}")
+                    try:
+                        gradcam_file = predictor.generate_gradcam_for_prediction(
+                            prediction.xray_image.path,
+                            prediction.predicted_disease
+                        )
 
-                if gradcam_file:
-                    prediction.gradcam_image.save(
-                        f'gradcam_{prediction.id}_{prediction.predicted_disease}.png',
-                        gradcam_file,
-                        save=True
-                    )
-                else:
-                    raise Http404("Grad-CAM image could not be generated")
-            except Exception as e:
-                logger.error(f"Error generating missing Grad-CAM: {str(e)}")
-                raise Http404(
-                    "Grad-CAM image not available and could not be generated")
+                        if gradcam_file:
+                            prediction.save_gradcam(
+                                prediction.predicted_disease, gradcam_file)
+                        else:
+                            raise Http404("Grad-CAM image could not be generated")
+                    except Exception as e:
+                        logger.error(f"Error generating missing Grad-CAM: {str(e)}")
+                        raise Http404(
+                            "Grad-CAM image not available and could not be generated")
 
-        # Check if file exists
-        if not os.path.exists(prediction.gradcam_image.path):
-            logger.error(
-                f"Grad-CAM file does not exist: {prediction.gradcam_image.path}")
-            raise Http404("Grad-CAM file not found on disk")
+        return _negotiated_gradcam_response(
+            request, prediction, prediction.predicted_disease, prediction.gradcam_image,
+            f'gradcam_{prediction_id}')
+
+    except Http404:
+        raise
+    except SingleFlightTimeout as e:
+        return _single_flight_timeout_response(e)
+    except Exception as e:
+        logger.error(f"Error serving Grad-CAM image: {str(e)}")
+        return Response({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+
+def _overlay_options(params, prediction):
+    """(disease, image_format, size, alpha, colormap) from the query
+    string; raises ValueError for values that can't be rendered"""
+    disease = params.get('disease') or prediction.predicted_disease
+    if disease not in (prediction.all_predictions or {}):
+        raise ValueError(f"Unknown disease: {disease}")
+
+    image_format = params.get('image_format', 'png').lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    if image_format not in rendering.IMAGE_FORMATS:
+        raise ValueError(
+            f"image_format must be one of {', '.join(rendering.IMAGE_FORMATS)}")
+
+    # Longest side, capped like stored overlays (ML_GRADCAM_MAX_RESOLUTION)
+    max_size = rendering.max_resolution()
+    size = int(params.get('size') or max_size or 0)
+    if size and size < 16:
+        raise ValueError("size must be at least 16 pixels")
+    if max_size:
+        size = min(size, max_size)
+
+    alpha = round(float(params.get('alpha', rendering.DEFAULT_ALPHA)), 2)
+    if not 0 <= alpha <= 1:
+        raise ValueError("alpha must be between 0 and 1")
+
+    colormap = params.get('colormap') or getattr(settings, 'ML_GRADCAM_COLORMAP', 'jet')
+    if colormap not in rendering.COLORMAPS:
+        raise ValueError(f"colormap must be one of {', '.join(rendering.COLORMAPS)}")
+    return disease, image_format, size, alpha, colormap
+
+
+def _missing_heatmaps(prediction):
+    """Compute and store heatmaps for every disease that doesn't have one yet"""
+    with claim(flight_key('heatmaps', _image_hash(prediction))) as leader:
+        if not leader:
+            # Another request was computing them; use what it stored
+            prediction.refresh_from_db()
+        stored = prediction.get_heatmaps()
+        missing = [disease for disease in prediction.all_predictions if disease not in stored]
+        if missing:
+            logger.info(f"Generating heatmaps for {', '.join(missing)}")
+            heatmaps = get_predictor().generate_heatmaps(prediction.xray_image.path, missing)
+            if heatmaps:
+                prediction.save_heatmaps(heatmaps)
+    return prediction.get_heatmaps()
+
+
+def _overlay_response(request, prediction, disease, heatmap, image_format, size, alpha,
+                      colormap):
+    """Render (or fetch the cached rendering of) an overlay from a heatmap"""
+    # Addressed by the X-ray and heatmap contents, so a regenerated
+    # heatmap never serves an old rendering. No model version: the entry
+    # stays valid across model reloads, which invalidate versioned ones.
+    key = GradCAMCacheKey(
+        _image_hash(prediction), disease, '',
+        hashlib.sha256(heatmap.tobytes()).hexdigest()[:16],
+        f"overlay:{size}:{alpha}:{colormap}", image_format)
+    etag = f'"{key.digest[:32]}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        gradcam_cache = get_gradcam_cache()
+        data = gradcam_cache.get(key) if gradcam_cache is not None else None
+        if data is None:
+            base = rendering.prepare_base(
+                load_image(prediction.xray_image.path), max_size=size)
+            overlay = rendering.render_overlay(
+                base, heatmap, alpha=alpha, colormap=colormap)
+            data = rendering.encode_image(overlay, image_format)
+            if gradcam_cache is not None:
+                gradcam_cache.put(key, data)
+        response = HttpResponse(
+            data, content_type=rendering.IMAGE_FORMATS[image_format][1])
+        response['Content-Disposition'] = (
+            f'inline; filename="gradcam_{prediction.id}_{disease}.{image_format}"')
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@image_aware_negotiation
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_gradcam_overlay(request, prediction_id):
+    """
+    Render a Grad-CAM overlay from the stored heatmap
+
+    Query parameters: disease (the predicted one by default), image_format
+    (png, webp or jpeg), size (longest side in pixels), alpha and colormap.
+    Rendered variants are kept in the Grad-CAM cache.
+    """
+    try:
+        prediction = get_object_or_404(PredictionResult, id=prediction_id)
+        if not prediction.predicted_disease:
+            return Response({
+                'success': False,
+                'message': 'No predicted disease available for Grad-CAM generation'
+            }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Open and return the image file
         try:
-            with open(prediction.gradcam_image.path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='image/png')
-                response['Content-Disposition'] = f'inline; filename="gradcam_{prediction_id}.png"'
-                response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response['Pragma'] = 'no-cache'
-                response['Expires'] = '0'
+            disease, image_format, size, alpha, colormap = _overlay_options(
+                request.GET, prediction)
+        except ValueError as e:
+            return Response({
+                'success': False,
+                'message': f'Invalid overlay options: {str(e)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        heatmap = prediction.get_heatmaps().get(disease)
+        if heatmap is None:
+            # Grad-CAMs still being built after the response store it
+            if prediction.gradcam_status in ('pending', 'running') \
+                    and not is_overdue(prediction):
+                ensure_scheduled(prediction)
+                response = Response({
+                    'success': True,
+                    'message': 'Grad-CAM is being generated',
+                    'gradcam_status': prediction.gradcam_status
+                }, status=status.HTTP_202_ACCEPTED)
+                response['Retry-After'] = '2'
                 return response
-        except IOError as e:
-            logger.error(f"Error reading Grad-CAM file: {str(e)}")
-            raise Http404("Could not read Grad-CAM image file")
+            heatmap = _missing_heatmaps(prediction).get(disease)
+            if heatmap is None:
+                raise Http404(f"Could not generate Grad-CAM for disease: {disease}")
+
+        return _overlay_response(
+            request, prediction, disease, heatmap, image_format, size, alpha, colormap)
 
     except Http404:
         raise
+    except SingleFlightTimeout as e:
+        return _single_flight_timeout_response(e)
     except Exception as e:
-        logger.error(f"Error serving Grad-CAM image: {str(e)}")
+        logger.error(f"Error rendering Grad-CAM overlay: {str(e)}")
         return Response({
             'success': False,
             'message': f'Error: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -311,29 +553,29 @@ def regenerate_gradcam(request, prediction_id):
 
         logger.info(f"Regenerating Grad-CAM for disease: {disease}")
 
-        # Generate new Grad-CAM
-        gradcam_file = predictor.generate_gradcam_for_prediction(
-            prediction.xray_image.path,
-            disease
-        )
-
-        if gradcam_file:
-            # Remove old Grad-CAM image if exists and we're updating the main one
-            if disease == prediction.predicted_disease and prediction.gradcam_image:
-                try:
-                    prediction.gradcam_image.delete(save=False)
-                except Exception as delete_error:
-                    logger.warning(
-                        f"Could not delete old Grad-CAM: {delete_error}")
-
-            # Save new Grad-CAM image
-            if disease == prediction.predicted_disease:
-                prediction.gradcam_image.save(
-                    f'gradcam_{prediction.id}_{disease}.png',
-                    gradcam_file,
-                    save=True
+        predictor = get_predictor()
+        with claim(flight_key('regenerate_gradcam', _image_hash(prediction), disease)) as leader:
+            gradcam_file = None
+            if not leader:
+                # A regeneration that was already running when this request
+                # came in is as fresh as starting another one
+                prediction.refresh_from_db()
+                gradcam_file = prediction.get_gradcam_file(disease)
+
+            if not gradcam_file:
+                # Generate new Grad-CAM, bypassing and refreshing the cache
+                gradcam_file = predictor.generate_gradcam_for_prediction(
+                    prediction.xray_image.path,
+                    disease,
+                    refresh_cache=True
                 )
 
+                if gradcam_file:
+                    # Replace the stored Grad-CAM for this disease (the main image
+                    # for the predicted disease, a per-disease image otherwise)
+                    prediction.save_gradcam(disease, gradcam_file)
+
+        if gradcam_file:
             serializer = PredictionResultSerializer(prediction)
             return Response({
                 'success': True,
@@ -346,6 +588,8 @@ def regenerate_gradcam(request, prediction_id):
                 'message': f'Failed to generate Grad-CAM visualization for {disease}'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    except SingleFlightTimeout as e:
+        return _single_flight_timeout_response(e)
     except Exception as e:
         logger.error(f"Error regenerating Grad-CAM: {str(e)}")
         return Response({
@@ -354,6 +598,23 @@ def regenerate_gradcam(request, prediction_id):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_prediction_job(request, job_id):
+    """
+    Progress of a queued prediction, with the result once it has succeeded
+    """
+    job = get_object_or_404(
+        PredictionJob.objects.select_related('prediction__patient'), id=job_id)
+    response = Response({
+        'success': job.status != 'failed',
+        'data': PredictionJobSerializer(job).data,
+    }, status=status.HTTP_200_OK)
+    if job.status in ('queued', 'running'):
+        response['Retry-After'] = '1'
+    return response
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_available_diseases(request):
@@ -361,8 +622,9 @@ def get_available_diseases(request):
     Get list of diseases that can generate Grad-CAM
     """
     try:
-        if predictor.models:
-            diseases = list(predictor.models.keys())
+        predictor = get_predictor()
+        if predictor.available_diseases:
+            diseases = predictor.available_diseases
             return Response({
                 'success': True,
                 'diseases': diseases,
@@ -382,6 +644,66 @@ def get_available_diseases(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_inference_stats(request):
+    """
+    Get inference counters for tuning throughput and latency
+    """
+    remote = get_remote_predictor()
+    if remote is not None and remote.available():
+        # Batching and the Grad-CAM cache live in the inference daemon
+        daemon_status = remote.status(refresh=True)
+        return Response({
+            'success': True,
+            'models_loaded': predictor_loaded(),
+            'models': dict(daemon_status['load_report'], daemon=True),
+            'batching': daemon_status['batching'],
+            'gradcam_cache': daemon_status['gradcam_cache'],
+            'shm_transport': remote.ring_stats(),
+            'single_flight': single_flight_stats(),
+            'jobs': job_stats(),
+            'deferred_gradcam': deferred_gradcam_stats(),
+            'admission': admission_stats(),
+            'stage_timings': stage_timing_stats(),
+        }, status=status.HTTP_200_OK)
+
+    return Response({
+        'success': True,
+        'models_loaded': predictor_loaded(),
+        'models': predictor_readiness(),
+        'batching': scheduler_stats(),
+        'gradcam_cache': gradcam_cache_stats(),
+        'single_flight': single_flight_stats(),
+        'jobs': job_stats(),
+        'deferred_gradcam': deferred_gradcam_stats(),
+        'admission': admission_stats(),
+        'stage_timings': stage_timing_stats(),
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def ml_health(request):
+    """
+    Readiness of the ML models for load balancer health checks
+
+    Starts loading the models if nothing has yet. Returns 200 once at least
+    one model can serve ('ready' or 'partial') and 503 otherwise.
+    """
+    warm_up()
+    report = predictor_readiness()
+    if not request.user.is_authenticated:
+        # Load errors can include file paths
+        for model_status in report['models'].values():
+            model_status.pop('error', None)
+
+    servable = report['status'] in ('ready', 'partial')
+    return Response(
+        report,
+        status=status.HTTP_200_OK if servable else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 # Keep your existing functions...
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -391,7 +713,8 @@ def get_patient_predictions(request, patient_id):
     """
     try:
         patient = get_object_or_404(Patient, id=patient_id)
-        predictions = PredictionResult.objects.filter(patient=patient)
+        predictions = PredictionResult.objects.filter(patient=patient).select_related(
+            'patient').prefetch_related('gradcams').defer('gradcam_heatmaps')
         serializer = PredictionResultSerializer(predictions, many=True)
 
         return Response({
@@ -413,7 +736,9 @@ def get_all_predictions(request):
     Get all predictions with optional filtering
     """
     try:
-        predictions = PredictionResult.objects.all()
+        # The serializer lists Grad-CAMs per row and never needs the heatmaps
+        predictions = PredictionResult.objects.select_related('patient').prefetch_related(
+            'gradcams').defer('gradcam_heatmaps')
 
         # Optional filtering
         disease_filter = request.GET.get('disease')